@@ -0,0 +1,406 @@
+### local latency benchmark for lambda_handler
+# Starts a stub PRISM server (serves synthetic tmin / tmax zips) and a stub S3
+# server (keeps uploads in memory), points lambda_function at them through the
+# environment, and invokes the handler repeatedly. Each cold sample runs in a
+# fresh interpreter, so it includes importing the module and the one-time
+# initialization; the following invocations in that process are warm. Every
+# other invocation repeats the previous request, so warm result cache hits and
+# misses are timed separately. With --batch-days a multi-date request is also
+# timed, cold (nothing cached) and repeated. With --render-runs the PNG
+# renderer is compared with the matplotlib path it replaced: import time in
+# a fresh interpreter and time per image. With --disk-days the bytes written
+# to disk by pull_PRISM_data + load_prism_raster are compared with and
+# without extracting the zips. With --cube-lengths the peak RSS of reducing
+# GDD cubes of those lengths (spatial mean series and biofix sum) is compared
+# for a loaded cube, a lazy chunked cube (open_gdd_cube) and a streamed path,
+# each in a fresh interpreter.
+#
+#   python benchmarks/benchmark.py --cold-runs 3 --warm-runs 10 --rows 621 --cols 1405
+
+import os
+import sys
+import io
+import json
+import time
+import zipfile
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote, parse_qs
+
+import numpy as np
+
+# the deployed handler lives outside this directory, which is not packaged
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda_deployment')
+STATE = 'Benchmark'
+DATE = '20240601'
+
+
+def make_fixtures(data_dir, rows, cols):
+    # PRISM-like 4km grids over the lower 48 and a states file with one state
+    import geopandas as gpd
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as rio_copy
+    from rasterio.transform import from_origin
+    from shapely.geometry import box
+
+    res = 1 / 24
+    transform = from_origin(-125.0208333, 49.9375, res, res)
+    rng = np.random.default_rng(0)
+    tmin = 5 + 10 * rng.random((rows, cols))
+    grids = {}
+    for var, values in (('tmin', tmin), ('tmax', tmin + 5 + 10 * rng.random((rows, cols)))):
+        file_name = f'PRISM_{var}_stable_4kmD2_{DATE}_nc.nc'
+        nc_file = os.path.join(data_dir, file_name)
+        # the netCDF driver only supports CreateCopy, so write through an in-memory GeoTIFF
+        with MemoryFile() as mem_file:
+            with mem_file.open(
+                driver = 'GTiff', width = cols, height = rows, count = 1, dtype = 'float32',
+                crs = 'EPSG:4269', transform = transform, nodata = -9999) as dst:
+                dst.write(values.astype('float32'), 1)
+            with mem_file.open() as src:
+                rio_copy(src, nc_file, driver = 'netCDF')
+        with open(nc_file, 'rb') as f:
+            grids[var] = f.read()
+
+    # a state covering the middle half of the grid
+    minx, maxy = transform * (cols // 4, rows // 4)
+    maxx, miny = transform * (3 * cols // 4, 3 * rows // 4)
+    shapes_file = os.path.join(data_dir, 'states.geojson')
+    gpd.GeoDataFrame({'NAME': [STATE]}, geometry = [box(minx, miny, maxx, maxy)], crs = 'EPSG:4269').to_file(shapes_file)
+    return grids, shapes_file
+
+
+def prism_zip(grids, var, date):
+    # the same grid for every date, under that date's member name
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(f'PRISM_{var}_stable_4kmD2_{date}_nc.nc', grids[var])
+    return buffer.getvalue()
+
+
+def start_servers(grids):
+    # stub PRISM: GET /{var}/{date}?format=nc; stub S3: path-style PUT (incl.
+    # copy and multipart uploads) / GET / HEAD
+    objects = {}
+    uploads = {} # upload id -> {part number: bytes}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True # no delayed-ack stalls between header and body writes
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body = b'', headers = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            path = unquote(urlsplit(self.path).path)
+            parts = path.strip('/').split('/')
+            if parts[0] == 'prism' and parts[1] in grids:
+                self._send(200, prism_zip(grids, parts[1], parts[2]), {'Content-Type': 'application/zip'})
+            elif path in objects:
+                self._send(200, objects[path])
+            else:
+                self._send(404)
+
+        do_HEAD = do_GET
+
+        def do_POST(self):
+            # CreateMultipartUpload (?uploads) and CompleteMultipartUpload (?uploadId=)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            url = urlsplit(self.path)
+            query = parse_qs(url.query, keep_blank_values = True)
+            if 'uploads' in query:
+                upload_id = str(len(uploads))
+                uploads[upload_id] = {}
+                return self._send(200, f'<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'.encode())
+            parts = uploads.pop(query['uploadId'][0])
+            objects[unquote(url.path)] = b''.join(parts[n] for n in sorted(parts))
+            self._send(200, b'<CompleteMultipartUploadResult><ETag>"stub"</ETag></CompleteMultipartUploadResult>')
+
+        def do_PUT(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            query = parse_qs(urlsplit(self.path).query)
+            if 'uploadId' in query:
+                uploads[query['uploadId'][0]][int(query['partNumber'][0])] = body
+                return self._send(200, headers = {'ETag': '"stub"'})
+            copy_source = self.headers.get('x-amz-copy-source')
+            if copy_source is None:
+                objects[unquote(urlsplit(self.path).path)] = body
+                return self._send(200, headers = {'ETag': '"stub"'})
+            source = '/' + unquote(copy_source).lstrip('/')
+            if source not in objects:
+                return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>')
+            objects[unquote(urlsplit(self.path).path)] = objects[source]
+            self._send(200, b'<CopyObjectResult><ETag>"stub"</ETag><LastModified>2024-01-01T00:00:00.000Z</LastModified></CopyObjectResult>')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, objects
+
+
+def run_batch_worker(batch_days):
+    # one multi-date request with two threshold pairs, run twice (miss, then hit)
+    sys.path.insert(0, HANDLER_DIR)
+    import lambda_function
+    import pandas as pd
+
+    dates = pd.date_range(DATE, periods = batch_days).strftime('%Y%m%d')
+    event = {
+        'start_date': dates[0], 'end_date': dates[-1], 'thresholds': '10:30,5:25',
+        'accumulate': 'true', 'user': 'benchmark', 'state': STATE}
+    bodies = []
+    for _ in range(2):
+        response = lambda_function.lambda_handler(event, None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(f'handler returned {response}')
+        bodies.append(json.loads(response['body']))
+    print(json.dumps(bodies))
+
+
+def run_render_benchmark(rows, cols, runs):
+    # import cost in fresh interpreters, then per-image render time in this one
+    for label, module in (('import render', 'degree_day.render'), ('import pyplot', 'matplotlib.pyplot')):
+        code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+        times = [float(subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True).stdout)
+                 for _ in range(runs)]
+        summarize(label, times)
+
+    import xarray as xra
+    from degree_day.render import render_png
+    yy, xx = np.mgrid[0:rows, 0:cols]
+    values = (15 + 10 * np.sin(xx / 90) * np.cos(yy / 60)).astype('float32')
+    values[:rows // 10, :cols // 10] = np.nan
+    raster = xra.DataArray(values, dims = ('y', 'x'), coords = {'y': -np.arange(rows), 'x': np.arange(cols)})
+
+    def render_pyplot():
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        raster.plot()
+        fig.savefig(io.BytesIO(), format = 'png')
+        plt.close(fig)
+
+    for label, render in (('render_png', lambda: render_png(raster)), ('pyplot plot + savefig', render_pyplot)):
+        render() # warm up
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            render()
+            times.append(time.perf_counter() - start)
+        summarize(label, times)
+
+
+def written_bytes():
+    # bytes this process has passed to write() so far (Linux)
+    with open('/proc/self/io') as f:
+        return int(dict(line.split(': ') for line in f.read().splitlines())['wchar'])
+
+def tree_bytes(root):
+
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+def run_disk_benchmark(endpoint, shapes_file, work_dir, days):
+    # disk bytes for pulling and loading days of tmin / tmax, extracted vs read in the zip
+    import geopandas as gpd
+    import pandas as pd
+    from degree_day.degree_day import pull_PRISM_data
+    from degree_day.download import PrismDownloader
+    from degree_day.prism_io import load_prism_raster
+
+    geometry = gpd.read_file(shapes_file).geometry
+    dates = pd.date_range(DATE, periods = days).strftime('%Y%m%d')
+    for extract in (True, False):
+        prism_dir = os.path.join(work_dir, f'disk-extract-{extract}')
+        with PrismDownloader(rate = 1000, burst = 100) as downloader:
+            start = written_bytes()
+            for target_date in dates:
+                if not pull_PRISM_data(
+                    target_date, ['tmin', 'tmax'], prism_dir, downloader = downloader, extract = extract,
+                    base_url = f'{endpoint}/prism'):
+                    raise RuntimeError(f'pull failed for {target_date}')
+                for var in ('tmin', 'tmax'):
+                    load_prism_raster(
+                        os.path.join(prism_dir, target_date, var), f'{target_date}_{var}.zip',
+                        f'PRISM_{var}_stable_4kmD2_{target_date}_nc.nc', geometry)
+            written = written_bytes() - start
+        label = 'extract=True (before)' if extract else 'extract=False (after)'
+        print(f'{label:<24} n_days={days:<4} written={written / 2 ** 20:9.2f} MiB  on disk={tree_bytes(prism_dir) / 2 ** 20:9.2f} MiB  per day={written / days / 2 ** 20:7.2f} MiB')
+
+
+def write_cube(cube_file, n_dates, rows, cols, block_dates = 64):
+    # a synthetic GDD cube of n_dates daily slices from 2020-01-01
+    import pandas as pd
+    import xarray as xra
+    from degree_day.cube_store import GddCubeStore
+
+    template = xra.DataArray(
+        np.zeros((rows, cols), dtype = 'float32'), dims = ('y', 'x'),
+        coords = {'y': 50 - np.arange(rows) / 24, 'x': -125 + np.arange(cols) / 24})
+    dates = pd.date_range('2020-01-01', periods = n_dates)
+    rng = np.random.default_rng(0)
+    cube_store = GddCubeStore(cube_file, overwrite = True)
+    for start in range(0, n_dates, block_dates):
+        block = dates[start:start + block_dates]
+        cube_store.write_block(start, block, (20 * rng.random((len(block), rows, cols))).astype('float32'), template = template)
+
+def vm_hwm():
+    # peak resident set size of this process, bytes (Linux)
+    with open('/proc/self/status') as f:
+        return 1024 * int(next(line for line in f if line.startswith('VmHWM')).split()[1])
+
+def run_cube_worker(cube_file, mode):
+    # reduce the cube one way; resident memory after the imports and peak RSS
+    # of the reduction (the high-water mark is reset after importing) as json
+    import xarray as xra
+    from degree_day.degree_day import open_gdd_cube, aggregate_cube_to_timeseries, aggregate_cube_by_date
+
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5') # reset VmHWM to the current RSS
+    baseline = vm_hwm()
+    start = time.perf_counter()
+    if mode == 'stream':
+        aggregate_cube_to_timeseries(cube_file)
+    else:
+        cube = xra.load_dataarray(cube_file) if mode == 'load' else open_gdd_cube(cube_file)
+        aggregate_cube_to_timeseries(cube)
+        aggregate_cube_by_date(cube, start_day = '03-01').values
+    print(json.dumps({'baseline': baseline, 'rss': vm_hwm(), 'elapsed': time.perf_counter() - start}))
+
+def run_cube_benchmark(work_dir, lengths, rows, cols):
+    # peak RSS against cube length, per way of reading the cube
+    print(f'cube memory, grid {rows} x {cols}')
+    for n_dates in lengths:
+        cube_file = os.path.join(work_dir, f'cube_{n_dates}.nc')
+        write_cube(cube_file, n_dates, rows, cols)
+        size = os.path.getsize(cube_file)
+        for mode in ('load', 'lazy', 'stream'):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--cube-worker', cube_file, '--cube-mode', mode],
+                capture_output = True, text = True)
+            if out.returncode != 0:
+                print(out.stdout[-2000:], out.stderr[-2000:])
+                raise RuntimeError('benchmark cube worker failed')
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{mode:<8} n_dates={n_dates:<5} cube={size / 2 ** 20:9.1f} MiB  peak rss={result['rss'] / 2 ** 20:9.1f} MiB  above imports={(result['rss'] - result['baseline']) / 2 ** 20:9.1f} MiB  time={result['elapsed'] * 1000:9.1f} ms")
+        os.remove(cube_file)
+
+
+def run_worker(warm_runs, worker_id):
+    # one cold start followed by warm invocations, timings as json on the last line
+    sys.path.insert(0, HANDLER_DIR)
+    start = time.perf_counter()
+    import lambda_function
+    import_time = time.perf_counter() - start
+
+    times = []
+    for i in range(warm_runs + 1):
+        # a new upper threshold on even calls (result cache miss), repeated on odd calls (hit)
+        ut = 30 + worker_id * (warm_runs + 1) + i // 2
+        event = {'date': DATE, 'temp_low': '10', 'temp_high': str(ut), 'user': f'benchmark{i}', 'state': STATE}
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        times.append((time.perf_counter() - start, response.get('headers', {}).get('X-Cache', 'miss')))
+        if response['statusCode'] != 200:
+            raise RuntimeError(f'handler returned {response}')
+    print(json.dumps({'import': import_time, 'first': times[0][0], 'warm': times[1:]}))
+
+
+def summarize(label, values):
+
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    print(f'{label:<24} n={len(values):<4} median={statistics.median(values) * 1000:9.1f} ms  p95={p95 * 1000:9.1f} ms  max={values[-1] * 1000:9.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Cold-start and warm-path latency of lambda_handler against local stubs.')
+    parser.add_argument('--cold-runs', type = int, default = 3)
+    parser.add_argument('--warm-runs', type = int, default = 10)
+    parser.add_argument('--rows', type = int, default = 621)
+    parser.add_argument('--cols', type = int, default = 1405)
+    parser.add_argument('--batch-days', type = int, default = 0, help = 'also time a batch request over this many dates')
+    parser.add_argument('--render-runs', type = int, default = 0, help = 'also compare png rendering with matplotlib')
+    parser.add_argument('--disk-days', type = int, default = 0, help = 'also compare disk bytes written with and without extracting zips')
+    parser.add_argument('--cube-lengths', type = str, default = '', help = 'also compare peak RSS of cube reductions, e.g. 30,365,730')
+    parser.add_argument('--worker', type = int, default = None, help = argparse.SUPPRESS)
+    parser.add_argument('--cube-worker', type = str, default = None, help = argparse.SUPPRESS)
+    parser.add_argument('--cube-mode', type = str, default = 'lazy', help = argparse.SUPPRESS)
+    parser.add_argument('--batch-worker', action = 'store_true', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        return run_worker(args.warm_runs, args.worker)
+    if args.batch_worker:
+        return run_batch_worker(args.batch_days)
+    if args.cube_worker is not None:
+        return run_cube_worker(args.cube_worker, args.cube_mode)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        grids, shapes_file = make_fixtures(work_dir, args.rows, args.cols)
+        server, objects = start_servers(grids)
+        endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+        env = dict(
+            os.environ,
+            PRISM_BASE_URL = f'{endpoint}/prism',
+            S3_ENDPOINT_URL = endpoint,
+            S3_BUCKET = 'benchmark',
+            STATE_SHAPES_PATH = shapes_file,
+            STORAGE_DIR = os.path.join(work_dir, 'prism-etl'),
+            EFS_DIR = os.path.join(work_dir, 'no-efs'),
+            AWS_ACCESS_KEY_ID = 'stub',
+            AWS_SECRET_ACCESS_KEY = 'stub',
+            AWS_DEFAULT_REGION = 'us-east-1',
+            AWS_REQUEST_CHECKSUM_CALCULATION = 'when_required',
+        )
+
+        def run(*worker_args):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *worker_args],
+                env = env, capture_output = True, text = True)
+            if out.returncode != 0:
+                print(out.stdout[-2000:], out.stderr[-2000:])
+                raise RuntimeError('benchmark worker failed')
+            return json.loads(out.stdout.strip().splitlines()[-1])
+
+        results = [run('--worker', str(i), '--warm-runs', str(args.warm_runs)) for i in range(args.cold_runs)]
+        batch = run('--batch-worker', '--batch-days', str(args.batch_days)) if args.batch_days > 0 else None
+        if args.disk_days > 0:
+            run_disk_benchmark(endpoint, shapes_file, work_dir, args.disk_days)
+        server.shutdown()
+
+    if args.render_runs > 0:
+        run_render_benchmark(args.rows, args.cols, args.render_runs)
+    if args.cube_lengths:
+        with tempfile.TemporaryDirectory() as work_dir:
+            run_cube_benchmark(work_dir, [int(n) for n in args.cube_lengths.split(',')], args.rows, args.cols)
+    print(f'grid {args.rows} x {args.cols}, {len(objects)} objects uploaded')
+    summarize('import + init', [r['import'] for r in results])
+    summarize('cold start (total)', [r['import'] + r['first'] for r in results])
+    summarize('first invocation', [r['first'] for r in results])
+    warm_miss = [t for r in results for t, cache in r['warm'] if cache == 'miss']
+    warm_hit = [t for r in results for t, cache in r['warm'] if cache != 'miss']
+    if warm_miss:
+        summarize('warm invocation (miss)', warm_miss)
+    if warm_hit:
+        summarize('warm invocation (hit)', warm_hit)
+    if batch is not None:
+        for label, body in zip(('batch (miss)', 'batch (hit)'), batch):
+            print(f"{label:<24} n_days={body['n_days']:<4} total={body['elapsed_s'] * 1000:9.1f} ms  per day={body['per_day_ms']:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import os
+import numpy as np
+import pandas as pd
+import netCDF4
+from .cube_store import GddCubeStore, DATA_VAR, slice_template
+from .cube_index import update_cumsum_index
+from .climatology import ClimatologyStore
+
+### departure from normal of observed GDD
+# Compares an observed cube (build_gdd_cube) with the normals, either a
+# ClimatologyStore or a normals cube (create_gdd_cube_normals), by day of year
+# on each observed date's own calendar, so normal years leave out the normals'
+# 02-29. Both sides are read as running totals (the observed cube's cumsum
+# index, the normals' cumulative layers), so GDD accumulated since the biofix
+# at any date costs a couple of slice reads, and outputs are written
+# chunk_days dates at a time with memory bounded by the chunk:
+# - <cube>_anomaly.nc: observed minus normal accumulated GDD
+# - <cube>_pct_normal.nc: observed accumulated GDD as a percent of normal
+# An update only recomputes dates whose running totals were rewritten since
+# the outputs were, so appending a day costs one date of work.
+
+
+def anomaly_path(cube_file: str):
+
+    root, ext = os.path.splitext(cube_file)
+    return f'{root}_anomaly{ext}'
+
+def percent_path(cube_file: str):
+
+    root, ext = os.path.splitext(cube_file)
+    return f'{root}_pct_normal{ext}'
+
+
+class _StoreNormals:
+    # cumulative normals of one pest in a ClimatologyStore
+    def __init__(self, store: ClimatologyStore, pest: str):
+        self.store = store
+        self.pest = pest
+        self.key = f'{os.path.abspath(store.path)}:{pest}:{store.pests()[pest]}'
+
+    def cumulative(self, dates: pd.DatetimeIndex):
+        # normal GDD from Jan 1 through each date's day of year, on its calendar
+        out = np.empty((len(dates),) + self.store.template().shape)
+        for leap in (True, False):
+            pick = np.flatnonzero(dates.is_leap_year == leap)
+            if len(pick) > 0:
+                out[pick] = self.store.cumulative(self.pest, dates[pick].strftime('%m%d').tolist(), leap)
+        return out
+
+
+class _CubeNormals:
+    # cumulative normals from a normals cube and its cumsum index
+    def __init__(self, cube_file: str):
+        self.index_store = GddCubeStore(update_cumsum_index(cube_file))
+        written = self.index_store.written_at()
+        self.dates = written.index
+        self.year = self.dates[0].year
+        self.shape = slice_template(cube_file).shape
+        self.key = f'{os.path.abspath(cube_file)}@{written.max()}'
+
+    def _position(self, date):
+        # last normals date on or before date's day of year, -1 if none
+        try:
+            day = pd.Timestamp(self.year, date.month, date.day)
+        except ValueError:
+            day = pd.Timestamp(self.year, 2, 28) # 02-29 against normals of a normal year
+        return self.dates.searchsorted(day, side = 'right') - 1
+
+    def cumulative(self, dates: pd.DatetimeIndex):
+
+        positions = [self._position(date) for date in dates]
+        reads = {p for p in positions if p >= 0}
+        leap_day = pd.Timestamp(self.year, 2, 29) if pd.Timestamp(self.year, 1, 1).is_leap_year else None
+        e = self.dates.get_loc(leap_day) if leap_day in self.dates else None
+        if e is not None:
+            reads |= {e, e - 1} - {-1}
+        reads = sorted(reads)
+        slices = dict(zip(reads, self.index_store.read_slices(reads)))
+        zero = np.zeros(self.shape)
+        out = np.empty((len(dates),) + self.shape)
+        for i, (date, p) in enumerate(zip(dates, positions)):
+            out[i] = slices[p] if p >= 0 else zero
+            if (e is not None) and (not date.is_leap_year) and (p >= e):
+                out[i] -= slices[e] - slices.get(e - 1, zero)
+        return out
+
+
+def _normals_source(normals, pest):
+
+    if isinstance(normals, ClimatologyStore):
+        if pest is None:
+            raise ValueError('pest is required with a ClimatologyStore.')
+        return _StoreNormals(normals, pest)
+    return _CubeNormals(normals)
+
+def _default_start_day(normals, pest, start_day):
+
+    if start_day is not None:
+        return start_day
+    if isinstance(normals, ClimatologyStore):
+        return normals.pests()[pest]['start_date']
+    return '01-01'
+
+def _season_start(date, start_day, first_date):
+    # accumulation start of date's season: the biofix in its year, or the
+    # first observed date when the cube starts later
+    month, day = [int(x) for x in start_day.split('-')]
+    return max(pd.Timestamp(date.year, month, day), first_date)
+
+def _departures(index_store, obs_dates, positions, source, start_day):
+    # (anomaly, percent) blocks for the observed dates at positions
+    dates = obs_dates[positions]
+    observed = np.stack(index_store.read_slices(list(positions)))
+    normal = source.cumulative(dates)
+
+    # running totals just before each season start, both sides
+    starts = pd.DatetimeIndex([_season_start(d, start_day, obs_dates[0]) for d in dates])
+    before = starts - pd.Timedelta(days = 1)
+    base_positions = obs_dates.searchsorted(starts, side = 'left') - 1
+    base_reads = sorted({p for p in base_positions if p >= 0})
+    base_slices = dict(zip(base_reads, index_store.read_slices(base_reads)))
+    zero = np.zeros(observed.shape[1:])
+    observed_base = np.stack([base_slices[p] if p >= 0 else zero for p in base_positions])
+    normal_base = source.cumulative(before)
+    normal_base[before.year < dates.year] = 0 # season starts on Jan 1
+
+    started = (dates >= starts)[:, None, None]
+    observed_acc = np.where(started, observed - observed_base, 0)
+    normal_acc = np.where(started, normal - normal_base, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        percent = np.where(normal_acc > 0, 100 * observed_acc / normal_acc, np.nan)
+    return (observed_acc - normal_acc).astype(np.float32), percent.astype(np.float32)
+
+def _cube_attrs(cube_file):
+
+    if not os.path.isfile(cube_file):
+        return None
+    with netCDF4.Dataset(cube_file, mode = 'r') as nc:
+        return {k: nc[DATA_VAR].getncattr(k) for k in nc[DATA_VAR].ncattrs() if k.startswith('normal')}
+
+def update_anomaly_cubes(
+    cube_file: str, # observed GDD cube
+    normals, # ClimatologyStore, or path to a normals cube
+    pest: str = None, # pest in the ClimatologyStore
+    start_day: str = None, # biofix 'mm-dd', defaults to the pest's in the store, else '01-01'
+    anomaly_file: str = None,
+    percent_file: str = None,
+    chunk_days: int = 32,
+):
+    # build the anomaly and percent-of-normal cubes, or bring them up to date
+    # from the first date whose running total changed. Returns their paths.
+    anomaly_file = anomaly_file or anomaly_path(cube_file)
+    percent_file = percent_file or percent_path(cube_file)
+    start_day = _default_start_day(normals, pest, start_day)
+    source = _normals_source(normals, pest)
+
+    index_store = GddCubeStore(update_cumsum_index(cube_file))
+    index_written = index_store.written_at()
+    obs_dates = index_written.index
+    template = slice_template(cube_file)
+    template.attrs = {'normals': source.key, 'normals_start_day': start_day}
+
+    stores = [GddCubeStore(anomaly_file), GddCubeStore(percent_file)]
+    written = []
+    for i, out_store in enumerate(stores):
+        out_written = out_store.written_at()
+        if (_cube_attrs(out_store.path) not in (None, template.attrs)) or not set(out_written.index).issubset(obs_dates):
+            # other normals / biofix, or dates removed from the cube: start over
+            stores[i] = GddCubeStore(out_store.path, overwrite = True)
+            out_written = stores[i].written_at()
+        written.append(out_written)
+
+    # first date not yet written by both outputs after its running total
+    k = 0
+    while (k < len(obs_dates)) and all(
+        (k < len(w)) and (w.index[k] == obs_dates[k]) and not (index_written.iloc[k] > w.iloc[k]) for w in written):
+        k += 1
+    for c in range(k, len(obs_dates), chunk_days):
+        positions = np.arange(c, min(c + chunk_days, len(obs_dates)))
+        anomaly, percent = _departures(index_store, obs_dates, positions, source, start_day)
+        for i, date in enumerate(obs_dates[positions]):
+            stores[0].write(template.copy(data = anomaly[i]), date = date)
+            stores[1].write(template.copy(data = percent[i]), date = date)
+    return anomaly_file, percent_file
+
+def departure_layer(
+    cube_file: str,
+    normals,
+    date: str, # observed date, e.g. '2024-06-30'
+    pest: str = None,
+    start_day: str = None,
+):
+    # (anomaly, percent of normal) of GDD accumulated since the biofix, for one
+    # observed date, from a handful of slice reads
+    start_day = _default_start_day(normals, pest, start_day)
+    source = _normals_source(normals, pest)
+    index_store = GddCubeStore(update_cumsum_index(cube_file))
+    obs_dates = index_store.dates()
+    date = pd.Timestamp(date)
+    if date not in obs_dates:
+        raise ValueError(f'{date.date()} is not in the cube {cube_file}.')
+    anomaly, percent = _departures(index_store, obs_dates, np.array([obs_dates.get_loc(date)]), source, start_day)
+    template = slice_template(cube_file)
+    return tuple(
+        template.copy(data = values[0]).assign_coords(date = date.to_datetime64()).expand_dims(date = 1)
+        for values in (anomaly, percent))
@@ -0,0 +1,188 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xra
+import netCDF4
+
+### precomputed daily-normals climatology store
+# PRISM 30-year daily normals only change once a decade, so for a region they
+# are pulled, clipped and computed once and kept in a single NetCDF file:
+# - tmin, tmax: the clipped normals, (day, y, x) over the 366 days of a leap year
+# - gdd: normal daily GDD per pest, (pest, day, y, x)
+# - gdd_cumsum: running GDD total from Jan 1 per pest over the leap calendar
+# Any biofix-to-date layer is then one difference of two cumulative slices;
+# normal-year layers also take off the 02-29 slice when the window spans it.
+# The pest dimension is unlimited, so pests can be added later from the stored
+# normals without going back to PRISM. Data is chunked in blocks of days and
+# compressed.
+
+DAYS = pd.date_range('2024-01-01', '2024-12-31').strftime('%m%d').tolist() # leap calendar
+LEAP_DAY = DAYS.index('0229')
+PEST_ATTRS = ('lt', 'ut', 'method', 'start_date')
+
+
+def pest_record(params: dict):
+    # the parameters a pest's stored GDD depend on, with the defaults filled in
+    return {
+        'lt': float(params['lt']), 'ut': float(params['ut']),
+        'method': str(params.get('method', 'single_sine')), 'start_date': str(params.get('start_date', '01-01'))}
+
+def day_index(day: str):
+    # position of 'mm-dd' (or 'm-d') or 'mmdd' in the leap calendar
+    if '-' in day:
+        month, day = day.split('-')
+        day = f'{int(month):02d}{int(day):02d}'
+    return DAYS.index(day)
+
+
+class ClimatologyStore:
+    def __init__(self, path, chunk_days: int = 16, zlib: bool = True):
+        self.path = path
+        self.chunk_days = chunk_days
+        self.zlib = zlib
+
+    def exists(self):
+
+        return os.path.isfile(self.path)
+
+    def has_normals(self):
+        # set once every day of tmin / tmax has been written
+        if not self.exists():
+            return False
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return bool(getattr(nc, 'normals_complete', 0))
+
+    def pests(self):
+        # {pest: pest_record} of the stored pests
+        if not self.exists():
+            return {}
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            names = list(nc['pest'][:])
+            params = {attr: list(nc[f'pest_{attr}'][:]) for attr in PEST_ATTRS}
+        return {name: pest_record({attr: params[attr][i] for attr in PEST_ATTRS}) for i, name in enumerate(names)}
+
+    def create(self, template: xra.DataArray):
+        # lay out dimensions, coordinates and crs from a clipped (y, x) raster
+        y_dim, x_dim = template.dims
+        n_y, n_x = template.sizes[y_dim], template.sizes[x_dim]
+        chunks = (min(self.chunk_days, len(DAYS)), min(n_y, 256), min(n_x, 256))
+        with netCDF4.Dataset(self.path, mode = 'w') as nc:
+            nc.createDimension('day', len(DAYS))
+            nc.createDimension('pest', None)
+            nc.createDimension(y_dim, n_y)
+            nc.createDimension(x_dim, n_x)
+            nc.createVariable('day', str, ('day',))[:] = np.array(DAYS, dtype = object)
+            nc.createVariable('pest', str, ('pest',))
+            for attr in PEST_ATTRS:
+                nc.createVariable(f'pest_{attr}', 'f8' if attr in ('lt', 'ut') else str, ('pest',))
+            for dim in (y_dim, x_dim):
+                coord_var = nc.createVariable(dim, 'f8', (dim,))
+                coord_var[:] = template[dim].values
+                coord_var.setncatts(template[dim].attrs)
+
+            data_attrs = {}
+            if 'spatial_ref' in template.coords:
+                crs_var = nc.createVariable('spatial_ref', 'i8')
+                crs_var.setncatts(template['spatial_ref'].attrs)
+                crs_var.assignValue(0)
+                data_attrs = {'coordinates': 'spatial_ref', 'grid_mapping': 'spatial_ref'}
+            for var in ('tmin', 'tmax'):
+                data_var = nc.createVariable(
+                    var, 'f4', ('day', y_dim, x_dim), fill_value = np.nan, chunksizes = chunks, zlib = self.zlib)
+                data_var.setncatts(data_attrs)
+            # running totals are float64 so differences of late-season totals stay exact
+            for var, dtype in (('gdd', 'f4'), ('gdd_cumsum', 'f8')):
+                data_var = nc.createVariable(
+                    var, dtype, ('pest', 'day', y_dim, x_dim), fill_value = np.nan,
+                    chunksizes = (1,) + chunks, zlib = self.zlib)
+                data_var.setncatts(data_attrs)
+            nc.normals_complete = 0
+
+    def write_normals(self, var: str, day_start: int, values: np.ndarray, complete: bool = False):
+        # values: (days, y, x) block starting at day_start
+        with netCDF4.Dataset(self.path, mode = 'a') as nc:
+            nc[var][day_start:day_start + len(values), :, :] = values
+            if complete:
+                nc.normals_complete = 1
+
+    def read_normals(self, day_start: int = 0, day_end: int = len(DAYS)):
+        # (tmin, tmax) numpy blocks for days [day_start, day_end)
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return tuple(nc[var][day_start:day_end, :, :].filled(np.nan) for var in ('tmin', 'tmax'))
+
+    def set_pests(self, pest_params: dict, pest_list: list):
+        # record the pests' parameters, in place for stored pests and at the end
+        # of the pest dimension for new ones; returns their positions
+        with netCDF4.Dataset(self.path, mode = 'a') as nc:
+            names = list(nc['pest'][:])
+            positions = []
+            for pest in pest_list:
+                if pest not in names:
+                    names.append(pest)
+                    nc['pest'][len(names) - 1] = pest
+                p = names.index(pest)
+                for attr, value in pest_record(pest_params[pest]).items():
+                    nc[f'pest_{attr}'][p] = value
+                positions.append(p)
+        return positions
+
+    def write_pest_block(self, var: str, pest_index: list, day_start: int, values: np.ndarray):
+        # values: (pest, days, y, x) for the pests at pest_index
+        with netCDF4.Dataset(self.path, mode = 'a') as nc:
+            for i, p in enumerate(pest_index):
+                nc[var][p, day_start:day_start + values.shape[1], :, :] = values[i]
+
+    def _pest_position(self, nc, pest):
+
+        names = list(nc['pest'][:])
+        if pest not in names:
+            raise KeyError(f'{pest} is not in the climatology store {self.path}.')
+        return names.index(pest)
+
+    def template(self):
+        # coordinates of one (y, x) slice, without reading any data; loaded so
+        # nothing keeps a lazy handle on the store after it is closed
+        with xra.open_dataset(self.path) as ds:
+            template = ds['tmin'].isel(day = 0, drop = True)
+            return template.copy(data = np.zeros(template.shape)).load()
+
+    def daily(self, pest: str, day: str):
+        # normal daily GDD of one day for one pest, as a (y, x) array
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return nc['gdd'][self._pest_position(nc, pest), day_index(day), :, :].filled(np.nan)
+
+    def cumulative(self, pest: str, days: list, leap: bool = True):
+        # normal GDD accumulated from Jan 1 through each day, (days, y, x); on
+        # the normal-year calendar 02-29 adds nothing
+        index = [day_index(day) for day in days]
+        reads = sorted(set(index))
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            p = self._pest_position(nc, pest)
+            if len(reads) == 0:
+                return np.zeros((0,) + nc['gdd_cumsum'].shape[2:])
+            block = nc['gdd_cumsum'][p, reads, :, :].filled(np.nan)
+            if (not leap) and reads[-1] >= LEAP_DAY:
+                leap_gdd = np.nan_to_num(nc['gdd'][p, LEAP_DAY, :, :].filled(np.nan))
+                block[np.array(reads) >= LEAP_DAY] -= leap_gdd
+        return block[[reads.index(i) for i in index]]
+
+    def layer(self, pest: str, end_day: str, leap: bool = True, start_day: str = None):
+        # normal GDD accumulated from start_day (default the pest's biofix)
+        # through end_day, both inclusive: S[end] - S[start - 1], two slice
+        # reads. Outside the region and before the biofix the total is 0, like
+        # aggregate_cube_by_date.
+        if (not leap) and day_index(end_day) == LEAP_DAY:
+            raise ValueError('02-29 is not a day of a normal year.')
+        if start_day is None:
+            start_day = self.pests()[pest]['start_date']
+        a, b = day_index(start_day), day_index(end_day)
+        if b < a:
+            return np.zeros(self.template().shape)
+        if a == 0:
+            return self.cumulative(pest, [DAYS[b]], leap)[0]
+        end, before_start = self.cumulative(pest, [DAYS[b], DAYS[a - 1]], leap)
+        return end - before_start
+
+    def open(self, chunks: dict = None):
+        # lazy Dataset view of the whole store, e.g. for ad-hoc analysis
+        return xra.open_dataset(self.path, chunks = chunks)
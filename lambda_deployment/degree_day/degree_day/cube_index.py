@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pandas as pd
+from .cube_store import GddCubeStore, slice_template
+
+### cumulative (prefix-sum) companion cubes
+# Next to gdd_cube_<pest>.nc sits gdd_cube_<pest>_cumsum.nc holding the running
+# sum of daily GDD along date (nodata counted as 0, like .sum(dim='date')).
+# Any accumulation over a date range is then S[end] - S[start - 1], and an
+# excluded day such as 02-29 is one more subtraction, instead of a sum over
+# every day in the range.
+
+
+def cumsum_path(cube_file: str):
+
+    root, ext = os.path.splitext(cube_file)
+    return f'{root}_cumsum{ext}'
+
+def update_cumsum_index(cube_file: str, index_file: str = None):
+    # build the index, or extend it from the first date where it no longer 
+    # matches the cube, so appending a day costs one slice
+    index_file = index_file or cumsum_path(cube_file)
+    cube_store = GddCubeStore(cube_file)
+    index_store = GddCubeStore(index_file)
+    cube_written = cube_store.written_at()
+    index_written = index_store.written_at()
+
+    if not set(index_written.index).issubset(cube_written.index):
+        # dates were removed from the cube, start over
+        index_store = GddCubeStore(index_file, overwrite = True)
+        index_written = index_store.written_at()
+
+    n = min(len(cube_written), len(index_written))
+    k = 0
+    while (k < n) and (cube_written.index[k] == index_written.index[k]) and not (cube_written.iloc[k] > index_written.iloc[k]):
+        k += 1
+    if k == len(cube_written):
+        return index_file
+
+    template = slice_template(cube_file)
+    running = np.zeros(template.shape)
+    if k > 0:
+        running = index_store.read_slices([k - 1])[0]
+    for date, values in cube_store.iter_slices(start = k):
+        running = running + np.nan_to_num(values)
+        index_store.write(template.copy(data = running), date = date)
+
+    return index_file
+
+def index_is_current(cube_file: str, index_file: str = None):
+    # the index covers exactly the cube's dates and no cube slice is newer than it
+    index_file = index_file or cumsum_path(cube_file)
+    if not (os.path.isfile(cube_file) and os.path.isfile(index_file)):
+        return False
+    cube_written = GddCubeStore(cube_file).written_at()
+    index_written = GddCubeStore(index_file).written_at()
+    if not cube_written.index.equals(index_written.index):
+        return False
+    return not (cube_written > index_written).any()
+
+def sum_dates_from_index(
+    index_file: str, 
+    start_date: pd.Timestamp, 
+    end_date: pd.Timestamp, 
+    exclude_date: pd.Timestamp = None, 
+):
+    # sum of daily GDD for start_date <= date <= end_date, less exclude_date
+    dates = GddCubeStore(index_file).dates()
+    a = dates.searchsorted(start_date, side = 'left')
+    b = dates.searchsorted(end_date, side = 'right') - 1
+
+    positions = [b, a - 1]
+    if (exclude_date is not None) and (exclude_date in dates):
+        e = dates.get_loc(exclude_date)
+        if a <= e <= b:
+            positions += [e, e - 1]
+    signs = [1, -1, -1, 1][:len(positions)]
+    reads = [p for p in positions if p >= 0]
+    slices = dict(zip(reads, GddCubeStore(index_file).read_slices(reads)))
+
+    total = None
+    for p, sign in zip(positions, signs):
+        if p < 0 or b < a:
+            continue
+        total = sign * slices[p] if total is None else total + sign * slices[p]
+    return total
@@ -0,0 +1,243 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import xarray as xra
+import netCDF4
+
+### append-only on-disk GDD cube
+# A NetCDF file with an unlimited `date` dimension, chunked one date slice at a
+# time, so adding a day writes only that slice instead of reloading and
+# rewriting the whole cube. Files stay readable with xra.open_dataarray /
+# xra.load_dataarray like the cubes written by to_netcdf.
+# With chunk_dates / tile the layout is time-major instead (many dates by a
+# small spatial tile per chunk), for reading the series of a few cells.
+# Dates are decoded with the variable's own units / calendar, so cubes written
+# by plain to_netcdf (int64 "days since <first date>", fixed `date` dimension)
+# read correctly. Those cannot grow in place: writing to one raises until it
+# is rewritten once into this layout with migrate().
+
+DATA_VAR = '__xarray_dataarray_variable__'
+DATE_UNITS = 'days since 1970-01-01 00:00:00'
+DATE_CALENDAR = 'proleptic_gregorian'
+
+
+def slice_template(cube_file: str):
+    # zero (y, x) array with the coordinates of one date slice, without reading any data
+    with xra.open_dataarray(cube_file) as cube:
+        template = cube.isel(date = 0, drop = True)
+        if 'date_written' in template.coords:
+            template = template.drop_vars('date_written')
+        return template.copy(data = np.zeros(template.shape))
+
+def _decode_times(time_var):
+    # DatetimeIndex of a CF time variable, NaT where unwritten
+    values = time_var[:]
+    written = ~np.ma.getmaskarray(values)
+    if values.dtype.kind == 'f':
+        written &= ~np.isnan(np.ma.getdata(values))
+    times = np.full(values.shape, np.datetime64('NaT'), dtype = 'datetime64[ns]')
+    if written.any():
+        decoded = netCDF4.num2date(
+            np.ma.getdata(values)[written], time_var.units, getattr(time_var, 'calendar', 'standard'),
+            only_use_cftime_datetimes = False, only_use_python_datetimes = True)
+        times[written] = pd.to_datetime(list(decoded)).as_unit('ns').values
+    return pd.DatetimeIndex(times)
+
+def _encode_dates(date_var, dates):
+    # numbers in date_var's units; whole days stay whole in integer variables
+    nums = netCDF4.date2num(
+        [pd.Timestamp(date).to_pydatetime() for date in dates], date_var.units, getattr(date_var, 'calendar', 'standard'))
+    return np.round(nums).astype(date_var.dtype) if date_var.dtype.kind == 'i' else nums
+
+
+class GddCubeStore:
+    def __init__(self, path, overwrite = False, zlib = False, chunk_dates: int = 1, tile: int = None):
+        self.path = path
+        self.zlib = zlib
+        self.chunk_dates = chunk_dates
+        self.tile = tile # None for whole slices
+        if overwrite and os.path.isfile(path):
+            os.remove(path)
+
+    def exists(self):
+
+        return os.path.isfile(self.path)
+
+    def _create(self, dd_slice):
+        # lay out dimensions, coordinates and crs from the first slice
+        y_dim, x_dim = dd_slice.dims
+        with netCDF4.Dataset(self.path, mode = 'w') as nc:
+            nc.createDimension('date', None)
+            nc.createDimension(y_dim, dd_slice.sizes[y_dim])
+            nc.createDimension(x_dim, dd_slice.sizes[x_dim])
+
+            date_var = nc.createVariable('date', 'f8', ('date',))
+            date_var.units = DATE_UNITS
+            date_var.calendar = DATE_CALENDAR
+
+            # when each slice was last written, to spot slices older than their inputs
+            written_var = nc.createVariable('date_written', 'f8', ('date',))
+            written_var.units = 'seconds since 1970-01-01 00:00:00'
+            written_var.calendar = DATE_CALENDAR
+
+            for dim in (y_dim, x_dim):
+                coord_var = nc.createVariable(dim, 'f8', (dim,))
+                coord_var[:] = dd_slice[dim].values
+                coord_var.setncatts(dd_slice[dim].attrs)
+
+            data_attrs = dict(dd_slice.attrs)
+            data_attrs['coordinates'] = 'date_written'
+            if 'spatial_ref' in dd_slice.coords:
+                crs_var = nc.createVariable('spatial_ref', 'i8')
+                crs_var.setncatts(dd_slice['spatial_ref'].attrs)
+                crs_var.assignValue(0)
+                data_attrs['coordinates'] = 'spatial_ref date_written'
+                data_attrs['grid_mapping'] = 'spatial_ref'
+
+            # keep float32 slices float32 on disk
+            data_dtype = dd_slice.dtype if dd_slice.dtype.kind == 'f' else np.dtype('f8')
+            data_var = nc.createVariable(
+                DATA_VAR, data_dtype, ('date', y_dim, x_dim),
+                fill_value = np.nan,
+                chunksizes = (
+                    self.chunk_dates,
+                    min(self.tile or dd_slice.sizes[y_dim], dd_slice.sizes[y_dim]),
+                    min(self.tile or dd_slice.sizes[x_dim], dd_slice.sizes[x_dim])),
+                zlib = self.zlib,
+            )
+            data_var.setncatts(data_attrs)
+
+    def _as_slice(self, dd_array, date):
+        # accept (y, x) or (date = 1, y, x) arrays
+        if 'date' in dd_array.dims:
+            if date is None:
+                date = dd_array.date.values[0]
+            dd_array = dd_array.isel(date = 0)
+        elif date is None:
+            date = dd_array.date.values
+        drop_coords = [c for c in ('date', 'date_written') if c in dd_array.coords]
+        return dd_array.drop_vars(drop_coords), pd.Timestamp(date)
+
+    def is_appendable(self):
+        # False for cubes with a fixed date dimension (plain to_netcdf output)
+        if not self.exists():
+            return True
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return nc.dimensions['date'].isunlimited()
+
+    def _open_for_write(self):
+
+        nc = netCDF4.Dataset(self.path, mode = 'a')
+        if not nc.dimensions['date'].isunlimited():
+            nc.close()
+            raise ValueError(
+                f'{self.path} has a fixed date dimension (written by to_netcdf) and cannot be written in place; '
+                'rewrite it once with GddCubeStore(path).migrate().')
+        return nc
+
+    def migrate(self):
+        # rewrite a to_netcdf cube into this layout one slice at a time, then 
+        # rename it over the original; no-op for store cubes. Returns True if rewritten.
+        if self.is_appendable():
+            return False
+        tmp_file = f'{self.path}.{os.getpid()}.migrate.nc'
+        tmp_store = GddCubeStore(tmp_file, overwrite = True, zlib = self.zlib, chunk_dates = self.chunk_dates, tile = self.tile)
+        with xra.open_dataarray(self.path) as cube:
+            for i in range(cube.sizes['date']):
+                tmp_store.append(cube.isel(date = i).load())
+        with netCDF4.Dataset(tmp_file, mode = 'a') as nc:
+            # written before tracking: NaT, so the next patch checks PRISM against nothing
+            nc['date_written'][:] = np.nan
+        os.replace(tmp_file, self.path)
+        return True
+
+    def dates(self):
+        # read only the date index, never the data
+        if not self.exists():
+            return pd.DatetimeIndex([])
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return _decode_times(nc['date'])
+
+    def written_at(self):
+        # per-date write time from the index, NaT for cubes written before it was tracked
+        if not self.exists():
+            return pd.Series([], dtype = 'datetime64[ns]')
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            dates = _decode_times(nc['date'])
+            if 'date_written' in nc.variables:
+                written = _decode_times(nc['date_written'])
+            else:
+                written = pd.DatetimeIndex(np.full(len(dates), np.datetime64('NaT'), dtype = 'datetime64[ns]'))
+        return pd.Series(written, index = dates)
+
+    def _write_slice(self, nc, i, date, values):
+
+        nc['date'][i] = _encode_dates(nc['date'], [date])[0]
+        if 'date_written' in nc.variables:
+            nc['date_written'][i] = time.time()
+        nc[DATA_VAR][i, :, :] = values
+
+    def append(self, dd_array, date = None):
+        # write one date slice at the end of the cube
+        dd_slice, date = self._as_slice(dd_array, date)
+        if not self.exists():
+            self._create(dd_slice)
+
+        with self._open_for_write() as nc:
+            i = nc.dimensions['date'].size
+            self._write_slice(nc, i, date, dd_slice.values)
+
+    def write(self, dd_array, date = None):
+        # write one date slice in date order: overwrite it if the date exists,
+        # append it if it is the latest, otherwise insert it by shifting the
+        # later slices back one place. Assumes the cube is sorted by date.
+        # Appending and overwriting cost one slice; an insert rewrites every 
+        # later slice, O(n) on a multi-year cube, so backfill an old date range
+        # by rebuilding (build_gdd_cube) rather than date by date.
+        dd_slice, date = self._as_slice(dd_array, date)
+        if not self.exists():
+            self._create(dd_slice)
+
+        with self._open_for_write() as nc:
+            dates = _decode_times(nc['date'])
+            n = len(dates)
+            i = int(dates.searchsorted(date))
+            if i < n and dates[i] == date:
+                self._write_slice(nc, i, date, dd_slice.values)
+                return
+            for j in range(n - 1, i - 1, -1):
+                nc['date'][j + 1] = nc['date'][j]
+                if 'date_written' in nc.variables:
+                    nc['date_written'][j + 1] = nc['date_written'][j]
+                nc[DATA_VAR][j + 1, :, :] = nc[DATA_VAR][j, :, :]
+            self._write_slice(nc, i, date, dd_slice.values)
+
+    def write_block(self, start: int, dates, values: np.ndarray, template = None):
+        # write (dates, y, x) values at date positions start.. in one call, 
+        # overwriting or extending the cube; template lays out a new file
+        if not self.exists():
+            self._create(template)
+        with self._open_for_write() as nc:
+            stop = start + len(dates)
+            nc['date'][start:stop] = _encode_dates(nc['date'], dates)
+            if 'date_written' in nc.variables:
+                nc['date_written'][start:stop] = np.full(len(dates), time.time())
+            nc[DATA_VAR][start:stop, :, :] = values
+
+    def iter_slices(self, start = 0):
+        # yield (date, values) one slice at a time with bounded memory
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            dates = _decode_times(nc['date'])
+            for i in range(start, len(dates)):
+                yield dates[i], nc[DATA_VAR][i, :, :].filled(np.nan)
+
+    def read_slices(self, index: list):
+        # read the slices at the given date positions
+        with netCDF4.Dataset(self.path, mode = 'r') as nc:
+            return [nc[DATA_VAR][i, :, :].filled(np.nan) for i in index]
+
+    def open(self, chunks: dict = None):
+        # lazy view of the cube; use .load() to bring it into memory. With chunks
+        # (e.g. {'date': 32}) the view is dask-backed and reductions stream chunk by chunk
+        return xra.open_dataarray(self.path, chunks = chunks)
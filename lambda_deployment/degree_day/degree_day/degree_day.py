@@ -1,17 +1,22 @@
-from sympy import symbols, sin, Abs, pi, integrate, solve, lambdify
 import numpy as np
 import pandas as pd
 import xarray as xra
 import os
 import zipfile
-import urllib
 import shutil
 import sys
 import geopandas as gpd
 import rioxarray
 from datetime import datetime, timedelta
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 import yaml
+from . import single_sine
+from .cube_store import GddCubeStore
+from .cube_index import cumsum_path, index_is_current, sum_dates_from_index, update_cumsum_index
+from .download import PrismDownloader, get_default_downloader
+from .prism_io import load_prism_raster
+from .climatology import ClimatologyStore, DAYS as CLIMATOLOGY_DAYS, LEAP_DAY, day_index, pest_record
 
 
 class DegreeDayCalculator:
@@ -37,66 +42,27 @@ class DegreeDayCalculator:
             self._init_simple_avg()
 
     def _init_single_sine(self):
-        ### use sympy to create lambda functions for degday calcs
-        # initialize symbols
-        temp_min, temp_max, upp_thresh, low_thresh, t, l_bnd, u_bnd = symbols('temp_min temp_max upp_thresh low_thresh t l_bnd, u_bnd', real = True)
-
-        ## single sin method
-        # a sin curve with temp-range amplitude and 2-day period (2pi = 2)
-        amp = (temp_max - temp_min) / 2
-        sin_curve = amp * sin(2 * pi * t - (pi / 2)) + temp_min + amp
-        self.sin_curve_fxn = lambdify([temp_min, temp_max, t], sin_curve, 'numpy')
-
-        # definite integral wrt time t
-        sin_intgr = integrate(sin_curve, (t, l_bnd, u_bnd))
-
-        # values of t when sin(t) intersects lower threshold
-        low_thresh_intersect = solve(sin_curve - low_thresh, t) 
-
-        # values of t when sin(t) intersects upper threshold
-        upp_thresh_intersect = solve(sin_curve - upp_thresh, t) 
-
-        # integral of sin between intersections with lower threshold
-        sin_low_intersect_intgr = (Abs(sin_intgr
-                                    .subs(l_bnd, low_thresh_intersect[0])
-                                    .subs(u_bnd, low_thresh_intersect[1])))
-
-        # integral of sin between intersections with upper threshold
-        sin_upp_intersect_intgr = (Abs(sin_intgr
-                                    .subs(l_bnd, upp_thresh_intersect[0])
-                                    .subs(u_bnd, upp_thresh_intersect[1])))
-
-        # area of rectangle below lower threshold and between intersections low_thresh with sin
-        low_intersect_rect = low_thresh * Abs(low_thresh_intersect[0] - low_thresh_intersect[1])
-
-        # area of rectangle below upper threshold and between intersections of upp_thresh with sin
-        upp_intersect_rect = upp_thresh * Abs(upp_thresh_intersect[0] - upp_thresh_intersect[1])
+        ### closed-form kernels, see single_sine.derive_sympy_kernels for the derivation
+        self.sin_curve_fxn = single_sine.sin_curve
 
         # The cases
         # 1. upper threshold below temp_min 
-        dd_case1_exp = upp_thresh - low_thresh
-        self.dd_case1_fxn = lambdify([low_thresh, upp_thresh], dd_case1_exp, 'numpy')
+        self.dd_case1_fxn = single_sine.case1
 
         # 2. lower threshold above temp_max
         # dd = 0 hardcode
 
         # 3. upper threshold above temp_max, lower threshold below temp_min
-        dd_case3_exp = sin_intgr.subs(l_bnd, 0).subs(u_bnd, 1) - low_thresh
-        self.dd_case3_fxn = lambdify([temp_min, temp_max, low_thresh], dd_case3_exp, "numpy")
+        self.dd_case3_fxn = single_sine.case3
 
         # 4. upper threshold above temp_max, lower threshold above temp_min
-        dd_case4_exp = sin_low_intersect_intgr - low_intersect_rect
-        self.dd_case4_fxn = lambdify([temp_min, temp_max, low_thresh], dd_case4_exp, 'numpy')
+        self.dd_case4_fxn = single_sine.case4
 
         # 5. upper threshold below temp_max, lower threshold below temp_min
-        dd_case5_exp = dd_case3_exp - sin_upp_intersect_intgr + upp_intersect_rect
-        self.dd_case5_fxn = lambdify([temp_min, temp_max, low_thresh, upp_thresh], dd_case5_exp, 'numpy')
-
-        # 6. upper threshold above temp_max, lower threshold above temp_min
-        dd_case6_exp = dd_case4_exp - sin_upp_intersect_intgr + upp_intersect_rect
-        self.dd_case6_fxn = lambdify([temp_min, temp_max, low_thresh, upp_thresh], dd_case6_exp, 'numpy')
+        self.dd_case5_fxn = single_sine.case5
 
-        del temp_min, temp_max, upp_thresh, low_thresh, t, l_bnd, u_bnd
+        # 6. upper threshold below temp_max, lower threshold above temp_min
+        self.dd_case6_fxn = single_sine.case6
     
     def _init_simple_avg(self):
         
@@ -148,30 +114,205 @@ class DegreeDayCalculator:
         else:
             return tavg - self.lt
 
-    def get_degree_days_raster(self, tmin_array, tmax_array):
-
-        # Initialize an empty array to store the result
-        result_array = np.empty_like(tmin_array.values)
-        # Loop over each cell of the grid and apply the custom function
-        for i in range(result_array.shape[0]):
-            for j in range(result_array.shape[1]):
-                tmin = tmin_array.values[i, j]
-                tmax = tmax_array.values[i, j]
-                dd = self.get_degree_days(tmin, tmax) 
-                result_array[i, j] = dd
-       
+    def get_degree_days_array(self, tmin, tmax, out = None):
+        # vectorized counterpart of get_degree_days for numpy arrays of any shape;
+        # out is an optional preallocated (or memory-mapped) array to fill
+        dtype = _float_dtype(tmin, tmax)
+        tmin, tmax = np.broadcast_arrays(np.asarray(tmin, dtype = dtype), np.asarray(tmax, dtype = dtype))
+        result = np.empty(tmin.shape, dtype = dtype) if out is None else out
+        n_bad = self._fill_degree_days(tmin, tmax, result)
+        self._warn_invalid(n_bad)
+
+        return result
+
+    def _warn_invalid(self, n_bad):
+
+        if self.lt >= self.ut: 
+            print("warning: lower threshold not less than upper threshold. returning nan.")
+        elif n_bad > 0:
+            print(f"warning: tmin not less than tmax in {n_bad} cells. returning nan for those cells.")
+
+    def _fill_degree_days(self, tmin, tmax, result):
+        # fills result in place, returns the number of cells with tmin >= tmax
+        result[...] = np.nan
+        if self.lt >= self.ut: 
+            return 0
+
+        # nan cells (nodata) fail every comparison and stay nan
+        valid = tmin < tmax
+        n_bad = np.count_nonzero(tmin >= tmax)
+
+        if self.method == "single_sine":
+            self._get_ss_dd_array(tmin, tmax, valid, result)
+        elif self.method == "simple_avg":
+            tavg = (tmin[valid] + tmax[valid]) / 2
+            result[valid] = self._get_sa_dd_array(tavg)
+        else: 
+            print('Degree day method not yet implemented. Using single sine.')
+            self._get_ss_dd_array(tmin, tmax, valid, result)
+
+        return n_bad
+
+    def _get_ss_dd_array(self, tmin, tmax, valid, result): # single sine, fills result in place
+
+        case1 = valid & (self.ut <= tmin)
+        case2 = valid & ~case1 & (self.lt >= tmax)
+        rest = valid & ~case1 & ~case2
+        upp_above = self.ut >= tmax
+        case3 = rest & upp_above & (self.lt <= tmin)
+        case4 = rest & upp_above & (self.lt > tmin)
+        case5 = rest & ~upp_above & (self.lt < tmin)
+        case6 = rest & ~upp_above & (self.lt >= tmin)
+
+        result[case1] = self.ut - self.lt
+        result[case2] = 0
+        result[case3] = self.dd_case3_fxn(tmin[case3], tmax[case3], self.lt)
+        result[case4] = self.dd_case4_fxn(tmin[case4], tmax[case4], self.lt)
+        result[case5] = self.dd_case5_fxn(tmin[case5], tmax[case5], self.lt, self.ut)
+        result[case6] = self.dd_case6_fxn(tmin[case6], tmax[case6], self.lt, self.ut)
+
+        return result
+
+    def _get_sa_dd_array(self, tavg): # simple average
+
+        return np.clip(tavg, self.lt, self.ut) - self.lt
+
+    def get_degree_days_raster(
+        self, 
+        tmin_array, 
+        tmax_array, 
+        tile_size: int = None, # evaluate in tile_size x tile_size spatial blocks
+        n_threads: int = 1, # threads for tiles
+        out: np.ndarray = None, # preallocated or memory-mapped output, shape of tmin_array
+    ):
+
+        if tile_size is None: 
+            result_array = self.get_degree_days_array(tmin_array.values, tmax_array.values, out = out)
+        else: 
+            result_array = np.empty(tmin_array.shape, dtype = _float_dtype(tmin_array, tmax_array)) if out is None else out
+            n_bad = _run_tiled(self._fill_degree_days, tmin_array, tmax_array, result_array, tile_size, n_threads)
+            self._warn_invalid(n_bad)
         result_xra = xra.DataArray(result_array, dims=tmin_array.dims, coords=tmin_array.coords)
 
         return result_xra
 
+def _float_dtype(*arrays):
+    # float32 inputs stay float32 end to end, anything else is promoted to at least float32
+    dtypes = [a.dtype if hasattr(a, 'dtype') else np.asarray(a).dtype for a in arrays]
+    return np.result_type(*dtypes, np.float32)
+
+def _spatial_tiles(shape, tile_size):
+    # (y, x) slice pairs covering the last two dimensions of shape
+    n_y, n_x = shape[-2:]
+    for y0 in range(0, n_y, tile_size):
+        for x0 in range(0, n_x, tile_size):
+            yield slice(y0, min(y0 + tile_size, n_y)), slice(x0, min(x0 + tile_size, n_x))
+
+def _run_tiled(fill_fxn, tmin_array, tmax_array, out, tile_size, n_threads = 1):
+    # fill_fxn(tmin, tmax, out_block) fills one block in place and returns its 
+    # count of tmin >= tmax cells. Only one tile of input is read at a time, so
+    # peak memory is set by tile_size rather than the extent.
+    y_dim, x_dim = tmin_array.dims[-2:]
+    dtype = _float_dtype(tmin_array, tmax_array)
+
+    def run_tile(tile):
+        ys, xs = tile
+        tmin = np.asarray(tmin_array.isel({y_dim: ys, x_dim: xs}).values, dtype = dtype)
+        tmax = np.asarray(tmax_array.isel({y_dim: ys, x_dim: xs}).values, dtype = dtype)
+        return fill_fxn(tmin, tmax, out[..., ys, xs])
+
+    tiles = _spatial_tiles(tmin_array.shape, tile_size)
+    if n_threads <= 1: 
+        return sum(run_tile(tile) for tile in tiles)
+    # numpy releases the GIL in the heavy ufuncs, so tiles overlap on threads
+    with ThreadPoolExecutor(max_workers = n_threads) as pool:
+        return sum(pool.map(run_tile, tiles))
+
+def _fill_degree_days_multi(tmin, tmax, pest_params, pest_list, result):
+    # fills result (pest, ...) in place, returns the number of cells with tmin >= tmax
+    result[...] = np.nan
+    valid = tmin < tmax
+    n_bad = np.count_nonzero(tmin >= tmax)
+    tmin_valid = tmin[valid]
+    tmax_valid = tmax[valid]
+    mean, amp = single_sine.sine_params(tmin_valid, tmax_valid)
+    area_cache = {}
+
+    for i, pest in enumerate(pest_list):
+        lt = pest_params[pest]['lt']
+        ut = pest_params[pest]['ut']
+        method = pest_params[pest].get('method', 'single_sine')
+        if lt >= ut: 
+            continue
+        if method == 'single_sine':
+            result[i][valid] = single_sine.degree_days(mean, amp, lt, ut, area_cache)
+        elif method == 'simple_avg':
+            result[i][valid] = np.clip(mean, lt, ut) - lt
+        else: 
+            raise ValueError(f'{method} is not an available degree day method.')
+
+    return n_bad
+
+def get_degree_days_raster_multi(
+    tmin_array: xra.DataArray, 
+    tmax_array: xra.DataArray, 
+    pest_params: dict, # {pest: {'lt': ..., 'ut': ..., 'method': ...}} or a DataFrame indexed by pest
+    pest_list: list = None, 
+    tile_size: int = None, # evaluate in tile_size x tile_size spatial blocks
+    n_threads: int = 1, # threads for tiles
+    out: np.ndarray = None, # preallocated or memory-mapped output, shape (pest,) + tmin_array.shape
+):
+    # evaluate many pests on one pair of tmin / tmax rasters, sharing the 
+    # sine mean, amplitude and per-threshold areas across pests
+    if isinstance(pest_params, pd.DataFrame):
+        pest_params = pest_params.to_dict('index')
+    if pest_list is None:
+        pest_list = list(pest_params.keys())
+    if not isinstance(pest_list, list): pest_list = [pest_list]
+
+    for pest in pest_list:
+        if pest_params[pest]['lt'] >= pest_params[pest]['ut']: 
+            print(f"warning: lower threshold not less than upper threshold for {pest}. returning nan.")
+
+    dtype = _float_dtype(tmin_array, tmax_array)
+    result_array = np.empty((len(pest_list),) + tmin_array.shape, dtype = dtype) if out is None else out
+
+    def fill_fxn(tmin, tmax, result):
+        return _fill_degree_days_multi(tmin, tmax, pest_params, pest_list, result)
+
+    if tile_size is None: 
+        tmin, tmax = np.broadcast_arrays(np.asarray(tmin_array.values, dtype = dtype), np.asarray(tmax_array.values, dtype = dtype))
+        n_bad = fill_fxn(tmin, tmax, result_array)
+    else: 
+        n_bad = _run_tiled(fill_fxn, tmin_array, tmax_array, result_array, tile_size, n_threads)
+    if n_bad > 0:
+        print(f"warning: tmin not less than tmax in {n_bad} cells. returning nan for those cells.")
+
+    result_xra = xra.DataArray(
+        result_array, 
+        dims = ('pest',) + tmin_array.dims, 
+        coords = {**tmin_array.coords, 'pest': pest_list},
+    )
+
+    return result_xra
+
 def pull_PRISM_data(
     target_date: str, # e.g., '20240101'
     var_list: list, 
     prism_dir: str, 
     resolution: str = '800m', 
-    overwrite: bool = False):
+    overwrite: bool = False,
+    downloader: PrismDownloader = None,
+    extract: bool = False, # loaders read inside the zip, extraction is optional
+    base_url: str = None): # defaults to PRISM's service for the resolution
         
+    if downloader is None:
+        downloader = get_default_downloader()
+    if base_url is None and resolution == '800m':
+        base_url = 'https://services.nacse.org/prism/data/800m'
+
     # loop through climate variables 
+    jobs = []
     for var in var_list:
         print(f" Processing {var} Data")
 
@@ -182,27 +323,24 @@ def pull_PRISM_data(
             print(f'  Zip file for {var} on day = {target_date} already exists! Skipping download')
             continue
 
-        # if os.path.exists(var_dir):
-        #     if (overwrite == True):  
-        #         shutil.rmtree(var_dir)
-        #     else: 
-        #         print("var_dir already exists! Specify overwrite argument = True.")
-        #         sys.exit(1)
         os.makedirs(var_dir, exist_ok=True)
-
-        # download data
-        print('downloading prism data')
-        if resolution == '800m': 
-            base_url = 'https://services.nacse.org/prism/data/800m'
+        if base_url is not None: 
             url =f'{base_url}/{var}/{target_date}'
-            urllib.request.urlretrieve(url, var_file)
-            if not zipfile.is_zipfile(var_file):
-               print('Data not found! Or too many downloads!') 
-               return False
-
-        # unzip data
-        with zipfile.ZipFile(var_file, 'r') as zip_ref:
-            zip_ref.extractall(var_dir)
+            jobs.append({'url': url, 'dest_file': var_file, 'var': var, 'date': target_date})
+
+    # download data, all variables at once
+    print('downloading prism data')
+    results = downloader.fetch_many(jobs)
+    if not all(results):
+        print('Data not found! Or too many downloads!') 
+        downloader.write_manifest()
+        return False
+
+    # unzip data
+    if extract:
+        for job in jobs:
+            with zipfile.ZipFile(job['dest_file'], 'r') as zip_ref:
+                zip_ref.extractall(os.path.dirname(job['dest_file']))
         
     return True
 
@@ -211,9 +349,15 @@ def pull_PRISM_data_normals(
     var_list: list, 
     prism_dir: str, 
     resolution: str = '800m', 
-    overwrite: bool = False):
+    overwrite: bool = False,
+    downloader: PrismDownloader = None,
+    extract: bool = False): # loaders read inside the zip, extraction is optional
         
+    if downloader is None:
+        downloader = get_default_downloader()
+
     # loop through climate variables 
+    jobs = []
     for var in var_list:
         print(f" Processing {var} Data")
         var_dir = os.path.join(prism_dir, target_day, var)
@@ -223,29 +367,94 @@ def pull_PRISM_data_normals(
             print(f'Zip file for {var} on day = {target_day} already exists! Skipping download')
             continue
 
-        if os.path.exists(var_dir):
-            if (overwrite == True):  
-                shutil.rmtree(var_dir)
-            else: 
-                print("var_dir already exists! Specify overwrite argument = True.")
-                return False
+        if os.path.exists(var_dir) and (overwrite == True):
+            shutil.rmtree(var_dir)
+        # a var_dir without its zip is left by a failed pull, so it is retried
         os.makedirs(var_dir, exist_ok=True)
 
-        # download data
         if resolution == '800m': 
             base_url = 'https://services.nacse.org/prism/data/public/normals/800m'
             url =f'{base_url}/{var}/{target_day}'
-            urllib.request.urlretrieve(url, var_file)
-            if not zipfile.is_zipfile(var_file):
-               print('Data not found! Or too many downloads!') 
-               return False
-
-        # unzip data
-        with zipfile.ZipFile(var_file, 'r') as zip_ref:
-            zip_ref.extractall(var_dir)
+            jobs.append({'url': url, 'dest_file': var_file, 'var': var, 'date': target_day})
+
+    # download data, all variables at once
+    results = downloader.fetch_many(jobs)
+    if not all(results):
+        print('Data not found! Or too many downloads!') 
+        downloader.write_manifest()
+        return False
+
+    # unzip data
+    if extract:
+        for job in jobs:
+            with zipfile.ZipFile(job['dest_file'], 'r') as zip_ref:
+                zip_ref.extractall(os.path.dirname(job['dest_file']))
         
     return True
     
+def _pull_day(target_date_raw, prism_dir, resolution):
+
+    target_date = datetime.strftime(target_date_raw, '%Y%m%d')
+    print(f'Pulling data for {target_date}')
+    pull_succeeded = pull_PRISM_data(
+        target_date, ['tmin', 'tmax'], prism_dir, 
+        overwrite = False, resolution = resolution
+        ) 
+    print(f'PRISM Pull Succeeeded: {pull_succeeded}')
+    if pull_succeeded == False: 
+        print(f'!Failed to pull data for {target_date}')
+    return pull_succeeded
+
+def _load_prism_day(target_date, prism_dir, bbox):
+    # prep tmin and tmax
+    prism_dict = {} 
+    for var in ['tmin', 'tmax']:
+        # load var
+        var_dir = os.path.join(prism_dir, target_date, var)
+        prism_dict[var] = load_prism_raster(var_dir, f'{target_date}_{var}.zip', f'prism_{var}_us_30s_{target_date}.bil', bbox.geometry)
+    return prism_dict
+
+def _compute_gdd_day(args):
+    # clip and compute one date for all pests; top level so a process pool can pickle it
+    target_date_raw, prism_dir, bbox, pest_params, pest_list = args
+    target_date = datetime.strftime(target_date_raw, '%Y%m%d')
+    prism_dict = _load_prism_day(target_date, prism_dir, bbox)
+    print(f'Calculating GDD rasters for {len(pest_list)} pests on {target_date}')
+    dd_stack = get_degree_days_raster_multi(prism_dict['tmin'], prism_dict['tmax'], pest_params, pest_list)
+    return target_date_raw, dd_stack
+
+def _iter_gdd_days(
+    date_list: list, 
+    prism_dir: str, 
+    bbox: gpd.GeoDataFrame, 
+    pest_params: dict, 
+    pest_list: list, 
+    resolution: str = '800m', 
+    parallel: bool = False, 
+    n_workers: int = None, # processes for clip / compute, defaults to cpu count
+    n_download_workers: int = 4, # threads for PRISM downloads
+):
+    # yields (date, dd_stack) in date order, skipping dates that failed to pull
+    if not parallel: 
+        for target_date_raw in date_list: 
+            if not _pull_day(target_date_raw, prism_dir, resolution): 
+                continue
+            yield _compute_gdd_day((target_date_raw, prism_dir, bbox, pest_params, pest_list))
+        return
+
+    # downloads are I/O bound, so run them on threads and hand each finished
+    # date to the process pool as soon as it (and every earlier date) is ready
+    with ThreadPoolExecutor(max_workers = n_download_workers) as download_pool, Pool(n_workers) as compute_pool:
+        pull_futures = [download_pool.submit(_pull_day, d, prism_dir, resolution) for d in date_list]
+
+        def pulled_tasks():
+            for target_date_raw, pull_future in zip(date_list, pull_futures):
+                if pull_future.result():
+                    yield target_date_raw, prism_dir, bbox, pest_params, pest_list
+
+        # imap keeps input order, so the caller can write slices in date order
+        yield from compute_pool.imap(_compute_gdd_day, pulled_tasks())
+
 def build_gdd_cube(
     prism_dir: str, 
     bbox_file: str,
@@ -255,6 +464,10 @@ def build_gdd_cube(
     end_date: datetime = None,
     cube_out: str = None,
     resolution: str = '800m', 
+    return_cube: bool = True, # set False with cube_out to stream to disk without holding the cube
+    parallel: bool = False,
+    n_workers: int = None,
+    build_index: bool = False, # keep a cumsum index next to cube_out
 ):
 
     if date_list is None:
@@ -267,52 +480,46 @@ def build_gdd_cube(
             print('Date list provided by user. Ignoring start and end dates!')
         
     bbox = gpd.read_file(bbox_file)
+    cube_store = None
+    if cube_out is not None:
+        cube_store = GddCubeStore(cube_out, overwrite = True)
     
     # loop through dates
-    dd_cube = None
-    for target_date_raw in date_list: 
+    dd_slices = []
+    gdd_days = _iter_gdd_days(
+        date_list, prism_dir, bbox, {'pest': pest_params}, ['pest'], 
+        resolution = resolution, parallel = parallel, n_workers = n_workers)
+    for target_date_raw, dd_stack in gdd_days: 
 
-        target_date = datetime.strftime(target_date_raw, '%Y%m%d')
-        print(f'Pulling data for {target_date}')
-        pull_succeeded = pull_PRISM_data(
-            target_date, ['tmin', 'tmax'], prism_dir, 
-            overwrite = False, resolution = resolution
-            ) 
-        print(f'PRISM Pull Succeeeded: {pull_succeeded}')
-        if pull_succeeded == False: 
-            print(f'!Failed to pull data for {target_date}')
-            continue
-        # prep tmin and tmax
-        prism_dict = {} 
-        for var in ['tmin', 'tmax']:
-            # load var
-            var_dir = os.path.join(prism_dir, target_date, var)
-            raw_raster = rioxarray.open_rasterio(os.path.join(var_dir, f'prism_{var}_us_30s_{target_date}.bil'))
-            or_raster = raw_raster.rio.clip(bbox.geometry, drop = True)
-            or_raster = or_raster.where(or_raster != -9999)
-            prism_dict[var] = or_raster.drop_vars('band').squeeze()
-            del raw_raster, or_raster
-        
-        # loop pests and get gdds
-        ss_calculator = DegreeDayCalculator(
-            lower_threshold = pest_params['lt'], 
-            upper_threshold = pest_params['ut'],
-            method = pest_params['method']) 
-        dd_array = ss_calculator.get_degree_days_raster(prism_dict['tmin'], prism_dict['tmax'])
+        dd_array = dd_stack.sel(pest = 'pest', drop = True)
         dd_array = dd_array.assign_coords(date=target_date_raw).expand_dims(date = 1)
 
-        if dd_cube is None: 
-            dd_cube = dd_array.copy()
-        else: 
-            dd_cube = xra.concat([dd_cube, dd_array], dim='date')
+        if cube_store is not None:  
+            cube_store.append(dd_array)
+            if build_index: 
+                update_cumsum_index(cube_out)
+        if return_cube:
+            dd_slices.append(dd_array)
 
-        if cube_out is not None:  
-            dd_cube.to_netcdf(cube_out)
+    if not return_cube or len(dd_slices) == 0:
+        return None
+    dd_cube = xra.concat(dd_slices, dim='date')
 
     return dd_cube 
 
+def _prism_updated_since(prism_dir, target_date_raw, written_at):
+    # True if the day's PRISM zips changed after the cube slice was written
+    if pd.isnull(written_at):
+        return False
+    target_date = datetime.strftime(target_date_raw, '%Y%m%d')
+    for var in ['tmin', 'tmax']:
+        var_file = os.path.join(prism_dir, target_date, var, f'{target_date}_{var}.zip')
+        if os.path.exists(var_file) and pd.Timestamp(os.path.getmtime(var_file), unit = 's') > written_at:
+            return True
+    return False
+
 def patch_gdd_cube(
-   cube: xra.DataArray, 
+   cube: xra.DataArray, # or a path to an on-disk cube to patch incrementally in place
    pest_params: dict,
    prism_dir: str, 
    bbox_file: str, 
@@ -321,6 +528,8 @@ def patch_gdd_cube(
    date_list: list = None, 
    overwrite: bool = False, 
    cube_out_file: str = None, 
+   parallel: bool = False,
+   n_workers: int = None,
 ):
     
     # get patch date list
@@ -335,6 +544,41 @@ def patch_gdd_cube(
     patch_date_set = set(date_list)
     patch_date_list = sorted(list(patch_date_set))
 
+    if isinstance(cube, str): 
+        # incremental mode: read only the cube's date index, compute missing or 
+        # stale dates (all patch dates with overwrite) and write them in place
+        cube_store = GddCubeStore(cube)
+        if cube_store.migrate():
+            # cubes written by to_netcdf have a fixed date dimension, rewritten once
+            print(f'Migrated {cube} to an appendable cube')
+        written_at = cube_store.written_at()
+        if overwrite: 
+            todo_date_list = patch_date_list
+        else: 
+            todo_date_list = [
+                d for d in patch_date_list 
+                if (d not in written_at.index) or _prism_updated_since(prism_dir, d, written_at[d])
+            ]
+        print(f'Patching {len(todo_date_list)} of {len(patch_date_list)} dates in {cube}')
+
+        bbox = gpd.read_file(bbox_file)
+        gdd_days = _iter_gdd_days(
+            todo_date_list, prism_dir, bbox, {'pest': pest_params}, ['pest'], 
+            parallel = parallel, n_workers = n_workers)
+        patched_date_list = []
+        for target_date_raw, dd_stack in gdd_days: 
+            cube_store.write(dd_stack.sel(pest = 'pest', drop = True), date = target_date_raw)
+            patched_date_list.append(target_date_raw)
+
+        # keep an existing cumsum index in step with the patched cube
+        if os.path.exists(cumsum_path(cube)): 
+            update_cumsum_index(cube)
+
+        return patched_date_list
+
+    # date_written belongs to an on-disk store's slices, new slices do not carry it
+    cube = cube.drop_vars('date_written', errors = 'ignore')
+
     # get cube dates
     cube_date_set = set(pd.to_datetime(cube.date.values))
     cube_date_list = sorted(list(cube_date_set))
@@ -396,6 +640,8 @@ def create_gdd_cube(
     resolution: str = '800m', 
     overwrite: bool = False,
     parallel: bool = False,
+    n_workers: int = None,
+    build_index: bool = False, # keep a cumsum index next to each pest's cube
 ):
 
     date_delta = (end_date - start_date).days
@@ -408,54 +654,24 @@ def create_gdd_cube(
             print("gdd_dir already exists! Specify overwrite argument = True.")
             sys.exit(1)
     os.makedirs(gdd_dir)
+    if pest_list is None:
+        pest_list = list(pest_params.keys())
     
-    # loop through dates
-    for target_date_raw in date_list: 
+    # loop through dates, writing each date's slices as they arrive in date order
+    gdd_days = _iter_gdd_days(
+        date_list, prism_dir, bbox, pest_params, pest_list, 
+        resolution = resolution, parallel = parallel, n_workers = n_workers)
+    for target_date_raw, dd_stack in gdd_days: 
 
-        target_date = datetime.strftime(target_date_raw, '%Y%m%d')
-        print(f'Pulling data for {target_date}')
-        pull_succeeded = pull_PRISM_data(
-            target_date, ['tmin', 'tmax'], prism_dir, 
-            overwrite = False, resolution = resolution
-            ) 
-        print(f'PRISM Pull Succeeeded: {pull_succeeded}')
-        if pull_succeeded == False: 
-            print(f'!Failed to pull data for {target_date}')
-            continue
-        # prep tmin and tmax
-        prism_dict = {} 
-        for var in ['tmin', 'tmax']:
-            # load var
-            var_dir = os.path.join(prism_dir, target_date, var)
-            raw_raster = rioxarray.open_rasterio(os.path.join(var_dir, f'prism_{var}_us_30s_{target_date}.bil'))
-            or_raster = raw_raster.rio.clip(bbox.geometry, drop = True)
-            or_raster = or_raster.where(or_raster != -9999)
-            prism_dict[var] = or_raster.drop_vars('band').squeeze()
-            del raw_raster, or_raster
-        
-        # loop pests and get gdds
-        if pest_list is None:
-            pest_list = list(pest_params.keys())
         for pest in pest_list:
 
-            print(f'Calculating GDD raster for {pest}')
-            ss_calculator = DegreeDayCalculator(
-                lower_threshold = pest_params[pest]['lt'], 
-                upper_threshold = pest_params[pest]['ut'],
-                method = pest_params[pest]['method']) 
-            dd_array = ss_calculator.get_degree_days_raster(prism_dict['tmin'], prism_dict['tmax'])
+            dd_array = dd_stack.sel(pest = pest, drop = True)
             dd_array = dd_array.assign_coords(date=target_date_raw).expand_dims(date = 1)
-            # dd_dataset = dd_array.to_dataset(name = target_date)
 
             cube_file = os.path.join(gdd_dir, f'gdd_cube_{pest}.nc')
-            write_mode = 'w'
-            if not os.path.isfile(cube_file): 
-                # write_mode = 'a' # append in place 
-                dd_array.to_netcdf(cube_file, mode = write_mode)
-            else: 
-                dd_base = xra.load_dataarray(cube_file)
-                dd_array = xra.concat([dd_base, dd_array], dim='date')
-                dd_array.to_netcdf(cube_file, mode = write_mode)
+            GddCubeStore(cube_file).append(dd_array)
+            if build_index: 
+                update_cumsum_index(cube_file)
 
     return True
             
@@ -471,6 +687,7 @@ def create_gdd_cube_normals( # for daily normals
     overwrite: bool = False,
     agg_to_layer: bool = False,
     layer_file_ext: str = 'nc', 
+    climatology_file: str = None, # read from (building it once if needed) a ClimatologyStore instead of pulling PRISM
 ):
 
     date_delta = (end_date - start_date).days
@@ -483,6 +700,11 @@ def create_gdd_cube_normals( # for daily normals
             print("gdd_dir already exists! Specify overwrite argument = True.")
             sys.exit(1)
     os.makedirs(os.path.join(gdd_dir, 'cubes'))
+
+    if climatology_file is not None:
+        store = build_climatology_store(climatology_file, prism_dir, bbox_file, pest_params, pest_list, resolution)
+        _write_normals_from_store(store, date_list, gdd_dir, pest_list, agg_to_layer, layer_file_ext)
+        return
     
     # loop through dates
     for target_date_raw in date_list: 
@@ -499,40 +721,25 @@ def create_gdd_cube_normals( # for daily normals
             print(f'!Failed to pull data for {target_day}')
             continue
         # prep tmin and tmax
-        prism_dict = {} 
-        for var in ['tmin', 'tmax']:
-            # load var
-            var_dir = os.path.join(prism_dir, target_day, var)
-            raw_raster = rioxarray.open_rasterio(os.path.join(var_dir, f'PRISM_{var}_30yr_normal_800mD1_{target_day}_bil.bil'))
-            or_raster = raw_raster.rio.clip(bbox.geometry, drop = True)
-            or_raster = or_raster.where(or_raster != -9999)
-            prism_dict[var] = or_raster.drop_vars('band').squeeze()
-            del raw_raster, or_raster
+        prism_dict = _load_normals_day(target_day, prism_dir, bbox)
         
-        # loop pests and get gdds
+        # get gdds for all pests in one pass
         if pest_list is None:
             pest_list = list(pest_params.keys())
         if not isinstance(pest_list, list): pest_list = [pest_list]
+        print(f'Calculating GDD rasters for {len(pest_list)} pests')
+        dd_stack = get_degree_days_raster_multi(prism_dict['tmin'], prism_dict['tmax'], pest_params, pest_list)
         for pest in pest_list:
-            print(f'Calculating GDD raster for {pest}')
-            ss_calculator = DegreeDayCalculator(
-                lower_threshold = pest_params[pest]['lt'], 
-                upper_threshold = pest_params[pest]['ut'],
-                method = pest_params[pest]['method']) 
-            dd_array = ss_calculator.get_degree_days_raster(prism_dict['tmin'], prism_dict['tmax'])
+            dd_array = dd_stack.sel(pest = pest, drop = True)
             dd_array = dd_array.assign_coords(date=target_date_raw).expand_dims(date = 1)
             # dd_dataset = dd_array.to_dataset(name = target_day)
 
-            # concatenate and write to NetCDF
+            # append to NetCDF
             cube_file = os.path.join(gdd_dir, 'cubes', f'gdd_cube_normals_{pest}.nc')
-            write_mode = 'w'
-            if not os.path.isfile(cube_file): 
-                # write_mode = 'a' # append in place 
-                dd_array.to_netcdf(cube_file, mode = write_mode)
-            else: 
-                dd_base = xra.load_dataarray(cube_file)
-                dd_array = xra.concat([dd_base, dd_array], dim='date')
-                dd_array.to_netcdf(cube_file, mode = write_mode)
+            cube_store = GddCubeStore(cube_file)
+            cube_store.append(dd_array)
+            if agg_to_layer: 
+                update_cumsum_index(cube_file)
             
             if agg_to_layer:
 
@@ -557,54 +764,246 @@ def create_gdd_cube_normals( # for daily normals
                             os.remove(layer_file)
                         else: raise('Layer file already exists. Set overwrite = True')
                    
-                    exclude_days = None
+                    exclude_day = None
                     if not leap_ind: 
-                        exclude_days = ['02-29']
-                        print(f'Excluding {exclude_days} from aggregation')
-                    dd_layer = aggregate_cube_by_date(
-                        cube = dd_array, 
-                        start_day = pest_params[pest]['start_date'], 
-                        end_day = str(target_date_raw.month) + '-' + str(target_date_raw.day), 
-                        exclude_days = exclude_days
-                    )
+                        exclude_day = '02-29'
+                        print(f'Excluding {exclude_day} from aggregation')
+                    with cube_store.open() as cube:
+                        dd_layer = aggregate_cube_by_date(
+                            cube = cube, 
+                            start_day = pest_params[pest]['start_date'], 
+                            end_day = str(target_date_raw.month) + '-' + str(target_date_raw.day), 
+                            exclude_day = exclude_day
+                        ).load()
 
                     if layer_file_ext == 'nc': 
                         dd_layer.to_netcdf(layer_file)
                     else: raise('File extension not supported! NetCDF only right now.')
 
+def _load_normals_day(target_day, prism_dir, bbox):
+
+    prism_dict = {}
+    for var in ['tmin', 'tmax']:
+        var_dir = os.path.join(prism_dir, target_day, var)
+        prism_dict[var] = load_prism_raster(var_dir, f'{target_day}_{var}.zip', f'PRISM_{var}_30yr_normal_800mD1_{target_day}_bil.bil', bbox.geometry)
+    return prism_dict
+
+def build_climatology_store(
+    store_file: str, 
+    prism_dir: str, 
+    bbox_file: str, 
+    pest_params: dict, 
+    pest_list: list = None, 
+    resolution: str = '800m', 
+    block_days: int = 16, # days clipped, computed and written at a time
+    downloader: PrismDownloader = None,
+):
+    # one-time setup of a region's ClimatologyStore: pull and clip the 366 daily
+    # normals (skipped once stored), then compute daily and cumulative normal GDD
+    # for the pests that are missing or whose parameters changed, from the stored
+    # normals. Returns the store.
+    if isinstance(pest_params, pd.DataFrame):
+        pest_params = pest_params.to_dict('index')
+    if pest_list is None:
+        pest_list = list(pest_params.keys())
+    if not isinstance(pest_list, list): pest_list = [pest_list]
+    store = ClimatologyStore(store_file, chunk_days = block_days)
+    n_days = len(CLIMATOLOGY_DAYS)
+
+    if not store.has_normals():
+        bbox = gpd.read_file(bbox_file)
+        for start in range(0, n_days, block_days):
+            block = {'tmin': [], 'tmax': []}
+            for target_day in CLIMATOLOGY_DAYS[start:start + block_days]:
+                print(f'Pulling normals for {target_day}')
+                if not pull_PRISM_data_normals(target_day, ['tmin', 'tmax'], prism_dir, resolution = resolution, downloader = downloader):
+                    raise RuntimeError(f'Failed to pull PRISM normals for {target_day}.')
+                prism_dict = _load_normals_day(target_day, prism_dir, bbox)
+                for var in block:
+                    block[var].append(prism_dict[var])
+            if start == 0:
+                store.create(block['tmin'][0])
+            for var, rasters in block.items():
+                store.write_normals(
+                    var, start, np.stack([r.values for r in rasters]).astype(np.float32),
+                    complete = (var == 'tmax') and (start + block_days >= n_days))
+
+    stored = store.pests()
+    todo = [pest for pest in pest_list if stored.get(pest) != pest_record(pest_params[pest])]
+    if len(todo) == 0:
+        return store
+    print(f'Calculating normal GDD for {len(todo)} pests')
+    positions = store.set_pests(pest_params, todo)
+    total = np.zeros((len(todo),) + store.template().shape)
+    for start in range(0, n_days, block_days):
+        tmin, tmax = store.read_normals(start, start + block_days)
+        gdd = np.empty((len(todo),) + tmin.shape, dtype = np.float32)
+        get_degree_days_raster_multi(xra.DataArray(tmin), xra.DataArray(tmax), pest_params, todo, out = gdd)
+        store.write_pest_block('gdd', positions, start, gdd)
+
+        # running total from Jan 1, nan (outside the region, lt >= ut) counts as 0
+        cumsum = total[:, None] + np.cumsum(np.nan_to_num(gdd, nan = 0.0), axis = 1, dtype = np.float64)
+        store.write_pest_block('gdd_cumsum', positions, start, cumsum)
+        total = cumsum[:, -1]
+    return store
+
+def climatology_degree_days(
+    store_file: str, 
+    lt: float, 
+    ut: float, 
+    method: str = 'single_sine', 
+    start_day: str = '01-01', 
+    end_day: str = '12-31', 
+    leap: bool = True, # False drops 02-29
+):
+    # ad-hoc normal daily GDD for any thresholds, from the normals in a
+    # ClimatologyStore (no download, no clipping); .sum('day') gives the layer
+    store = ClimatologyStore(store_file)
+    a, b = day_index(start_day), day_index(end_day)
+    tmin, tmax = store.read_normals(a, b + 1)
+    days = CLIMATOLOGY_DAYS[a:b + 1]
+    template = store.template()
+    dd_array = get_degree_days_raster_multi(
+        xra.DataArray(tmin), xra.DataArray(tmax), {'normal': {'lt': lt, 'ut': ut, 'method': method}}).values[0]
+    dd_array = xra.DataArray(
+        dd_array, dims = ('day',) + template.dims, 
+        coords = {**template.coords, 'day': days})
+    if not leap:
+        dd_array = dd_array.sel(day = [d for d in days if d != CLIMATOLOGY_DAYS[LEAP_DAY]])
+    return dd_array
+
+def _write_normals_from_store(store, date_list, gdd_dir, pest_list, agg_to_layer, layer_file_ext):
+    # create_gdd_cube_normals output (cubes, and layers with agg_to_layer) read
+    # straight from a ClimatologyStore. Layers sum from the later of the biofix
+    # and the first date, like aggregating the cube written so far.
+    if pest_list is None:
+        pest_list = list(store.pests().keys())
+    if not isinstance(pest_list, list): pest_list = [pest_list]
+    if layer_file_ext != 'nc': 
+        raise ValueError('File extension not supported! NetCDF only right now.')
+    template = store.template()
+    first_day = day_index(datetime.strftime(date_list[0], '%m%d'))
+    for pest in pest_list:
+        print(f'Writing normal GDD for {pest} from {store.path}')
+        cube_file = os.path.join(gdd_dir, 'cubes', f'gdd_cube_normals_{pest}.nc')
+        cube_store = GddCubeStore(cube_file)
+        for target_date_raw in date_list:
+            target_day = datetime.strftime(target_date_raw, '%m%d')
+            cube_store.append(template.copy(data = store.daily(pest, target_day)), date = target_date_raw)
+        if not agg_to_layer:
+            continue
+        update_cumsum_index(cube_file)
+
+        start_day = CLIMATOLOGY_DAYS[max(first_day, day_index(store.pests()[pest]['start_date']))]
+        for layer_kind, leap_ind, leap_char in zip(['leap_year', 'norm_year'], [True, False], ['leapyear_', '']):
+            layer_dir = os.path.join(gdd_dir, 'layers', pest, layer_kind)
+            os.makedirs(layer_dir, exist_ok = True)
+            for target_date_raw in date_list:
+                target_day = datetime.strftime(target_date_raw, '%m%d')
+                if (not leap_ind) & (target_day == '0229'): 
+                    continue # no leap day layer for normal years
+                dd_layer = (
+                    template.copy(data = store.layer(pest, target_day, leap_ind, start_day))
+                    .assign_coords(date = pd.Timestamp(target_date_raw).to_datetime64())
+                    .expand_dims(date = 1)
+                )
+                dd_layer.to_netcdf(os.path.join(layer_dir, f'gdd_normal_layer_{leap_char}{pest}_{target_day}.{layer_file_ext}'))
+
 def aggregate_cube_by_date(
     cube: xra.DataArray, 
-    exclude_day: str = None, # eg leap day: ['02-29']
+    exclude_day: str = None, # eg leap day: '02-29'
     start_day: str = '01-01', # must be in this format
     end_day: str = '12-31',
+    cumsum_index: str = None, # defaults to the cumsum index next to the cube's file, if current
+    year: int = None, # of the days above, defaults to the year of the cube's first date
 ): 
 
-    # get / use biofix date
+    # get / use biofix date, in the cube's own year
+    if year is None:
+        year = pd.Timestamp(cube.date.values.min()).year
     biofix_mon_day = [int(x) for x in start_day.split('-')]
-    biofix_date = pd.to_datetime(datetime(2024, biofix_mon_day[0], biofix_mon_day[1]))
+    biofix_date = pd.to_datetime(datetime(year, biofix_mon_day[0], biofix_mon_day[1]))
     end_mon_day = [int(x) for x in end_day.split('-')]
-    end_date = pd.to_datetime(datetime(2024, end_mon_day[0], end_mon_day[1]))
+    end_date = pd.to_datetime(datetime(year, end_mon_day[0], end_mon_day[1]))
+    exclude_date = None
     if exclude_day is not None: 
         exclude_mon_day = [int(x) for x in exclude_day.split('-')]
-        exclude_date = pd.to_datetime(datetime(2024, exclude_mon_day[0], exclude_mon_day[1]))
-    else: exclude_date = pd.to_datetime(datetime(2023, 1, 1)) 
+        try:
+            exclude_date = pd.to_datetime(datetime(year, exclude_mon_day[0], exclude_mon_day[1]))
+        except ValueError:
+            pass # 02-29 of a normal year, nothing to exclude
 
     # print(cube)
     max_date = cube.date.values.max()
+
+    # use the prefix-sum index when one matches this cube: two or four slice reads
+    cube_file = cube.encoding.get('source')
+    if (cumsum_index is None) and (cube_file is not None):
+        cumsum_index = cumsum_path(cube_file)
+    if (cumsum_index is not None) and (cube_file is not None) and index_is_current(cube_file, cumsum_index):
+        index_dates = GddCubeStore(cumsum_index).dates()
+        if np.array_equal(index_dates.values, pd.to_datetime(cube.date.values).values) and index_dates.is_monotonic_increasing:
+            slice_dims = [d for d in cube.dims if d != 'date']
+            slice_coords = {k: v for k, v in cube.coords.items() if ('date' not in v.dims) and (k not in ('date', 'date_written'))}
+            total = sum_dates_from_index(cumsum_index, biofix_date, end_date, exclude_date)
+            if total is None:
+                total = np.zeros([cube.sizes[d] for d in slice_dims])
+            dd_layer = (
+                xra.DataArray(total, dims = slice_dims, coords = slice_coords)
+                .assign_coords(date = max_date)
+                .expand_dims(date = 1)
+            )
+            return dd_layer
+
+    in_range = (cube.date >= biofix_date) & (cube.date <= end_date)
+    if exclude_date is not None:
+        in_range = in_range & (cube.date != exclude_date)
     dd_layer = (
-        cube.sel(date = (cube.date >= biofix_date) & (cube.date <= end_date) & (cube.date != exclude_date))
+        cube.sel(date = in_range)
         .sum(dim='date')
         .assign_coords(date = max_date)
         .expand_dims(date = 1)
     )
     return  dd_layer
 
+def open_gdd_cube(
+    cube_file: str, 
+    chunks: dict = None, # None follows the stored chunks, False opens without dask
+    min_dates: int = 32, # with chunks = None, dates per dask chunk at least
+):
+    # lazily open a cube, chunked along date (and optionally y / x) so that
+    # multi-year cubes never have to fit in memory; requires dask when chunked.
+    # By default each variable is opened on its own stored chunks (asking for
+    # other sizes splits them, and xarray warns on every open), then the cube
+    # is grouped into whole stored chunks of at least min_dates dates.
+    stored = chunks is None
+    if stored:
+        chunks = {}
+    elif chunks is False:
+        chunks = None
+    cube = GddCubeStore(cube_file).open(chunks = chunks)
+    if stored and (cube.chunks is not None) and (cube.sizes['date'] > 0):
+        stored_dates = cube.chunks[0][0]
+        if stored_dates < min_dates:
+            cube = cube.chunk({'date': -(-min_dates // stored_dates) * stored_dates})
+    return cube
+
 def aggregate_cube_to_timeseries(
-    cube: xra.DataArray
+    cube: xra.DataArray # or a path to an on-disk cube, which is streamed one slice at a time
 ):
 
-    gdd = cube.mean(dim=['x', 'y']).values
-    dates = cube.date.values
+    if isinstance(cube, str): 
+        dates = []
+        gdd = []
+        for date, values in GddCubeStore(cube).iter_slices(): 
+            dates.append(date)
+            gdd.append(np.nanmean(values) if not np.isnan(values).all() else np.nan)
+        dates = pd.DatetimeIndex(dates).values
+        gdd = np.array(gdd)
+    else: 
+        # dask-backed cubes only compute the small (date,) result here
+        gdd = cube.mean(dim=['x', 'y']).values
+        dates = cube.date.values
     df = (
         pd.DataFrame({'date': dates, 'gdd_mean': gdd})
         .assign(
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import atexit
+import random
+import zipfile
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+### shared PRISM download subsystem
+# PRISM throttles clients that pull too fast ("too many downloads") and answers
+# with a small text body instead of a zip, so every fetch goes through a shared
+# token bucket, is retried with exponential backoff, and is only accepted once
+# the body is a valid zip. Keep-alive connections are pooled per host and the
+# worker threads live as long as the downloader, so a warm process reuses both
+# across pulls; close() releases them. Anything that still fails is recorded
+# in a manifest so it can be re-queued, and dropped from it once it succeeds.
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PrismDownloader:
+    def __init__(
+        self,
+        max_workers: int = 4,
+        rate: float = 2.0, # requests per second across all threads
+        burst: int = 4,
+        max_retries: int = 4,
+        backoff: float = 1.0, # seconds, doubled on each retry
+        timeout: float = 60,
+        manifest_file: str = None,
+    ):
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.manifest_file = manifest_file
+        self.failed = [] # [{'var': ..., 'date': ..., 'url': ..., 'error': ...}]
+        self._failed_lock = threading.Lock()
+        self._idle = {} # (scheme, host) -> idle keep-alive connections
+        self._pool_lock = threading.Lock()
+        self._executor = None
+
+    def _get_connection(self, scheme, host):
+        # an idle keep-alive connection to host, or a new one
+        with self._pool_lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop()
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(host, timeout = self.timeout)
+
+    def _release_connection(self, scheme, host, conn):
+
+        with self._pool_lock:
+            self._idle.setdefault((scheme, host), []).append(conn)
+
+    def _request(self, url, dest_file, max_redirects = 5):
+        # stream one GET to dest_file, following redirects
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            conn = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path or '/')
+                response = conn.getresponse()
+                if response.status in (301, 302, 303, 307, 308):
+                    response.read()
+                    url = urljoin(url, response.getheader('Location'))
+                    self._release_connection(parts.scheme, parts.netloc, conn)
+                    continue
+                if response.status != 200:
+                    response.read()
+                    self._release_connection(parts.scheme, parts.netloc, conn)
+                    raise IOError(f'HTTP {response.status} for {url}')
+                with open(dest_file, 'wb') as f:
+                    while True:
+                        chunk = response.read(1 << 16)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            except (http.client.HTTPException, OSError):
+                # connection may be stale or reset, start fresh next attempt
+                conn.close()
+                raise
+            self._release_connection(parts.scheme, parts.netloc, conn)
+            return
+        raise IOError(f'Too many redirects for {url}')
+
+    def fetch(self, url, dest_file, var = None, date = None):
+        # download url to dest_file, retrying until the body is a zip
+        os.makedirs(os.path.dirname(dest_file), exist_ok = True)
+        tmp_file = dest_file + '.part'
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay / 2))
+            self.bucket.acquire()
+            try:
+                self._request(url, tmp_file)
+            except (http.client.HTTPException, OSError) as e:
+                error = str(e)
+                print(f'- Download attempt {attempt + 1} failed for {url}: {error}')
+                continue
+            if zipfile.is_zipfile(tmp_file):
+                os.replace(tmp_file, dest_file)
+                with self._failed_lock:
+                    self.failed = [job for job in self.failed if job['dest_file'] != dest_file]
+                return True
+            error = 'Data not found! Or too many downloads!'
+            print(f'- Attempt {attempt + 1} for {url}: {error}')
+
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        with self._failed_lock:
+            self.failed = [job for job in self.failed if job['dest_file'] != dest_file]
+            self.failed.append({'var': var, 'date': date, 'url': url, 'dest_file': dest_file, 'error': error})
+        return False
+
+    def fetch_many(self, jobs: list):
+        # jobs: [{'url': ..., 'dest_file': ..., 'var': ..., 'date': ...}], returns success per job
+        if len(jobs) == 0:
+            return []
+        with self._pool_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers = self.max_workers, thread_name_prefix = 'prism')
+            executor = self._executor
+        futures = [executor.submit(self.fetch, **job) for job in jobs]
+        return [f.result() for f in futures]
+
+    def close(self):
+        # stop the worker threads and close the pooled connections
+        with self._pool_lock:
+            executor, self._executor = self._executor, None
+            idle, self._idle = self._idle, {}
+        if executor is not None:
+            executor.shutdown(wait = True)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+    def write_manifest(self, manifest_file: str = None):
+        # persist failed (var, date) pairs for a later re-queue
+        manifest_file = manifest_file or self.manifest_file
+        if manifest_file is None:
+            return None
+        with self._failed_lock:
+            failed = list(self.failed)
+        with open(manifest_file, 'w') as f:
+            json.dump(failed, f, indent = 2)
+        return manifest_file
+
+    def retry_failed(self, manifest_file: str = None):
+        # re-queue everything in the manifest (or in memory) and keep what still fails
+        manifest_file = manifest_file or self.manifest_file
+        if manifest_file is not None and os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                jobs = json.load(f)
+        else:
+            jobs = list(self.failed)
+        jobs = [{k: job[k] for k in ('url', 'dest_file', 'var', 'date')} for job in jobs]
+        results = self.fetch_many(jobs)
+        self.write_manifest(manifest_file)
+        return results
+
+
+_default_downloader = None
+_default_lock = threading.Lock()
+
+def default_manifest_file():
+    # PRISM_MANIFEST_FILE, else in the temp dir (/tmp on Lambda)
+    return os.environ.get('PRISM_MANIFEST_FILE', os.path.join(tempfile.gettempdir(), 'prism_failed_downloads.json'))
+
+def get_default_downloader():
+    # process-wide downloader so concurrent callers share one rate limit,
+    # connection pool and manifest
+    global _default_downloader
+    with _default_lock:
+        if _default_downloader is None:
+            _default_downloader = PrismDownloader(manifest_file = default_manifest_file())
+            atexit.register(_default_downloader.close)
+    return _default_downloader
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+from .cube_store import GddCubeStore, slice_template
+
+### threshold-crossing (phenology event) dates
+# For each cell, the first date on which GDD accumulated since the biofix
+# reaches a target (egg hatch, adult flight, ...). The cube is streamed one
+# date slice at a time in date order with a running total per cell, so the
+# cumulative cube is never built, and reading stops as soon as every cell in
+# the region has reached the largest target. Results are int16 day-of-year
+# rasters, NODATA where a target is not reached (or outside the region).
+
+NODATA = -1
+
+
+def _iter_window(cube, start_date, end_date):
+    # (date, values) for start_date <= date <= end_date, a path is read slice by slice
+    if isinstance(cube, str):
+        cube_store = GddCubeStore(cube)
+        start = cube_store.dates().searchsorted(start_date, side = 'left')
+        for date, values in cube_store.iter_slices(start = start):
+            if date > end_date:
+                return
+            yield date, values
+        return
+    dates = pd.to_datetime(cube.date.values)
+    for i in np.flatnonzero((dates >= start_date) & (dates <= end_date)):
+        yield dates[i], np.asarray(cube.isel(date = i).values)
+
+def _slice_coords(cube):
+
+    template = slice_template(cube) if isinstance(cube, str) else cube.isel(date = 0, drop = True)
+    if 'date_written' in template.coords:
+        template = template.drop_vars('date_written')
+    return template.dims, {k: v.load() for k, v in template.coords.items()}
+
+def event_dates(
+    cube, # GDD cube, or a path to an on-disk cube which is streamed
+    targets, # {name: accumulated GDD}, e.g. {'egg_hatch': 250, 'adult_flight': 600}, or a list of GDD
+    start_day: str = '01-01', # biofix, 'mm-dd'
+    year: int = None, # season, defaults to the year of the cube's first date
+    end_day: str = '12-31', # last day of the season read, 'mm-dd'
+):
+    # (target, y, x) int16 day of year of the first date each target is reached
+    if not isinstance(targets, dict):
+        targets = {str(target): target for target in targets}
+    names = list(targets.keys())
+    values = np.array([targets[name] for name in names], dtype = np.float64)
+    if year is None:
+        first_date = GddCubeStore(cube).dates()[0] if isinstance(cube, str) else pd.Timestamp(cube.date.values[0])
+        year = first_date.year
+    month, day = [int(x) for x in start_day.split('-')]
+    start_date = pd.Timestamp(year, month, day)
+    month, day = [int(x) for x in end_day.split('-')]
+    end_date = pd.Timestamp(year, month, day)
+
+    dims, coords = _slice_coords(cube)
+    result = None
+    for date, daily in _iter_window(cube, start_date, end_date):
+        if result is None:
+            # the region: cells with data on the first day of the season
+            in_region = ~np.isnan(daily)
+            running = np.zeros(daily.shape)
+            result = np.full((len(names),) + daily.shape, NODATA, dtype = np.int16)
+        running += np.nan_to_num(daily)
+        for i, target in enumerate(values):
+            result[i][(result[i] == NODATA) & in_region & (running >= target)] = date.dayofyear
+        if np.all(running[in_region] >= values.max()):
+            break # every cell has reached every target
+
+    if result is None:
+        raise ValueError(f'The cube has no dates from {start_date.date()} to {end_date.date()}.')
+    event_array = xra.DataArray(
+        result,
+        dims = ('target',) + dims,
+        coords = {**coords, 'target': names, 'gdd_target': ('target', values)},
+        attrs = {'start_day': start_day, 'year': year, 'units': 'day of year', 'nodata': NODATA},
+    )
+    return event_array
@@ -0,0 +1,66 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+### two layer cache of numpy arrays
+# Values that are expensive to compute but fully determined by a key (region
+# masks, zonal indexes, projections) are kept in memory and optionally
+# persisted as <prefix>_<sha1 of key>.npz files (e.g. on EFS) so other
+# processes can reuse them. A value is stored as {name: numpy array}; callers
+# holding other objects pass encode / decode to convert.
+
+
+class NpzCache:
+    def __init__(self, cache_dir: str = None, prefix: str = 'cache', max_items: int = None):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self.max_items = max_items # None for unbounded
+        self.values = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok = True)
+
+    def _cache_file(self, key):
+
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{self.prefix}_{key_hash}.npz')
+
+    def load(self, key):
+        # {name: array} from the file layer, None when missing
+        if self.cache_dir is None or not os.path.exists(self._cache_file(key)):
+            return None
+        with np.load(self._cache_file(key)) as f:
+            return {name: f[name] for name in f.files}
+
+    def save(self, key, arrays: dict):
+
+        if self.cache_dir is None:
+            return
+        # write then rename so readers never see a partial file
+        cache_file = self._cache_file(key)
+        tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, cache_file)
+
+    def cached(self, key, compute, encode = None, decode = None):
+        # compute() -> value, run only when key is in neither layer; encode(value)
+        # -> {name: array} and decode({name: array}) -> value, default as is
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                return self.values[key]
+
+        arrays = self.load(key)
+        if arrays is not None:
+            value = decode(arrays) if decode is not None else arrays
+        else:
+            value = compute()
+            self.save(key, encode(value) if encode is not None else value)
+
+        with self.lock:
+            self.values[key] = value
+            while (self.max_items is not None) and len(self.values) > self.max_items:
+                self.values.popitem(last = False)
+        return value
@@ -0,0 +1,263 @@
+import os
+import time
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from .download import PrismDownloader, get_default_downloader
+
+### shared, size-bounded cache of raw PRISM downloads
+# One directory per (var, date) on a filesystem every worker mounts (e.g. EFS),
+# so a day's zip is downloaded once however many invocations ask for it.
+# - a per-entry lock file (POSIX record lock, which EFS / NFSv4 honour) makes
+#   concurrent workers wait for the one that is downloading instead of
+#   fetching the same file again
+# - a COMPLETE marker is written only after the zip is fully in place, and
+#   readers only use entries that have it
+# - readers hold the entry's lock shared while they read it (reading()), and
+#   eviction takes it exclusively without waiting, so entries in use are skipped
+# - entries are evicted least recently used first once the cache grows past
+#   max_bytes; the marker's mtime is the last use. The evicting worker also
+#   removes the entry's lock file (still holding it), and a worker that then
+#   gets the lock on the removed file starts over on a new one
+
+COMPLETE = 'COMPLETE'
+
+
+class _EntryLock:
+    # readers / writer lock on one entry, across threads and processes. Record
+    # locks belong to the process and closing any descriptor of the file drops
+    # them all, so the process holds one descriptor per entry and one record
+    # lock, shared while it has readers, exclusive while a thread writes.
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.lock_file = None
+        self.users = 0 # threads using this lock, see PrismCache._entry_lock
+
+    def acquire(self, shared: bool, blocking: bool = True):
+
+        with self.cond:
+            while self.writer or (not shared and self.readers > 0):
+                if not blocking:
+                    return False
+                self.cond.wait()
+            if shared and self.readers > 0:
+                self.readers += 1 # the process already holds the shared lock
+                return True
+            while not self._lock_file(shared, blocking):
+                if not blocking:
+                    return False
+            if shared:
+                self.readers += 1
+            else:
+                self.writer = True
+            return True
+
+    def _lock_file(self, shared, blocking):
+        # True once the lock is held on the file currently at path; False if it
+        # is busy (non-blocking) or was removed while we waited (try again)
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        lock_file = open(self.path, 'a+') # shared record locks need read access
+        try:
+            fcntl.lockf(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            lock_file.close()
+            if blocking:
+                raise
+            return False
+        try:
+            current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(self.path))
+        except FileNotFoundError:
+            current = False
+        if not current:
+            lock_file.close() # drops the lock
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def remove(self):
+        # delete the lock file while holding the lock exclusively
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def release(self, shared: bool):
+
+        with self.cond:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            if self.readers == 0 and not self.writer:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+                self.lock_file.close()
+                self.lock_file = None
+            self.cond.notify_all()
+
+
+class PrismCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 5 * 1024 ** 3, downloader: PrismDownloader = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.downloader = downloader
+        self.stats = {'hits': 0, 'misses': 0}
+        self._key_locks = {} # record locks are per process, so threads also need their own
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def entry_dir(self, var, date):
+        # var_dir argument for prism_io.load_prism_raster
+        return os.path.join(self.cache_dir, var, str(date))
+
+    def zip_file(self, var, date):
+
+        return os.path.join(self.entry_dir(var, date), f'{var}_{date}.zip')
+
+    def is_complete(self, var, date):
+
+        return os.path.exists(os.path.join(self.entry_dir(var, date), COMPLETE))
+
+    @contextmanager
+    def _entry_lock(self, entry_dir):
+        # the entry's lock, counted as in use until the block exits so eviction
+        # only forgets locks no other thread is holding or waiting for
+        with self._lock:
+            entry_lock = self._key_locks.setdefault(entry_dir, _EntryLock(f'{entry_dir}.lock'))
+            entry_lock.users += 1
+        try:
+            yield entry_lock
+        finally:
+            with self._lock:
+                entry_lock.users -= 1
+
+    @contextmanager
+    def _locked(self, entry_dir, blocking = True):
+        # exclusive lock on one entry across threads and processes; yields the
+        # lock, or None instead of waiting when blocking is False and the entry is busy
+        with self._entry_lock(entry_dir) as entry_lock:
+            if not entry_lock.acquire(shared = False, blocking = blocking):
+                yield None
+                return
+            try:
+                yield entry_lock
+            finally:
+                entry_lock.release(shared = False)
+
+    def _count(self, stat):
+
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _touch(self, marker):
+        # mark a complete entry as used now; False if it was evicted meanwhile
+        try:
+            os.utime(marker)
+        except FileNotFoundError:
+            return False
+        self._count('hits')
+        return True
+
+    def get(self, url, var, date):
+        # entry dir holding the day's zip, downloading it if no one has yet; None
+        # on failure. Nothing keeps the entry from eviction afterwards, use
+        # reading() to hold it while it is read.
+        entry_dir = self.entry_dir(var, date)
+        marker = os.path.join(entry_dir, COMPLETE)
+        if os.path.exists(marker) and self._touch(marker):
+            return entry_dir
+        with self._locked(entry_dir):
+            # someone else may have finished it while we waited for the lock
+            if os.path.exists(marker) and self._touch(marker):
+                return entry_dir
+            self._count('misses')
+            downloader = self.downloader or get_default_downloader()
+            if not downloader.fetch(url, self.zip_file(var, date), var = var, date = date):
+                return None
+            with open(marker, 'w') as f:
+                f.write(str(time.time()))
+        self.evict(keep = entry_dir)
+        return entry_dir
+
+    def get_many(self, jobs: list, max_workers: int = 8):
+        # jobs: [{'url': ..., 'var': ..., 'date': ...}], returns the entry dir (or None) per job
+        if len(jobs) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers = min(max_workers, len(jobs))) as pool:
+            futures = [pool.submit(self.get, job['url'], job['var'], job['date']) for job in jobs]
+            return [f.result() for f in futures]
+
+    @contextmanager
+    def reading(self, jobs: list):
+        # entry dir (or None) per job, each held shared until the block exits
+        # so eviction cannot remove it while it is read; evicted entries are
+        # fetched again
+        with ExitStack() as held:
+            entry_dirs = []
+            for job in jobs:
+                entry_dir = self.entry_dir(job['var'], job['date'])
+                marker = os.path.join(entry_dir, COMPLETE)
+                entry_lock = held.enter_context(self._entry_lock(entry_dir))
+                while True:
+                    entry_lock.acquire(shared = True)
+                    if os.path.exists(marker) and self._touch(marker):
+                        held.callback(entry_lock.release, shared = True)
+                        entry_dirs.append(entry_dir)
+                        break
+                    entry_lock.release(shared = True)
+                    if self.get(job['url'], job['var'], job['date']) is None:
+                        entry_dirs.append(None)
+                        break
+            yield entry_dirs
+
+    def _entries(self):
+        # (last use, size, entry dir) of every complete entry
+        entries = []
+        for var in os.listdir(self.cache_dir):
+            var_dir = os.path.join(self.cache_dir, var)
+            if not os.path.isdir(var_dir):
+                continue
+            for date in os.listdir(var_dir):
+                entry_dir = os.path.join(var_dir, date)
+                try:
+                    last_used = os.stat(os.path.join(entry_dir, COMPLETE)).st_mtime
+                    size = sum(e.stat().st_size for e in os.scandir(entry_dir))
+                except OSError:
+                    continue # incomplete, or removed by another worker
+                entries.append((last_used, size, entry_dir))
+        return entries
+
+    def evict(self, keep: str = None):
+        # least recently used first, skipping entries another worker holds and
+        # keep (the entry just fetched, which its caller is about to read)
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            with self._locked(entry_dir, blocking = False) as entry_lock:
+                if entry_lock is None:
+                    continue
+                # drop the marker first so the entry stops being used right away
+                try:
+                    os.remove(os.path.join(entry_dir, COMPLETE))
+                except FileNotFoundError:
+                    continue # already evicted by another worker
+                shutil.rmtree(entry_dir, ignore_errors = True)
+                entry_lock.remove()
+            total -= size
+        self._forget_locks()
+
+    def _forget_locks(self):
+        # drop locks of entries that are gone (evicted here or by another worker)
+        # and that no thread is using, so a warm process does not keep one per day ever seen
+        with self._lock:
+            for entry_dir, entry_lock in list(self._key_locks.items()):
+                if entry_lock.users == 0 and not os.path.exists(entry_dir):
+                    del self._key_locks[entry_dir]
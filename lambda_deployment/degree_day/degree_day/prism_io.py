@@ -0,0 +1,143 @@
+import os
+import zipfile
+import numpy as np
+import xarray as xra
+import rioxarray
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.windows import Window, from_bounds
+from .region_mask import MaskCache, get_default_mask_cache
+
+### reading PRISM rasters
+# PRISM downloads are zips holding a .bil (+ .hdr, .prj, ...) or a .nc. GDAL can
+# read those members in place through /vsizip/, so the zips never need to be
+# extracted to disk. A .bil is a flat grid described by its .hdr, so when it is
+# on disk (extracted, or stored uncompressed in the zip) it is memory-mapped
+# instead: windows are zero-copy views and data stays float32.
+# PRISM serves deflated zips, so with the default extract = False every read
+# goes through GDAL: on an 800m grid a region window costs ~0.35 s that way
+# against ~0.04 s memory-mapped from an extracted .bil. Extract (extract = True)
+# when the same days are read many times; inflating the member in Python is
+# slower than GDAL, so a single read per day is best left in the zip.
+
+BIL_DTYPES = {('FLOAT', 32): 'f4', ('FLOAT', 64): 'f8', ('SIGNEDINT', 16): 'i2', ('SIGNEDINT', 32): 'i4', (None, 16): 'u2', (None, 8): 'u1'}
+
+
+def zip_member_path(zip_file: str, member: str):
+
+    return f'/vsizip/{zip_file}/{member}'
+
+def prism_raster_path(var_dir: str, zip_name: str, file_name: str):
+    # use an already extracted copy if there is one, otherwise read inside the zip
+    extracted_file = os.path.join(var_dir, file_name)
+    if os.path.exists(extracted_file):
+        return extracted_file
+    return zip_member_path(os.path.join(var_dir, zip_name), file_name)
+
+def read_bil_header(hdr_text: str):
+    # ESRI .hdr: one 'KEY value' pair per line
+    header = {}
+    for line in hdr_text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            header[parts[0].upper()] = parts[1]
+    return header
+
+def _bil_array(header, source, offset = 0):
+    # memory-map the band-interleaved-by-line grid as (band, y, x)
+    n_rows, n_cols = int(header['NROWS']), int(header['NCOLS'])
+    n_bands = int(header.get('NBANDS', 1))
+    key = (header.get('PIXELTYPE', '').upper() or None, int(header.get('NBITS', 8)))
+    if key not in BIL_DTYPES: 
+        key = (None, key[1])
+    if header.get('LAYOUT', 'BIL').upper() != 'BIL' or key not in BIL_DTYPES: 
+        return None
+    byte_order = '>' if header.get('BYTEORDER', 'I').upper() in ('M', 'MOTOROLA') else '<'
+    dtype = np.dtype(byte_order + BIL_DTYPES[key])
+    offset += int(header.get('SKIPBYTES', 0))
+    data = np.memmap(source, dtype = dtype, mode = 'r', offset = offset, shape = (n_rows, n_bands, n_cols))
+    return data.transpose(1, 0, 2)
+
+def open_bil(var_dir: str, zip_name: str, file_name: str):
+    # memory-mapped DataArray for a .bil, or None if it can only be read through GDAL
+    stem = os.path.splitext(file_name)[0]
+    bil_file = os.path.join(var_dir, file_name)
+    hdr_file = os.path.join(var_dir, f'{stem}.hdr')
+    prj_file = os.path.join(var_dir, f'{stem}.prj')
+    zip_file = os.path.join(var_dir, zip_name)
+    if os.path.exists(bil_file) and os.path.exists(hdr_file): 
+        with open(hdr_file) as f: 
+            header = read_bil_header(f.read())
+        prj_text = None
+        if os.path.exists(prj_file): 
+            with open(prj_file) as f: 
+                prj_text = f.read()
+        data = _bil_array(header, bil_file)
+    elif os.path.exists(zip_file): 
+        with zipfile.ZipFile(zip_file) as zip_ref: 
+            names = zip_ref.namelist()
+            if (file_name not in names) or (f'{stem}.hdr' not in names): 
+                return None
+            info = zip_ref.getinfo(file_name)
+            if info.compress_type != zipfile.ZIP_STORED: 
+                return None
+            header = read_bil_header(zip_ref.read(f'{stem}.hdr').decode())
+            prj_text = zip_ref.read(f'{stem}.prj').decode() if f'{stem}.prj' in names else None
+        # member data starts after its local header (30 bytes + name + extra)
+        with open(zip_file, 'rb') as f: 
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype = '<u2')
+        data_offset = info.header_offset + 30 + int(name_len) + int(extra_len)
+        data = _bil_array(header, zip_file, offset = data_offset)
+    else: 
+        return None
+    if data is None: 
+        return None
+
+    # ULXMAP / ULYMAP are the centre of the upper left cell
+    x_res, y_res = float(header['XDIM']), float(header['YDIM'])
+    transform = Affine(x_res, 0, float(header['ULXMAP']) - x_res / 2, 0, -y_res, float(header['ULYMAP']) + y_res / 2)
+    n_bands, n_rows, n_cols = data.shape
+    centers = transform * Affine.translation(0.5, 0.5) # same cell centres as rioxarray
+    x_coords, _ = centers * (np.arange(n_cols), np.zeros(n_cols))
+    _, y_coords = centers * (np.zeros(n_rows), np.arange(n_rows))
+    raster = xra.DataArray(
+        data, 
+        dims = ('band', 'y', 'x'), 
+        coords = {'band': np.arange(1, n_bands + 1), 'y': y_coords, 'x': x_coords},
+    )
+    crs = CRS.from_wkt(prj_text) if prj_text else CRS.from_epsg(4269) # PRISM grids are NAD83
+    # in place: by default rio.write_* deep copy the data, the whole grid each time
+    raster.rio.write_crs(crs, inplace = True).rio.write_transform(transform, inplace = True)
+    if 'NODATA' in header: 
+        raster.rio.write_nodata(float(header['NODATA']), inplace = True)
+    return raster
+
+def open_prism_raster(var_dir: str, zip_name: str, file_name: str):
+    # memory-map .bil grids when possible, otherwise go through GDAL
+    if file_name.lower().endswith('.bil'): 
+        raster = open_bil(var_dir, zip_name, file_name)
+        if raster is not None: 
+            return raster
+    return rioxarray.open_rasterio(prism_raster_path(var_dir, zip_name, file_name))
+
+def bbox_window(raster, geometry):
+    # raster window covering the geometry bounds, snapped outward to whole cells,
+    # padded and limited to the raster extent. Like rio.clip without crs, the geometry
+    # is taken to be in the raster's crs.
+    minx, miny, maxx, maxy = geometry.total_bounds
+    window = from_bounds(minx, miny, maxx, maxy, transform = raster.rio.transform())
+    window = window.round_offsets(op = 'floor').round_lengths(op = 'ceil')
+    # pad a cell on each side so edge cells rio.clip would keep are never cut
+    padded = Window(window.col_off - 1, window.row_off - 1, window.width + 2, window.height + 2)
+    return padded.intersection(Window(0, 0, raster.rio.width, raster.rio.height))
+
+def load_prism_raster(var_dir: str, zip_name: str, file_name: str, geometry, nodata = -9999, mask_cache: MaskCache = None):
+    # read only the region's window and apply its cached polygon mask, which
+    # matches rio.clip(geometry, drop = True) without rasterizing every time
+    if mask_cache is None:
+        mask_cache = get_default_mask_cache()
+    raw_raster = open_prism_raster(var_dir, zip_name, file_name)
+    region_mask = mask_cache.get(raw_raster, geometry, window = bbox_window(raw_raster, geometry))
+    clip_raster = region_mask.apply(raw_raster, nodata = nodata)
+    return clip_raster.drop_vars('band').squeeze()
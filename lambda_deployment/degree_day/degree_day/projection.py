@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xra
+from .cube_store import GddCubeStore, slice_template
+from .cube_index import update_cumsum_index
+from .npz_cache import NpzCache
+from .anomaly import _default_start_day, _normals_source, _season_start
+from .events import NODATA, event_dates
+
+### season-to-date GDD projected with the normals
+# Observed GDD accumulated since the biofix up to an as-of date, extended past
+# it with the normal daily GDD:
+#   projected(d) = observed(as_of) + N(d) - N(as_of)
+# where N is the normals' running total on the season's calendar. The base
+# state (observed(as_of), N(as_of)) is two or three slice reads from the cumsum
+# index and the normals, projections for any dates are one cumulative read,
+# and event dates past the as-of date come from a chunked scan of N that stops
+# once every cell has reached every target. Results are cached per (cube,
+# normals, biofix, as-of date) query in memory and optionally as .npz files
+# (e.g. on EFS), so repeated dashboard queries skip the work.
+
+
+class ProjectionCache(NpzCache):
+    def __init__(self, cache_dir: str = None, max_items: int = 256):
+        super().__init__(cache_dir, prefix = 'gdd_projection', max_items = max_items)
+
+    def get(self, key, compute):
+        # compute() -> {name: numpy array}, run only when key is in neither layer
+        return self.cached(key, compute)
+
+_default_projection_cache = ProjectionCache()
+
+def get_default_projection_cache():
+
+    return _default_projection_cache
+
+def set_default_projection_cache(projection_cache: ProjectionCache):
+    # e.g. set_default_projection_cache(ProjectionCache('/mnt/efs/gdd_projections'))
+    global _default_projection_cache
+    _default_projection_cache = projection_cache
+
+
+class GddProjection:
+    def __init__(
+        self,
+        cube_file: str, # observed GDD cube of the region
+        normals, # ClimatologyStore, or path to a normals cube of the same region
+        as_of: str, # last observed date used, e.g. '2024-06-30'; defaults to the cube's last date on or before it
+        pest: str = None, # pest in the ClimatologyStore
+        start_day: str = None, # biofix 'mm-dd', defaults to the pest's in the store, else '01-01'
+        cache: ProjectionCache = None,
+    ):
+        self.cube_file = cube_file
+        self.start_day = _default_start_day(normals, pest, start_day)
+        self.source = _normals_source(normals, pest)
+        self.cache = cache or get_default_projection_cache()
+
+        index_store = GddCubeStore(update_cumsum_index(cube_file))
+        index_written = index_store.written_at()
+        obs_dates = index_written.index
+        p = obs_dates.searchsorted(pd.Timestamp(as_of), side = 'right') - 1
+        if p < 0:
+            raise ValueError(f'The cube {cube_file} has no dates on or before {as_of}.')
+        self.as_of = obs_dates[p]
+        self.season_start = _season_start(self.as_of, self.start_day, obs_dates[0])
+        self.season_end = pd.Timestamp(self.as_of.year, 12, 31)
+        # the cube's last write is part of the key, so patched cubes are recomputed
+        self.key = (os.path.abspath(cube_file), str(index_written.max()), self.source.key, self.start_day, str(self.as_of.date()))
+        self.template = slice_template(cube_file)
+
+        def base():
+            if self.as_of < self.season_start:
+                # season not started: nothing observed, normals from the day before the biofix
+                before = self.season_start - pd.Timedelta(days = 1)
+                normal = self.source.cumulative(pd.DatetimeIndex([before]))[0]
+                if before.year < self.as_of.year:
+                    normal = np.zeros(normal.shape)
+                first_day = GddCubeStore(cube_file).read_slices([p])[0]
+                return {'observed': np.zeros(first_day.shape), 'normal': normal, 'in_region': ~np.isnan(first_day)}
+            b = obs_dates.searchsorted(self.season_start, side = 'left') - 1
+            slices = index_store.read_slices([p, b] if b >= 0 else [p])
+            observed = slices[0] - slices[1] if b >= 0 else slices[0]
+            # the region: cells with data on the first day of the season
+            first_day = GddCubeStore(cube_file).read_slices([b + 1])[0]
+            return {
+                'observed': observed, 'normal': self.source.cumulative(pd.DatetimeIndex([self.as_of]))[0],
+                'in_region': ~np.isnan(first_day)}
+        self.base = self.cache.get(self.key + ('base',), base)
+
+    def _dates(self, dates):
+
+        dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        if ((dates <= self.as_of) | (dates > self.season_end)).any():
+            raise ValueError(f'Projected dates must be after {self.as_of.date()} and by {self.season_end.date()}.')
+        return dates
+
+    def accumulation(self, dates: list):
+        # (date, y, x) projected GDD accumulated since the biofix at each date
+        dates = self._dates(dates)
+
+        def compute():
+            normal = np.maximum(self.source.cumulative(dates) - self.base['normal'], 0)
+            return {'gdd': (self.base['observed'] + normal).astype(np.float32)}
+        values = self.cache.get(self.key + ('accumulation', tuple(dates.strftime('%Y%m%d'))), compute)['gdd']
+        return xra.DataArray(
+            values, dims = ('date',) + self.template.dims,
+            coords = {**self.template.coords, 'date': dates.values},
+            attrs = {'as_of': str(self.as_of.date()), 'start_day': self.start_day})
+
+    def event_dates(self, targets, chunk_days: int = 32):
+        # (target, y, x) int16 day of year each target is reached: observed up
+        # to as_of, projected after it (day of year > the as_of attribute)
+        if not isinstance(targets, dict):
+            targets = {str(target): target for target in targets}
+        names = list(targets.keys())
+        values = np.array([targets[name] for name in names], dtype = np.float64)
+
+        def compute():
+            if self.as_of < self.season_start:
+                result = np.full((len(names),) + self.template.shape, NODATA, dtype = np.int16)
+            else:
+                result = event_dates(
+                    self.cube_file, targets, self.start_day, year = self.as_of.year,
+                    end_day = self.as_of.strftime('%m-%d')).values
+            in_region = self.base['in_region']
+            remaining = values[:, None, None] - self.base['observed']
+            days = pd.date_range(self.as_of + pd.Timedelta(days = 1), self.season_end)
+            for c in range(0, len(days), chunk_days):
+                if not np.any((result == NODATA) & in_region):
+                    break # every cell has reached every target
+                chunk = days[c:c + chunk_days]
+                normal = self.source.cumulative(chunk) - self.base['normal']
+                for j, date in enumerate(chunk):
+                    for i in range(len(names)):
+                        result[i][(result[i] == NODATA) & in_region & (normal[j] >= remaining[i])] = date.dayofyear
+            return {'doy': result}
+        result = self.cache.get(self.key + ('event_dates', tuple(targets.items())), compute)['doy']
+        return xra.DataArray(
+            result,
+            dims = ('target',) + self.template.dims,
+            coords = {**self.template.coords, 'target': names, 'gdd_target': ('target', values)},
+            attrs = {
+                'start_day': self.start_day, 'year': self.as_of.year, 'units': 'day of year', 'nodata': NODATA,
+                'as_of': self.as_of.dayofyear},
+        )
@@ -0,0 +1,230 @@
+import os
+import numpy as np
+import pandas as pd
+import netCDF4
+from rasterio.transform import Affine
+from rasterio import windows
+from rasterio.features import geometry_mask
+from .cube_store import GddCubeStore, DATA_VAR, slice_template
+from .cube_index import index_is_current
+from .region_mask import geometry_key
+from .npz_cache import NpzCache
+
+### point and zonal queries over GDD cubes
+# Per-farm series and per-county means need a few cells of every date, not
+# whole slices. Lookups against the cube grid are computed once:
+# - points: (row, col) of the cell holding each coordinate, -1 off the grid
+# - zones: sparse membership weights per polygon (cells whose centre falls
+#   inside, each weighted 1 / n) as CSR arrays (offsets, cells, weights),
+#   rasterized on the polygon's own window and kept in an NpzCache like
+#   region masks
+# Queries then read only the needed cells, tile by tile, for every date at
+# once. They read from a time-major copy of the cube (<cube>_ts.nc, chunked as
+# chunk_dates x tile x tile, so a cell's series is contiguous) when it is
+# current, else from the cube's own slices.
+
+
+def timeseries_path(cube_file: str):
+
+    root, ext = os.path.splitext(cube_file)
+    return f'{root}_ts{ext}'
+
+def update_timeseries_cube(
+    cube_file: str,
+    ts_file: str = None,
+    chunk_dates: int = 366,
+    tile: int = 32,
+    block_dates: int = 64, # dates copied per write
+):
+    # build the time-major copy of a cube, or extend it from the first date it
+    # no longer matches, block_dates at a time
+    ts_file = ts_file or timeseries_path(cube_file)
+    cube_store = GddCubeStore(cube_file)
+    ts_store = GddCubeStore(ts_file, chunk_dates = chunk_dates, tile = tile)
+    cube_written = cube_store.written_at()
+    ts_written = ts_store.written_at()
+    if not set(ts_written.index).issubset(cube_written.index):
+        # dates were removed from the cube, start over
+        ts_store = GddCubeStore(ts_file, overwrite = True, chunk_dates = chunk_dates, tile = tile)
+        ts_written = ts_store.written_at()
+
+    n = min(len(cube_written), len(ts_written))
+    k = 0
+    while (k < n) and (cube_written.index[k] == ts_written.index[k]) and not (cube_written.iloc[k] > ts_written.iloc[k]):
+        k += 1
+    template = slice_template(cube_file)
+    for c in range(k, len(cube_written), block_dates):
+        positions = list(range(c, min(c + block_dates, len(cube_written))))
+        values = np.stack(cube_store.read_slices(positions))
+        ts_store.write_block(c, cube_written.index[positions], values, template = template.astype(values.dtype))
+    return ts_file
+
+
+class CubeGrid:
+    # the cube's regular (y, x) grid, read from its coordinates only
+    def __init__(self, cube_file: str):
+        template = slice_template(cube_file)
+        self.y_dim, self.x_dim = template.dims
+        y = template[self.y_dim].values
+        x = template[self.x_dim].values
+        self.shape = (len(y), len(x))
+        dy = y[1] - y[0] if len(y) > 1 else -1.0
+        dx = x[1] - x[0] if len(x) > 1 else 1.0
+        # transform of cell corners, for rasterizing
+        self.transform = Affine(dx, 0, x[0] - dx / 2, 0, dy, y[0] - dy / 2)
+        self.key = (tuple(self.transform)[:6], self.shape)
+
+    def cells(self, xs, ys):
+        # (rows, cols) of the cells holding the coordinates, -1 off the grid
+        cols, rows = ~self.transform * (np.asarray(xs, dtype = float), np.asarray(ys, dtype = float))
+        rows, cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        off_grid = (rows < 0) | (rows >= self.shape[0]) | (cols < 0) | (cols >= self.shape[1])
+        rows[off_grid] = -1
+        cols[off_grid] = -1
+        return rows, cols
+
+
+class ZonalIndex:
+    def __init__(self, offsets, cells, weights, shape):
+        self.offsets = offsets # zone i owns cells[offsets[i]:offsets[i + 1]]
+        self.cells = cells # flat (row * n_cols + col) cell index
+        self.weights = weights
+        self.shape = shape
+
+
+class ZonalIndexCache(NpzCache):
+    def __init__(self, cache_dir: str = None):
+        super().__init__(cache_dir, prefix = 'zonal_index')
+
+    def get(self, grid: CubeGrid, geometry):
+        # geometry: shapely geometries in the cube's crs, one zone each
+        def encode(zonal_index):
+            return {'offsets': zonal_index.offsets, 'cells': zonal_index.cells, 'weights': zonal_index.weights}
+
+        def decode(arrays):
+            return ZonalIndex(arrays['offsets'], arrays['cells'], arrays['weights'], grid.shape)
+
+        key = (geometry_key(geometry), grid.key)
+        return self.cached(key, lambda: rasterize_zones(grid, geometry), encode, decode)
+
+_default_zonal_cache = ZonalIndexCache()
+
+def set_default_zonal_cache(zonal_cache: ZonalIndexCache):
+    # e.g. set_default_zonal_cache(ZonalIndexCache('/mnt/efs/zonal_indexes'))
+    global _default_zonal_cache
+    _default_zonal_cache = zonal_cache
+
+def rasterize_zones(grid: CubeGrid, geometry):
+    # membership of every zone, each rasterized on its own bounds window only
+    full = windows.Window(0, 0, grid.shape[1], grid.shape[0])
+    offsets = [0]
+    cells = []
+    for geom in geometry:
+        try:
+            bounds = windows.from_bounds(*geom.bounds, transform = grid.transform)
+            # whole cells around the bounds, one cell of margin
+            r0, c0 = int(np.floor(bounds.row_off)) - 1, int(np.floor(bounds.col_off)) - 1
+            r1 = int(np.ceil(bounds.row_off + bounds.height)) + 1
+            c1 = int(np.ceil(bounds.col_off + bounds.width)) + 1
+            window = windows.Window(c0, r0, c1 - c0, r1 - r0).intersection(full)
+        except windows.WindowError:
+            offsets.append(offsets[-1])
+            continue # off the grid
+        mask = geometry_mask(
+            [geom], out_shape = (int(window.height), int(window.width)),
+            transform = windows.transform(window, grid.transform), invert = True)
+        rows, cols = np.nonzero(mask)
+        cells.append((rows + int(window.row_off)) * grid.shape[1] + cols + int(window.col_off))
+        offsets.append(offsets[-1] + len(rows))
+    cells = np.concatenate(cells) if len(cells) > 0 else np.zeros(0, dtype = np.int64)
+    counts = np.diff(offsets)
+    weights = np.repeat(1 / np.maximum(counts, 1), counts)
+    return ZonalIndex(np.array(offsets), cells, weights, grid.shape)
+
+
+def _query_file(cube_file, ts_file):
+    # the time-major copy when it matches the cube, else the cube
+    ts_file = ts_file or timeseries_path(cube_file)
+    return ts_file if index_is_current(cube_file, ts_file) else cube_file
+
+def _read_cells(path, rows, cols, a, b):
+    # (dates a..b-1, cells) values; cells are grouped by chunk tile and each
+    # group is one read of its bounding box over all the dates
+    out = np.full((b - a, len(rows)), np.nan, dtype = np.float32)
+    on_grid = np.flatnonzero(rows >= 0)
+    if len(on_grid) == 0 or b <= a:
+        return out
+    with netCDF4.Dataset(path, mode = 'r') as nc:
+        data_var = nc[DATA_VAR]
+        n_y, n_x = data_var.shape[1:]
+        chunk_y, chunk_x = data_var.chunking()[1:] if data_var.chunking() != 'contiguous' else (n_y, n_x)
+        # whole-slice chunks: group nearby cells in 64 x 64 boxes instead
+        tile_y = chunk_y if chunk_y < n_y else 64
+        tile_x = chunk_x if chunk_x < n_x else 64
+        tile_ids = (rows[on_grid] // tile_y) * (n_x // tile_x + 1) + cols[on_grid] // tile_x
+        order = np.argsort(tile_ids, kind = 'stable')
+        groups = np.split(on_grid[order], np.flatnonzero(np.diff(tile_ids[order])) + 1)
+        for group in groups:
+            r0, r1 = rows[group].min(), rows[group].max() + 1
+            c0, c1 = cols[group].min(), cols[group].max() + 1
+            block = data_var[a:b, r0:r1, c0:c1]
+            block = block.filled(np.nan) if np.ma.isMaskedArray(block) else block
+            out[:, group] = block[:, rows[group] - r0, cols[group] - c0]
+    return out
+
+def _date_positions(path, start_date, end_date):
+
+    dates = GddCubeStore(path).dates()
+    a = 0 if start_date is None else dates.searchsorted(pd.Timestamp(start_date), side = 'left')
+    b = len(dates) if end_date is None else dates.searchsorted(pd.Timestamp(end_date), side = 'right')
+    return dates[a:b], a, b
+
+def query_points(
+    cube_file: str,
+    xs, # coordinates in the cube's crs (lon / lat for PRISM)
+    ys,
+    ids: list = None, # column names, defaults to 0..n-1
+    start_date: str = None,
+    end_date: str = None,
+    ts_file: str = None, # time-major copy, see update_timeseries_cube
+):
+    # (date x point) GDD of the cells holding each point, nan off the grid
+    path = _query_file(cube_file, ts_file)
+    rows, cols = CubeGrid(cube_file).cells(xs, ys)
+    dates, a, b = _date_positions(path, start_date, end_date)
+    values = _read_cells(path, rows, cols, a, b)
+    return pd.DataFrame(values, index = pd.Index(dates, name = 'date'), columns = ids if ids is not None else range(len(rows)))
+
+def query_zones(
+    cube_file: str,
+    geometry, # shapely geometries (e.g. a GeoSeries) in the cube's crs, one zone each
+    ids: list = None,
+    start_date: str = None,
+    end_date: str = None,
+    ts_file: str = None,
+    zonal_cache: ZonalIndexCache = None,
+):
+    # (date x zone) mean GDD over the cells of each zone, ignoring nan cells
+    path = _query_file(cube_file, ts_file)
+    grid = CubeGrid(cube_file)
+    zonal_index = (zonal_cache or _default_zonal_cache).get(grid, list(geometry))
+    dates, a, b = _date_positions(path, start_date, end_date)
+
+    # read every distinct cell once, however many zones share it
+    unique_cells, inverse = np.unique(zonal_index.cells, return_inverse = True)
+    values = _read_cells(path, unique_cells // grid.shape[1], unique_cells % grid.shape[1], a, b)[:, inverse]
+    valid = ~np.isnan(values)
+    weighted = np.where(valid, values, 0) * zonal_index.weights
+    weight = valid * zonal_index.weights
+
+    n_zones = len(zonal_index.offsets) - 1
+    totals = np.zeros((len(dates), n_zones))
+    weights = np.zeros((len(dates), n_zones))
+    # cells are stored zone by zone, so each zone is one segment of the sum
+    filled = np.flatnonzero(np.diff(zonal_index.offsets) > 0)
+    if len(filled) > 0:
+        totals[:, filled] = np.add.reduceat(weighted, zonal_index.offsets[filled], axis = 1)
+        weights[:, filled] = np.add.reduceat(weight, zonal_index.offsets[filled], axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        means = np.where(weights > 0, totals / weights, np.nan)
+    return pd.DataFrame(means, index = pd.Index(dates, name = 'date'), columns = ids if ids is not None else range(n_zones))
@@ -0,0 +1,87 @@
+import hashlib
+import numpy as np
+from rasterio import windows
+from rasterio.features import geometry_mask
+from .npz_cache import NpzCache
+
+### cached region masks
+# The PRISM grid never changes, so the raster window and polygon mask for a
+# region are the same every day, for every variable and every pest. They are
+# rasterized once per (geometry, grid transform, grid shape) and kept in an
+# NpzCache, in memory and optionally as .npz files shared across processes.
+
+
+class RegionMask:
+    def __init__(self, window, mask):
+        self.window = window # rasterio Window of the masked extent on the full grid
+        self.mask = mask # boolean (rows, cols), True inside the region
+
+    def apply(self, raster, nodata = -9999):
+        # slice the window out of a (lazy or memory-mapped) raster, take one copy 
+        # of it in at least float32, and set outside cells and nodata to nan in place
+        window_raster = raster.rio.isel_window(self.window)
+        values = np.array(window_raster.values, dtype = np.result_type(window_raster.dtype, np.float32))
+        values[values == nodata] = np.nan
+        values[..., ~self.mask] = np.nan
+        return window_raster.copy(data = values)
+
+
+def geometry_key(geometry):
+    # stable hash of the geometries' WKB
+    digest = hashlib.sha1()
+    for geom in geometry:
+        digest.update(geom.wkb)
+    return digest.hexdigest()
+
+def rasterize_region(raster, geometry, window):
+    # polygon mask on the window, shrunk to the rows / cols the region covers,
+    # which is the extent rio.clip(..., drop = True) keeps
+    window_transform = windows.transform(window, raster.rio.transform())
+    mask = geometry_mask(
+        geometry, out_shape = (int(window.height), int(window.width)),
+        transform = window_transform, invert = True)
+    rows = np.flatnonzero(mask.any(axis = 1))
+    cols = np.flatnonzero(mask.any(axis = 0))
+    if len(rows) == 0:
+        raise ValueError('Region does not overlap the raster.')
+    r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    region_window = windows.Window(window.col_off + c0, window.row_off + r0, c1 - c0, r1 - r0)
+    return RegionMask(region_window, mask[r0:r1, c0:c1])
+
+
+class MaskCache(NpzCache):
+    def __init__(self, cache_dir: str = None):
+        super().__init__(cache_dir, prefix = 'region_mask')
+
+    def key(self, raster, geometry):
+
+        transform = tuple(raster.rio.transform())[:6]
+        shape = (raster.rio.height, raster.rio.width)
+        return (geometry_key(geometry), transform, shape)
+
+    def get(self, raster, geometry, window = None):
+        # window: optional starting window around the geometry (see prism_io.bbox_window)
+        def compute():
+            full = windows.Window(0, 0, raster.rio.width, raster.rio.height)
+            return rasterize_region(raster, geometry, window if window is not None else full)
+
+        def encode(region_mask):
+            w = region_mask.window
+            return {'window': [w.col_off, w.row_off, w.width, w.height], 'mask': region_mask.mask}
+
+        def decode(arrays):
+            return RegionMask(windows.Window(*arrays['window']), arrays['mask'])
+
+        return self.cached(self.key(raster, geometry), compute, encode, decode)
+
+
+_default_mask_cache = MaskCache()
+
+def get_default_mask_cache():
+
+    return _default_mask_cache
+
+def set_default_mask_cache(mask_cache: MaskCache):
+    # e.g. set_default_mask_cache(MaskCache('/mnt/efs/region_masks')) to share masks across processes
+    global _default_mask_cache
+    _default_mask_cache = mask_cache
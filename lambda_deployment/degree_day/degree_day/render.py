@@ -0,0 +1,135 @@
+import zlib
+import struct
+import numpy as np
+
+### lightweight PNG rendering of GDD rasters
+# Maps values through a fixed colormap lookup table straight to a palette
+# (indexed color) PNG, one byte per pixel, encoded with zlib, so rendering
+# needs neither matplotlib nor a figure. NaN cells (outside the region) are
+# transparent. The optional legend is a color bar with min / mid / max labels
+# drawn with a built-in 3x5 pixel font.
+
+# viridis, sampled at 9 evenly spaced stops and interpolated to the table
+VIRIDIS = [
+    (68, 1, 84), (71, 44, 122), (59, 81, 139), (44, 113, 142), (33, 144, 141),
+    (39, 173, 129), (92, 200, 99), (170, 220, 50), (253, 231, 37)]
+
+# palette layout: N_COLORS colormap entries, then transparent, white and black
+N_COLORS = 253
+TRANSPARENT, WHITE, BLACK = N_COLORS, N_COLORS + 1, N_COLORS + 2
+
+GLYPHS = {
+    '0': ('111', '101', '101', '101', '111'), '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'), '3': ('111', '001', '111', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'), '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'), '7': ('111', '001', '001', '001', '001'),
+    '8': ('111', '101', '111', '101', '111'), '9': ('111', '101', '111', '001', '111'),
+    '.': ('000', '000', '000', '000', '010'), '-': ('000', '000', '111', '000', '000'),
+    ' ': ('000', '000', '000', '000', '000')}
+
+
+def colormap_palette(stops = VIRIDIS):
+    # (256, 3) uint8 PNG palette: the colormap, linear between the stops, then the fixed entries
+    stops = np.asarray(stops, dtype = float)
+    positions = np.linspace(0, 1, len(stops))
+    levels = np.linspace(0, 1, N_COLORS)
+    palette = np.zeros((256, 3), dtype = np.uint8)
+    for channel in range(3):
+        palette[:N_COLORS, channel] = np.round(np.interp(levels, positions, stops[:, channel]))
+    palette[WHITE] = 255
+    return palette
+
+_default_palette = colormap_palette()
+
+def color_index(values, vmin = None, vmax = None):
+    # (rows, cols) values -> (rows, cols) uint8 palette indices, nan transparent
+    values = np.asarray(values, dtype = np.float32)
+    finite = np.isfinite(values)
+    if vmin is None:
+        vmin = float(values[finite].min()) if finite.any() else 0.0
+    if vmax is None:
+        vmax = float(values[finite].max()) if finite.any() else 1.0
+    span = (vmax - vmin) or 1.0
+    scaled = np.clip((values - vmin) * ((N_COLORS - 1) / span), 0, N_COLORS - 1)
+    index = np.where(finite, scaled + 0.5, TRANSPARENT).astype(np.uint8)
+    return index, vmin, vmax
+
+def encode_png(index, palette = None, level: int = 1):
+    # (rows, cols) uint8 palette indices -> PNG bytes (8 bit indexed, no filtering)
+    if palette is None:
+        palette = _default_palette
+    rows, cols = index.shape
+    raw = np.zeros((rows, cols + 1), dtype = np.uint8) # leading filter byte per row
+    raw[:, 1:] = index
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    alpha = np.full(TRANSPARENT + 1, 255, dtype = np.uint8)
+    alpha[TRANSPARENT] = 0
+    header = struct.pack('>IIBBBBB', cols, rows, 8, 3, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'PLTE', palette.tobytes())
+            + chunk(b'tRNS', alpha.tobytes()) + chunk(b'IDAT', zlib.compress(raw.tobytes(), level))
+            + chunk(b'IEND', b''))
+
+def _format_label(value):
+
+    return f'{value:.0f}' if abs(value) >= 10 else f'{value:.1f}'
+
+def _draw_text(canvas, text, row, col, size = 2, color = BLACK):
+    # text with its top left corner at (row, col), clipped to the canvas
+    for char in text:
+        glyph = np.array([[c == '1' for c in line] for line in GLYPHS.get(char, GLYPHS[' '])])
+        pixels = np.kron(glyph, np.ones((size, size), dtype = bool))
+        target = canvas[row:row + pixels.shape[0], col:col + pixels.shape[1]]
+        target[pixels[:target.shape[0], :target.shape[1]]] = color
+        col += 4 * size
+
+def _legend(height, vmin, vmax, bar_width = 12, pad = 8, text_size = 2):
+    # white panel with a vertical color bar, max at the top
+    labels = [(vmax, 0.0), ((vmin + vmax) / 2, 0.5), (vmin, 1.0)]
+    text_width = max(len(_format_label(v)) for v, _ in labels) * 4 * text_size
+    panel = np.full((height, pad + bar_width + pad + text_width + pad), WHITE, dtype = np.uint8)
+    bar_top, bar_bottom = pad, height - pad
+    if bar_bottom - bar_top < 2:
+        return panel
+    levels = np.round(np.linspace(N_COLORS - 1, 0, bar_bottom - bar_top)).astype(np.uint8)
+    panel[bar_top:bar_bottom, pad:pad + bar_width] = levels[:, None]
+    text_col = pad + bar_width + pad
+    for value, position in labels:
+        tick_row = bar_top + int(round(position * (bar_bottom - bar_top - 1)))
+        text_row = min(max(tick_row - 5 * text_size // 2, 0), height - 5 * text_size)
+        panel[tick_row, pad + bar_width:text_col - 2] = BLACK
+        _draw_text(panel, _format_label(value), text_row, text_col, text_size)
+    return panel
+
+def render_png(
+    raster,
+    vmin: float = None,
+    vmax: float = None,
+    scale: int = 1, # integer upscaling, each cell becomes scale x scale pixels
+    legend: bool = True,
+    palette: np.ndarray = None, # see colormap_palette
+):
+    # 2d array or DataArray (north up, or with an ascending y that gets flipped) -> PNG bytes
+    values = np.asarray(getattr(raster, 'values', raster))
+    if values.ndim != 2:
+        values = values.squeeze()
+    y = raster.coords.get('y') if hasattr(raster, 'coords') else None
+    if y is not None and len(y) > 1 and y.values[1] > y.values[0]:
+        values = values[::-1]
+    index, vmin, vmax = color_index(values, vmin, vmax)
+    if scale > 1:
+        index = np.repeat(np.repeat(index, scale, axis = 0), scale, axis = 1)
+    if legend:
+        height = max(index.shape[0], 64)
+        image = np.full((height, index.shape[1]), TRANSPARENT, dtype = np.uint8)
+        image[:index.shape[0]] = index
+        index = np.concatenate([image, _legend(height, vmin, vmax)], axis = 1)
+    return encode_png(index, palette)
+
+def write_png(path: str, raster, **kwargs):
+
+    with open(path, 'wb') as f:
+        f.write(render_png(raster, **kwargs))
+    return path
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from .upload import write_artifact, upload_artifacts
+
+### content-addressed cache of finished GDD artifacts
+# A result (raster, png, ...) depends only on its inputs, e.g. (date, state,
+# lt, ut, method), never on who asked for it. Results are stored under a hash
+# of those inputs in two layers:
+# - local: a directory (e.g. on EFS), one sub directory per result, evicted by
+#   TTL and least recently used first once it grows past max_bytes; optional,
+#   since on /tmp it would put every artifact back on local disk
+# - shared: an object store prefix (S3) that every execution environment sees
+# A hit is published to the caller's own keys with a server-side copy, so
+# nothing is recomputed, downloaded or re-uploaded.
+# Shared objects older than the TTL are misses, but requests never delete
+# them: the prefix is trimmed by a bucket lifecycle rule (set once with
+# apply_shared_lifecycle) or by sweep_shared from a scheduled job.
+
+
+class ResultCache:
+    def __init__(
+        self,
+        cache_dir: str, # None for no local layer
+        s3_client = None, # boto3 s3 client for the shared layer, None for local only
+        bucket: str = None,
+        prefix: str = 'gdd_cache',
+        max_bytes: int = 2 * 1024 ** 3,
+        ttl: float = None, # seconds, None to keep results until evicted by size
+    ):
+        self.cache_dir = cache_dir
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok = True)
+
+    @staticmethod
+    def key(**params):
+        # stable hash of the inputs that determine a result
+        return hashlib.sha1(json.dumps(params, sort_keys = True, default = str).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+
+        return os.path.join(self.cache_dir, key)
+
+    def _shared_key(self, key, name):
+
+        return f'{self.prefix}/{key}/{name}'
+
+    def _count(self, stat):
+
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _expired(self, entry_dir):
+
+        if self.ttl is None:
+            return False
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                created = json.load(f)['created']
+        except (OSError, ValueError, KeyError):
+            return True
+        return time.time() - created > self.ttl
+
+    def get_local(self, key, names: list):
+        # {name: path} when every artifact is in the local layer, else None
+        if self.cache_dir is None:
+            return None
+        entry_dir = self._entry_dir(key)
+        paths = {name: os.path.join(entry_dir, name) for name in names}
+        if not all(os.path.isfile(path) for path in paths.values()) or self._expired(entry_dir):
+            return None
+        os.utime(entry_dir) # mark as recently used
+        return paths
+
+    def _has_shared(self, key, names: list):
+
+        if self.s3_client is None:
+            return False
+        for name in names:
+            try:
+                head = self.s3_client.head_object(Bucket = self.bucket, Key = self._shared_key(key, name))
+            except self.s3_client.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                    return False
+                raise
+            if (self.ttl is not None) and time.time() - head['LastModified'].timestamp() > self.ttl:
+                return False # expired, recomputed and overwritten
+        return True
+
+    def lookup(self, key, names: list):
+        # 'local', 'shared' or None (miss), counted in self.stats
+        if self.get_local(key, names) is not None:
+            self._count('local_hits')
+            return 'local'
+        if self._has_shared(key, names):
+            self._count('shared_hits')
+            return 'shared'
+        self._count('misses')
+        return None
+
+    def put(self, key, files: dict, **params):
+        # files: {name: path or bytes}; stores the artifacts in both layers
+        self.put_local(key, files, **params)
+        self.put_shared(key, files)
+
+    def put_local(self, key, files: dict, **params):
+        # assemble the entry in a temp dir and rename it into place, so readers
+        # never see a partial entry
+        if self.cache_dir is None:
+            return
+        entry_dir = self._entry_dir(key)
+        tmp_dir = os.path.join(self.cache_dir, f'.{key}.{uuid.uuid4().hex}.tmp')
+        os.makedirs(tmp_dir)
+        for name, artifact in files.items():
+            write_artifact(artifact, os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'created': time.time(), 'params': params}, f, default = str)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors = True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another writer won the race with the same result
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+        self.evict()
+
+    def put_shared(self, key, files: dict):
+
+        if self.s3_client is None:
+            return
+        upload_artifacts(self.s3_client, self.bucket, {self._shared_key(key, name): artifact for name, artifact in files.items()})
+
+    def publish(self, key, dest_keys: dict, bucket: str = None):
+        # dest_keys: {name: destination key}. Server-side copy from the shared
+        # layer, restoring it from the local layer if it was cleared.
+        bucket = bucket or self.bucket
+        for name, dest_key in dest_keys.items():
+            source = {'Bucket': self.bucket, 'Key': self._shared_key(key, name)}
+            try:
+                self.s3_client.copy_object(CopySource = source, Bucket = bucket, Key = dest_key)
+            except self.s3_client.exceptions.ClientError as e:
+                local_files = self.get_local(key, [name])
+                if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey') or local_files is None:
+                    raise
+                self.put_shared(key, local_files)
+                self.s3_client.copy_object(CopySource = source, Bucket = bucket, Key = dest_key)
+
+    def evict(self):
+        # drop expired entries, then least recently used ones until under max_bytes
+        if self.cache_dir is None:
+            return
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry)
+            if entry.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            if self._expired(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors = True)
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except OSError:
+                continue # removed by another process meanwhile
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            total -= size
+
+    def sweep_shared(self, max_age: float = None):
+        # delete shared objects older than max_age seconds (default the TTL);
+        # returns the number deleted
+        max_age = self.ttl if max_age is None else max_age
+        if self.s3_client is None or max_age is None:
+            return 0
+        expired = []
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket = self.bucket, Prefix = f'{self.prefix}/'):
+            for obj in page.get('Contents', []):
+                if time.time() - obj['LastModified'].timestamp() > max_age:
+                    expired.append({'Key': obj['Key']})
+        for i in range(0, len(expired), 1000): # delete_objects takes up to 1000 keys
+            self.s3_client.delete_objects(Bucket = self.bucket, Delete = {'Objects': expired[i:i + 1000], 'Quiet': True})
+        return len(expired)
+
+    def apply_shared_lifecycle(self, days: int, rule_id: str = None):
+        # expire the shared prefix after days with a bucket lifecycle rule,
+        # keeping the bucket's other rules; needs s3:PutLifecycleConfiguration
+        rule_id = rule_id or f'{self.prefix}-expiry'
+        try:
+            rules = self.s3_client.get_bucket_lifecycle_configuration(Bucket = self.bucket)['Rules']
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchLifecycleConfiguration':
+                raise
+            rules = []
+        rules = [rule for rule in rules if rule.get('ID') != rule_id]
+        rules.append({
+            'ID': rule_id, 'Status': 'Enabled', 'Filter': {'Prefix': f'{self.prefix}/'},
+            'Expiration': {'Days': int(days)}, 'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': 1}})
+        self.s3_client.put_bucket_lifecycle_configuration(Bucket = self.bucket, LifecycleConfiguration = {'Rules': rules})
+        return rule_id
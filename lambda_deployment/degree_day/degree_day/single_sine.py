@@ -0,0 +1,124 @@
+import numpy as np
+
+### closed-form single sine degree day kernels (Baskerville & Emin 1969)
+# The daily temperature curve is a sine with amplitude amp = (tmax - tmin) / 2
+# around mean = (tmax + tmin) / 2 and a one-day period, matching
+# DegreeDayCalculator.sin_curve_fxn. Each case below is the exact value of the
+# definite integrals the sympy setup used to derive, so no symbolic work is
+# needed at runtime. All functions accept scalars or numpy arrays.
+
+
+def sin_curve(temp_min, temp_max, t):
+
+    amp = (temp_max - temp_min) / 2
+    return amp * np.sin(2 * np.pi * t - (np.pi / 2)) + temp_min + amp
+
+def sine_params(temp_min, temp_max):
+
+    mean = (temp_max + temp_min) / 2
+    amp = (temp_max - temp_min) / 2
+    return mean, amp
+
+def threshold_angle(mean, amp, thresh):
+    # phase angle where the sine crosses thresh, in [-pi/2, pi/2]
+    return np.arcsin(np.clip((thresh - mean) / amp, -1, 1))
+
+def area_above(mean, amp, thresh, theta = None):
+    # degree days above thresh: area between the sine and thresh where sine > thresh
+    if theta is None:
+        theta = threshold_angle(mean, amp, thresh)
+    return ((mean - thresh) * (np.pi / 2 - theta) + amp * np.cos(theta)) / np.pi
+
+def degree_days(mean, amp, low_thresh, upp_thresh, area_cache = None):
+    # all six cases at once: because threshold_angle clips to [-pi/2, pi/2],
+    # area_above is mean - thresh below temp_min and 0 above temp_max, so the
+    # difference of the two areas covers every case. area_cache maps
+    # thresh -> area_above so several threshold pairs can share the work
+    if area_cache is None:
+        area_cache = {}
+    for thresh in (low_thresh, upp_thresh):
+        if thresh not in area_cache:
+            area_cache[thresh] = area_above(mean, amp, thresh)
+    return area_cache[low_thresh] - area_cache[upp_thresh]
+
+# The cases (argument order matches the former lambdified functions)
+# 1. upper threshold below temp_min
+def case1(low_thresh, upp_thresh):
+
+    return upp_thresh - low_thresh
+
+# 2. lower threshold above temp_max
+# dd = 0 hardcode
+
+# 3. upper threshold above temp_max, lower threshold below temp_min
+def case3(temp_min, temp_max, low_thresh):
+
+    mean, _ = sine_params(temp_min, temp_max)
+    return mean - low_thresh
+
+# 4. upper threshold above temp_max, lower threshold above temp_min
+def case4(temp_min, temp_max, low_thresh):
+
+    mean, amp = sine_params(temp_min, temp_max)
+    return area_above(mean, amp, low_thresh)
+
+# 5. upper threshold below temp_max, lower threshold below temp_min
+def case5(temp_min, temp_max, low_thresh, upp_thresh):
+
+    mean, amp = sine_params(temp_min, temp_max)
+    return mean - low_thresh - area_above(mean, amp, upp_thresh)
+
+# 6. upper threshold below temp_max, lower threshold above temp_min
+def case6(temp_min, temp_max, low_thresh, upp_thresh):
+
+    mean, amp = sine_params(temp_min, temp_max)
+    return area_above(mean, amp, low_thresh) - area_above(mean, amp, upp_thresh)
+
+
+def derive_sympy_kernels():
+    ### reference derivation of the six cases with sympy (dev only, slow)
+    # returns lambdified functions with the same signatures as case1 ... case6
+    # so the closed forms above can be checked against the symbolic integrals
+    # (tests/test_single_sine.py). The Abs() terms assume the area under the
+    # sine is positive, so with negative thresholds on a day that stays below
+    # 0 these expressions are wrong; the closed forms are not.
+    from sympy import symbols, sin, Abs, pi, integrate, solve, lambdify
+
+    temp_min, temp_max, upp_thresh, low_thresh, t, l_bnd, u_bnd = symbols('temp_min temp_max upp_thresh low_thresh t l_bnd, u_bnd', real = True)
+
+    # a sin curve with temp-range amplitude and one-day period
+    amp = (temp_max - temp_min) / 2
+    sin_curve = amp * sin(2 * pi * t - (pi / 2)) + temp_min + amp
+
+    # definite integral wrt time t
+    sin_intgr = integrate(sin_curve, (t, l_bnd, u_bnd))
+
+    # values of t when sin(t) intersects lower / upper threshold
+    low_thresh_intersect = solve(sin_curve - low_thresh, t)
+    upp_thresh_intersect = solve(sin_curve - upp_thresh, t)
+
+    # integral of sin between intersections with lower / upper threshold
+    sin_low_intersect_intgr = (Abs(sin_intgr
+                                .subs(l_bnd, low_thresh_intersect[0])
+                                .subs(u_bnd, low_thresh_intersect[1])))
+    sin_upp_intersect_intgr = (Abs(sin_intgr
+                                .subs(l_bnd, upp_thresh_intersect[0])
+                                .subs(u_bnd, upp_thresh_intersect[1])))
+
+    # area of rectangle below lower / upper threshold between intersections
+    low_intersect_rect = low_thresh * Abs(low_thresh_intersect[0] - low_thresh_intersect[1])
+    upp_intersect_rect = upp_thresh * Abs(upp_thresh_intersect[0] - upp_thresh_intersect[1])
+
+    dd_case1_exp = upp_thresh - low_thresh
+    dd_case3_exp = sin_intgr.subs(l_bnd, 0).subs(u_bnd, 1) - low_thresh
+    dd_case4_exp = sin_low_intersect_intgr - low_intersect_rect
+    dd_case5_exp = dd_case3_exp - sin_upp_intersect_intgr + upp_intersect_rect
+    dd_case6_exp = dd_case4_exp - sin_upp_intersect_intgr + upp_intersect_rect
+
+    return {
+        'case1': lambdify([low_thresh, upp_thresh], dd_case1_exp, 'numpy'),
+        'case3': lambdify([temp_min, temp_max, low_thresh], dd_case3_exp, 'numpy'),
+        'case4': lambdify([temp_min, temp_max, low_thresh], dd_case4_exp, 'numpy'),
+        'case5': lambdify([temp_min, temp_max, low_thresh, upp_thresh], dd_case5_exp, 'numpy'),
+        'case6': lambdify([temp_min, temp_max, low_thresh, upp_thresh], dd_case6_exp, 'numpy'),
+    }
@@ -0,0 +1,60 @@
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+### in-memory artifacts and concurrent uploads to object storage
+# An artifact is either bytes (serialized in memory) or a path (spilled to
+# disk because it was too large to hold in memory, or because no in-memory
+# NetCDF writer is installed). Uploads stream from either with multipart
+# transfers, all artifacts at once.
+
+
+def netcdf_artifact(obj, spill_path: str, max_memory_bytes: int = 256 * 1024 ** 2):
+    # NetCDF bytes of a DataArray / Dataset, or spill_path after writing it there.
+    # In-memory writing goes through h5netcdf (pip install degree_day[h5netcdf]).
+    if obj.nbytes <= max_memory_bytes:
+        try:
+            buffer = io.BytesIO()
+            obj.to_netcdf(buffer, engine = 'h5netcdf')
+            return buffer.getvalue()
+        except ImportError:
+            pass
+    os.makedirs(os.path.dirname(spill_path), exist_ok = True)
+    obj.to_netcdf(spill_path)
+    return spill_path
+
+def artifact_size(artifact):
+
+    return len(artifact) if isinstance(artifact, (bytes, bytearray)) else os.path.getsize(artifact)
+
+def open_artifact(artifact):
+    # binary file object over the artifact
+    if isinstance(artifact, (bytes, bytearray)):
+        return io.BytesIO(artifact)
+    return open(artifact, 'rb')
+
+def write_artifact(artifact, path: str):
+
+    if isinstance(artifact, (bytes, bytearray)):
+        with open(path, 'wb') as f:
+            f.write(artifact)
+    else:
+        shutil.copyfile(artifact, path)
+
+def upload_artifacts(s3_client, bucket: str, artifacts: dict, max_workers: int = 4, transfer_config = None):
+    # artifacts: {key: artifact}; uploaded concurrently, each as a multipart
+    # stream once above the transfer config's threshold (boto3 default 8 MB)
+    def upload(key, artifact):
+        with open_artifact(artifact) as fileobj:
+            if transfer_config is None:
+                s3_client.upload_fileobj(fileobj, bucket, key)
+            else:
+                s3_client.upload_fileobj(fileobj, bucket, key, Config = transfer_config)
+
+    if len(artifacts) == 0:
+        return
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(artifacts))) as pool:
+        futures = [pool.submit(upload, key, artifact) for key, artifact in artifacts.items()]
+        for f in futures:
+            f.result()
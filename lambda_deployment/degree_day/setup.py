@@ -6,5 +6,6 @@ setup(
     version='0.1.0',
     description='Library of functions to compute and work with degree day phenology models',
     author='Tim Farkas',
-    install_requires=['sympy', 'numpy', 'pandas', 'geopandas', 'pyyaml', 'xarray', 'rioxarray'],
+    extras_require={'dev': ['sympy', 'pytest'], 'dask': ['dask'], 'h5netcdf': ['h5netcdf']},
+    install_requires=['numpy', 'pandas', 'geopandas', 'pyyaml', 'xarray', 'rioxarray', 'netCDF4'],
 )
\ No newline at end of file
@@ -0,0 +1,282 @@
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+### shared fixtures: a small on-disk PRISM archive
+# PRISM-like .bil zips for a few days on a 20 x 30 grid, laid out the way
+# pull_PRISM_data leaves them (<prism_dir>/<date>/<var>/<date>_<var>.zip),
+# so cube builders find every day cached and never go to the network, and a
+# bbox file covering the middle of the grid.
+
+N_ROWS, N_COLS = 20, 30
+RES = 1 / 24
+ULX, ULY = -120.0, 45.0
+PRJ = 'GEOGCS["NAD83",DATUM["North_American_Datum_1983",SPHEROID["GRS 1980",6378137,298.257222101]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'
+
+
+def write_prism_zip(zip_file, stem, values):
+    # one PRISM .bil (with .hdr / .prj) zipped as <stem>.*
+    header = '\n'.join([
+        'BYTEORDER I', 'LAYOUT BIL', f'NROWS {N_ROWS}', f'NCOLS {N_COLS}', 'NBANDS 1', 'NBITS 32',
+        'PIXELTYPE FLOAT', f'ULXMAP {ULX + RES / 2}', f'ULYMAP {ULY - RES / 2}', f'XDIM {RES}', f'YDIM {RES}',
+        'NODATA -9999'])
+    os.makedirs(os.path.dirname(zip_file), exist_ok = True)
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr(f'{stem}.bil', values.astype('<f4').tobytes())
+        z.writestr(f'{stem}.hdr', header)
+        z.writestr(f'{stem}.prj', PRJ)
+
+def write_prism_day(prism_dir, target_date, tmin, tmax):
+
+    for var, values in (('tmin', tmin), ('tmax', tmax)):
+        zip_file = os.path.join(prism_dir, target_date, var, f'{target_date}_{var}.zip')
+        write_prism_zip(zip_file, f'prism_{var}_us_30s_{target_date}', values)
+
+@pytest.fixture
+def prism_archive(tmp_path):
+    # (prism_dir, bbox_file, dates) with ten days from 2024-01-01
+    prism_dir = str(tmp_path / 'prism')
+    dates = list(pd.date_range('2024-01-01', periods = 10).to_pydatetime())
+    rng = np.random.default_rng(0)
+    for date in dates:
+        tmin = 5 + 10 * rng.random((N_ROWS, N_COLS))
+        write_prism_day(prism_dir, date.strftime('%Y%m%d'), tmin, tmin + 5 + 10 * rng.random((N_ROWS, N_COLS)))
+    bbox_file = str(tmp_path / 'bbox.geojson')
+    geometry = box(ULX + 5 * RES, ULY - 15 * RES, ULX + 25 * RES, ULY - 5 * RES)
+    gpd.GeoDataFrame(geometry = [geometry], crs = 'EPSG:4269').to_file(bbox_file)
+    return prism_dir, bbox_file, dates
+
+
+### a filesystem-backed S3 stand-in
+# Path-style S3 over HTTP with objects kept as files under a directory (their
+# mtime is LastModified, so tests can age them), enough of the API for a real
+# boto3 client: put / get / head / copy, multipart uploads, ListObjectsV2,
+# DeleteObjects and bucket lifecycle configuration. PUTs are slowed down a
+# little and counted while in flight, so concurrent uploads are observable.
+
+import time
+import shutil
+import threading
+import email.utils
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+
+
+class _S3(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+
+        pass
+
+    def _send(self, status, body = b'', headers = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+
+        self._send(status, f'<Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode())
+
+    def _target(self):
+        # (bucket, key, query)
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, parse_qs(url.query, keep_blank_values = True)
+
+    def _file(self, bucket, key):
+
+        return os.path.join(self.server.root, bucket, key)
+
+    def _body(self):
+
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _store(self, bucket, key, body):
+
+        path = self._file(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def do_GET(self):
+        bucket, key, query = self._target()
+        if 'lifecycle' in query:
+            if bucket not in self.server.lifecycle:
+                return self._error(404, 'NoSuchLifecycleConfiguration')
+            return self._send(200, self.server.lifecycle[bucket])
+        if key == '' and 'list-type' in query:
+            prefix = query.get('prefix', [''])[0]
+            root = os.path.join(self.server.root, bucket)
+            contents = []
+            for d, _, files in os.walk(root):
+                for name in files:
+                    path = os.path.join(d, name)
+                    obj_key = os.path.relpath(path, root).replace(os.sep, '/')
+                    if obj_key.startswith(prefix):
+                        modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(os.path.getmtime(path)))
+                        contents.append(
+                            f'<Contents><Key>{obj_key}</Key><LastModified>{modified}</LastModified>'
+                            f'<ETag>"stub"</ETag><Size>{os.path.getsize(path)}</Size></Contents>')
+            body = (
+                f'<ListBucketResult><Name>{bucket}</Name><Prefix>{prefix}</Prefix><KeyCount>{len(contents)}</KeyCount>'
+                f'<MaxKeys>1000</MaxKeys><IsTruncated>false</IsTruncated>{"".join(sorted(contents))}</ListBucketResult>')
+            return self._send(200, body.encode())
+        path = self._file(bucket, key)
+        if not os.path.isfile(path):
+            return self._error(404, 'NoSuchKey')
+        with open(path, 'rb') as f:
+            body = f.read()
+        self._send(200, body, {'Last-Modified': email.utils.formatdate(os.path.getmtime(path), usegmt = True), 'ETag': '"stub"'})
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        if 'lifecycle' in query:
+            self.server.lifecycle[bucket] = body
+            return self._send(200)
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(self.server.put_delay)
+            if 'uploadId' in query:
+                self.server.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = body
+                return self._send(200, headers = {'ETag': '"stub"'})
+            copy_source = self.headers.get('x-amz-copy-source')
+            if copy_source is not None:
+                source_bucket, _, source_key = unquote(copy_source).lstrip('/').partition('/')
+                source = self._file(source_bucket, source_key)
+                if not os.path.isfile(source):
+                    return self._error(404, 'NoSuchKey')
+                os.makedirs(os.path.dirname(self._file(bucket, key)), exist_ok = True)
+                shutil.copyfile(source, self._file(bucket, key))
+                return self._send(200, b'<CopyObjectResult><ETag>"stub"</ETag><LastModified>2024-01-01T00:00:00.000Z</LastModified></CopyObjectResult>')
+            self._store(bucket, key, body)
+            self.server.puts.append(key)
+            self._send(200, headers = {'ETag': '"stub"'})
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def do_POST(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        if 'delete' in query:
+            for element in ET.fromstring(body).iter():
+                if element.tag.split('}')[-1] == 'Key' and os.path.isfile(self._file(bucket, element.text)):
+                    os.remove(self._file(bucket, element.text))
+            return self._send(200, b'<DeleteResult></DeleteResult>')
+        if 'uploads' in query:
+            with self.server.lock:
+                upload_id = str(len(self.server.multipart) + len(self.server.uploads))
+                self.server.uploads[upload_id] = {}
+            return self._send(200, (
+                f'<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>').encode())
+        parts = self.server.uploads.pop(query['uploadId'][0])
+        self._store(bucket, key, b''.join(parts[n] for n in sorted(parts)))
+        self.server.multipart.append((key, len(parts)))
+        self._send(200, b'<CompleteMultipartUploadResult><ETag>"stub"</ETag></CompleteMultipartUploadResult>')
+
+
+@pytest.fixture
+def s3(tmp_path):
+    # (boto3 client, server) against the stand-in, with bucket 'test'
+    boto3 = pytest.importorskip('boto3')
+    from botocore.config import Config
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _S3)
+    server.daemon_threads = True
+    server.root = str(tmp_path / 's3')
+    server.lock = threading.Lock()
+    server.lifecycle = {}
+    server.uploads = {}
+    server.multipart = [] # (key, number of parts) of completed multipart uploads
+    server.puts = [] # keys of single-request uploads
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.put_delay = 0.0
+    os.makedirs(os.path.join(server.root, 'test'))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    client = boto3.client(
+        's3', endpoint_url = f'http://127.0.0.1:{server.server_address[1]}', region_name = 'us-east-1',
+        aws_access_key_id = 'stub', aws_secret_access_key = 'stub',
+        config = Config(s3 = {'addressing_style': 'path'}, request_checksum_calculation = 'when_required',
+                        response_checksum_validation = 'when_required', retries = {'max_attempts': 1}))
+    yield client, server
+    server.shutdown()
+    server.server_close()
+
+def age_object(server, bucket, key, seconds):
+    # move an object's LastModified back by seconds
+    path = os.path.join(server.root, bucket, key)
+    mtime = os.path.getmtime(path) - seconds
+    os.utime(path, (mtime, mtime))
+
+
+### synthetic GDD cubes and normals on the same grid
+# Daily GDD with a block of nan cells in the corner (outside the region), as
+# a GddCubeStore cube or a ClimatologyStore with the daily GDD of some pests.
+
+OUTSIDE = (slice(0, 4), slice(0, 6))
+
+
+def grid_template(dtype = np.float32):
+    # zero (y, x) raster on the cell centres of the PRISM fixtures' grid
+    import xarray as xra
+    return xra.DataArray(
+        np.zeros((N_ROWS, N_COLS), dtype = dtype), dims = ('y', 'x'),
+        coords = {'y': ULY - RES * (np.arange(N_ROWS) + 0.5), 'x': ULX + RES * (np.arange(N_COLS) + 0.5)})
+
+def daily_gdd(n_dates, seed = 0, high = 12):
+
+    values = (high * np.random.default_rng(seed).random((n_dates, N_ROWS, N_COLS))).astype(np.float32)
+    values[(slice(None),) + OUTSIDE] = np.nan
+    return values
+
+def write_gdd_cube(cube_file, dates, values):
+
+    from degree_day.cube_store import GddCubeStore
+    GddCubeStore(cube_file).write_block(0, pd.DatetimeIndex(dates), values, template = grid_template(values.dtype))
+    return cube_file
+
+def write_climatology_store(store_file, pest_params, daily):
+    # daily: {pest: (366, y, x) normal daily GDD on the leap calendar}
+    from degree_day.climatology import ClimatologyStore
+    store = ClimatologyStore(store_file)
+    store.create(grid_template())
+    pests = list(daily.keys())
+    positions = store.set_pests(pest_params, pests)
+    gdd = np.stack([daily[pest] for pest in pests])
+    store.write_pest_block('gdd', positions, 0, gdd)
+    store.write_pest_block('gdd_cumsum', positions, 0, np.cumsum(np.nan_to_num(gdd), axis = 1, dtype = np.float64))
+    return store
+
+def write_normals(kind, root, normal, start_day = '01-01'):
+    # (normals argument, pest, daily GDD of 'mmdd') for normal, (366, y, x) on
+    # the leap calendar: kind 'store' is a ClimatologyStore with the pest
+    # 'pest', 'cube_<year>' a normals cube of that year, whose 02-29 adds
+    # nothing in a normal year
+    from degree_day.climatology import DAYS
+    if kind == 'store':
+        store = write_climatology_store(
+            os.path.join(root, 'climatology.nc'), {'pest': {'lt': 10, 'ut': 30, 'start_date': start_day}}, {'pest': normal})
+        return store, 'pest', lambda day: normal[DAYS.index(day)]
+    year = int(kind[-4:])
+    dates = pd.date_range(f'{year}-01-01', f'{year}-12-31')
+    days = set(dates.strftime('%m%d'))
+    normals_file = write_gdd_cube(
+        os.path.join(root, f'normals_{year}.nc'), dates, normal[[DAYS.index(day) for day in dates.strftime('%m%d')]])
+    return normals_file, None, lambda day: normal[DAYS.index(day)] if day in days else np.zeros(normal.shape[1:])
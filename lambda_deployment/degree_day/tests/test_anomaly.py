@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+import pytest
+from degree_day.anomaly import departure_layer, update_anomaly_cubes
+from degree_day.climatology import DAYS
+from degree_day.cube_store import GddCubeStore
+from conftest import daily_gdd, grid_template, write_gdd_cube, write_normals
+
+### anomaly and percent-of-normal cubes against sums over the daily cubes
+# The observed cube crosses a new year, so seasons restart on Jan 1, and the
+# normals come from a ClimatologyStore or from normals cubes of a leap and a
+# normal year.
+
+NORMAL = daily_gdd(len(DAYS), seed = 5, high = 8) # leap calendar
+
+
+def _reference(obs_dates, observed, normal_of, dates, start_day):
+    # (anomaly, percent) of GDD accumulated since each date's season start
+    month, day = [int(x) for x in start_day.split('-')]
+    anomaly, percent = [], []
+    for date in dates:
+        start = max(pd.Timestamp(date.year, month, day), obs_dates[0])
+        in_season = (obs_dates >= start) & (obs_dates <= date)
+        obs_acc = np.nan_to_num(observed[in_season]).sum(axis = 0, dtype = np.float64)
+        normal_acc = sum((np.nan_to_num(normal_of(d)).astype(np.float64) for d in pd.date_range(start, date).strftime('%m%d')),
+                         np.zeros(observed.shape[1:]))
+        anomaly.append(obs_acc - normal_acc)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            percent.append(np.where(normal_acc > 0, 100 * obs_acc / normal_acc, np.nan))
+    return np.array(anomaly), np.array(percent)
+
+def _assert_matches(anomaly_file, percent_file, obs_dates, observed, normal_of, start_day):
+
+    anomaly, percent = xra.load_dataarray(anomaly_file), xra.load_dataarray(percent_file)
+    assert list(anomaly.date.values) == list(percent.date.values) == list(obs_dates)
+    expected_anomaly, expected_percent = _reference(obs_dates, observed, normal_of, obs_dates, start_day)
+    np.testing.assert_allclose(anomaly.values, expected_anomaly, rtol = 1e-5, atol = 1e-3)
+    np.testing.assert_allclose(percent.values, expected_percent, rtol = 1e-5, atol = 1e-4)
+    assert np.isnan(percent.values).any() and not np.isnan(percent.values).all()
+
+
+@pytest.mark.parametrize('kind', ['store', 'cube_2024', 'cube_2023'])
+@pytest.mark.parametrize('first_date, start_day', [('2023-12-25', '01-01'), ('2023-12-25', '02-10'), ('2022-12-25', '02-10')])
+def test_anomaly_matches_sums(tmp_path, kind, first_date, start_day):
+    obs_dates = pd.date_range(first_date, periods = 72) # through Feb 29 / Mar 1 - Mar 5
+    observed = daily_gdd(len(obs_dates), seed = 1)
+    cube_file = write_gdd_cube(str(tmp_path / 'cube.nc'), obs_dates, observed)
+    normals, pest, normal_of = write_normals(kind, str(tmp_path), NORMAL, start_day)
+    anomaly_file, percent_file = update_anomaly_cubes(
+        cube_file, normals, pest = pest, start_day = None if kind == 'store' else start_day, chunk_days = 16)
+    _assert_matches(anomaly_file, percent_file, obs_dates, observed, normal_of, start_day)
+
+    anomaly, percent = departure_layer(cube_file, normals, '2024-01-20' if first_date > '2023' else '2023-01-20', pest = pest, start_day = start_day)
+    expected = xra.load_dataarray(anomaly_file).sel(date = anomaly.date.values)
+    np.testing.assert_array_equal(anomaly.values, expected.values)
+    with pytest.raises(ValueError, match = 'not in the cube'):
+        departure_layer(cube_file, normals, '2025-01-01', pest = pest, start_day = start_day)
+
+def test_update_recomputes_from_the_first_changed_date(tmp_path):
+    obs_dates = pd.date_range('2024-01-01', periods = 60)
+    observed = daily_gdd(len(obs_dates), seed = 2)
+    cube_file = write_gdd_cube(str(tmp_path / 'cube.nc'), obs_dates[:40], observed[:40])
+    normals, _, normal_of = write_normals('cube_2024', str(tmp_path), NORMAL, '01-01')
+    anomaly_file, percent_file = update_anomaly_cubes(cube_file, normals, chunk_days = 8)
+    first_written = GddCubeStore(anomaly_file).written_at()
+    update_anomaly_cubes(cube_file, normals) # nothing changed, nothing written
+    assert (GddCubeStore(anomaly_file).written_at() == first_written).all()
+
+    # new days appended and an earlier day patched
+    cube_store = GddCubeStore(cube_file)
+    for i in range(40, 60):
+        cube_store.append(grid_template().copy(data = observed[i]), date = obs_dates[i])
+    observed[25] = daily_gdd(1, seed = 3)[0]
+    cube_store.write(grid_template().copy(data = observed[25]), date = obs_dates[25])
+    update_anomaly_cubes(cube_file, normals, chunk_days = 8)
+    _assert_matches(anomaly_file, percent_file, obs_dates, observed, normal_of, '01-01')
+    written = GddCubeStore(anomaly_file).written_at()
+    assert (written.iloc[:25] == first_written.iloc[:25]).all()
+    assert (written.iloc[25:40] > first_written.iloc[25:40]).all()
+
+    # other normals start the outputs over
+    other_normals, _, other_normal_of = write_normals('cube_2023', str(tmp_path), NORMAL, '01-01')
+    update_anomaly_cubes(cube_file, other_normals)
+    _assert_matches(anomaly_file, percent_file, obs_dates, observed, other_normal_of, '01-01')
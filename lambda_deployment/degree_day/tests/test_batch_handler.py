@@ -0,0 +1,176 @@
+import os
+import io
+import sys
+import json
+import zipfile
+import threading
+import importlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xarray as xra
+import pytest
+from shapely.geometry import Polygon
+from degree_day.degree_day import DegreeDayCalculator
+from degree_day.prism_cache import PrismCache
+from degree_day.prism_io import load_prism_raster
+from conftest import N_ROWS, N_COLS, RES, ULX, ULY
+
+### lambda_function.batch_handler against the S3 stand-in
+# PRISM is replaced by a downloader writing synthetic netCDF zips (a different
+# grid per date), so the cube published to S3 can be compared with the
+# calculator run day by day on the same clipped rasters.
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'lambda_deployment')
+STATE = 'Teststate'
+THRESHOLDS = [(10, 30), (5, 25)]
+
+
+def _grid(var, date):
+
+    rng = np.random.default_rng(int(date))
+    tmin = 5 + 10 * rng.random((N_ROWS, N_COLS))
+    return tmin if var == 'tmin' else tmin + 5 + 10 * rng.random((N_ROWS, N_COLS))
+
+def _write_netcdf_zip(zip_file, var, date):
+    # PRISM's zip layout: one netCDF member per day and variable
+    from rasterio.io import MemoryFile
+    from rasterio.shutil import copy as rio_copy
+    from rasterio.transform import from_origin
+
+    # the netCDF driver only supports CreateCopy to a real file, so write through an in-memory GeoTIFF
+    nc_file = f'{zip_file}.nc'
+    with MemoryFile() as mem_file:
+        with mem_file.open(
+            driver = 'GTiff', width = N_COLS, height = N_ROWS, count = 1, dtype = 'float32',
+            crs = 'EPSG:4269', transform = from_origin(ULX, ULY, RES, RES), nodata = -9999) as dst:
+            dst.write(_grid(var, date).astype('float32'), 1)
+        with mem_file.open() as src:
+            rio_copy(src, nc_file, driver = 'netCDF')
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.write(nc_file, f'PRISM_{var}_stable_4kmD2_{date}_nc.nc')
+    os.remove(nc_file)
+
+
+class _Downloader:
+    # serves _write_netcdf_zip, fails for the dates in failing, and counts fetches
+    def __init__(self, failing = ()):
+        self.failing = set(failing)
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def fetch(self, url, dest_file, var = None, date = None):
+        with self.lock:
+            self.fetched.append((var, date))
+        if date in self.failing:
+            return False
+        os.makedirs(os.path.dirname(dest_file), exist_ok = True)
+        _write_netcdf_zip(dest_file, var, date)
+        return True
+
+@pytest.fixture
+def handler(s3, tmp_path, monkeypatch):
+    # (lambda_function, downloader, client) with the module loaded fresh against tmp_path
+    client, server = s3
+    shapes_file = str(tmp_path / 'states.geojson')
+    # a triangle, so the state's window has cells outside it
+    geometry = Polygon([(ULX + 5 * RES, ULY - 15 * RES), (ULX + 25 * RES, ULY - 15 * RES), (ULX + 15 * RES, ULY - 4 * RES)])
+    gpd.GeoDataFrame({'NAME': [STATE]}, geometry = [geometry], crs = 'EPSG:4269').to_file(shapes_file)
+    monkeypatch.setenv('S3_BUCKET', 'test')
+    monkeypatch.setenv('S3_ENDPOINT_URL', client.meta.endpoint_url)
+    monkeypatch.setenv('STATE_SHAPES_PATH', shapes_file)
+    monkeypatch.setenv('STORAGE_DIR', str(tmp_path / 'storage'))
+    monkeypatch.setenv('EFS_DIR', str(tmp_path / 'no-efs'))
+    monkeypatch.syspath_prepend(HANDLER_DIR)
+    monkeypatch.delitem(sys.modules, 'lambda_function', raising = False)
+    lambda_function = importlib.import_module('lambda_function')
+    downloader = _Downloader()
+    monkeypatch.setattr(lambda_function, '_s3_client', client)
+    monkeypatch.setattr(lambda_function, '_result_cache', None)
+    monkeypatch.setattr(lambda_function, '_prism_cache', PrismCache(str(tmp_path / 'prism_cache'), downloader = downloader))
+    yield lambda_function, downloader, client
+    sys.modules.pop('lambda_function', None)
+
+def _event(dates, **kwargs):
+
+    return {'dates': ','.join(dates), 'thresholds': '10:30,5:25', 'user': 'tester', 'state': STATE, **kwargs}
+
+def _published_cube(client, response):
+
+    key = json.loads(response['body'])['s3_key']
+    return xra.load_dataset(io.BytesIO(client.get_object(Bucket = 'test', Key = key)['Body'].read()))
+
+def _expected(lambda_function, dates):
+    # (date, threshold, y, x) from the calculator, one day and threshold pair at a time
+    geometry = lambda_function.get_state_geometry(STATE)
+    cache = lambda_function.get_prism_cache()
+    days = []
+    for date in dates:
+        rasters = {
+            var: load_prism_raster(cache.entry_dir(var, date), f'{var}_{date}.zip', f'PRISM_{var}_stable_4kmD2_{date}_nc.nc', geometry)
+            for var in ('tmin', 'tmax')}
+        days.append([
+            DegreeDayCalculator(lt, ut).get_degree_days_raster(rasters['tmin'], rasters['tmax']).values
+            for lt, ut in THRESHOLDS])
+    return np.array(days)
+
+
+def test_batch_matches_per_day_calculation(handler):
+    lambda_function, downloader, client = handler
+    dates = ['20240601', '20240602', '20240603']
+    response = lambda_function.lambda_handler({'queryStringParameters': _event(dates, accumulate = 'true')}, None)
+    assert response['statusCode'] == 200 and response['headers']['X-Cache'] == 'miss'
+    body = json.loads(response['body'])
+    assert body['n_days'] == 3 and body['thresholds'] == ['10_30', '5_25']
+
+    cube = _published_cube(client, response)
+    assert list(cube.gdd.dims) == ['date', 'threshold', 'y', 'x']
+    assert list(cube.date.values) == list(pd.to_datetime(dates))
+    expected = _expected(lambda_function, dates)
+    np.testing.assert_allclose(cube.gdd.values, expected, rtol = 1e-6)
+    assert np.isnan(expected).any() and not np.isnan(expected).all() # cells outside the state
+    np.testing.assert_allclose(cube.gdd_cumulative.values, np.cumsum(expected, axis = 0), rtol = 1e-5)
+
+def test_overlapping_batches_reuse_cached_days(handler):
+    # PRISM cache hits for the shared days, a result cache hit for the repeat
+    lambda_function, downloader, client = handler
+    first = lambda_function.lambda_handler(_event(['20240601', '20240602']), None)
+    assert first['statusCode'] == 200
+    dates = ['20240602', '20240603', '20240601'] # unsorted, duplicates the first batch's days
+    second = lambda_function.lambda_handler(_event(dates), None)
+    assert second['statusCode'] == 200 and second['headers']['X-Cache'] == 'miss'
+    assert sorted(downloader.fetched) == sorted((var, date) for var in ('tmin', 'tmax') for date in ['20240601', '20240602', '20240603'])
+    np.testing.assert_allclose(_published_cube(client, second).gdd.values, _expected(lambda_function, sorted(dates)), rtol = 1e-6)
+
+    repeat = lambda_function.lambda_handler(_event(dates, user = 'other'), None)
+    assert repeat['statusCode'] == 200 and repeat['headers']['X-Cache'] == 'hit-shared'
+    assert len(downloader.fetched) == 6
+    np.testing.assert_array_equal(_published_cube(client, repeat).gdd.values, _published_cube(client, second).gdd.values)
+
+def test_failed_days_are_reported(handler):
+    lambda_function, downloader, client = handler
+    downloader.failing = {'20240602'}
+    response = lambda_function.lambda_handler(_event(['20240601', '20240602', '20240603']), None)
+    assert response['statusCode'] == 502
+    assert json.loads(response['body'])['failed_dates'] == ['20240602']
+    # the days that did download stay cached for the retry
+    downloader.failing = set()
+    retry = lambda_function.lambda_handler(_event(['20240601', '20240602', '20240603']), None)
+    assert retry['statusCode'] == 200
+    assert downloader.fetched.count(('tmin', '20240601')) == 1
+    assert downloader.fetched.count(('tmin', '20240602')) == 2
+
+@pytest.mark.parametrize('event, message', [
+    ({'dates': '20240601', 'thresholds': '10:30', 'state': STATE}, "'user'"),
+    ({'dates': '20240601', 'thresholds': '10:30', 'user': 'tester'}, "'state'"),
+    ({'dates': '2024-06-01', 'thresholds': '10:30', 'user': 'tester', 'state': STATE}, 'Invalid batch request'),
+    ({'dates': '20240601', 'thresholds': '10', 'user': 'tester', 'state': STATE}, 'Invalid batch request'),
+    ({'start_date': '20240601', 'user': 'tester', 'state': STATE, 'temp_low': 10, 'temp_high': 30}, "'end_date'"),
+    ({'dates': '20240601', 'thresholds': '10:30', 'user': 'tester', 'state': 'Nowhere'}, 'not a known state'),
+])
+def test_malformed_batches_are_rejected(handler, event, message):
+    lambda_function, downloader, client = handler
+    response = lambda_function.lambda_handler(event, None)
+    assert response['statusCode'] == 400
+    assert message in json.loads(response['body'])
+    assert downloader.fetched == []
@@ -0,0 +1,171 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xarray as xra
+import pytest
+from datetime import datetime
+from shapely.geometry import box
+from degree_day import degree_day
+from degree_day.degree_day import (
+    DegreeDayCalculator, build_climatology_store, climatology_degree_days, create_gdd_cube_normals,
+    pull_PRISM_data_normals)
+from degree_day.climatology import DAYS, ClimatologyStore, day_index
+from degree_day.prism_io import load_prism_raster
+from conftest import N_ROWS, N_COLS, RES, ULX, ULY, write_prism_zip
+
+### the normals ClimatologyStore against the calculator, and against the pulled-normals path
+# A stub downloader writes a different synthetic normal for each of the 366
+# days, with a nodata cell, in PRISM's normals layout.
+
+PEST_PARAMS = {
+    'early': {'lt': 8, 'ut': 30, 'method': 'single_sine', 'start_date': '01-03'},
+    'late': {'lt': 5, 'ut': 25, 'method': 'simple_avg', 'start_date': '02-27'},
+}
+
+
+def _normal(var, day):
+
+    rng = np.random.default_rng(day_index(day))
+    tmin = 2 + 10 * rng.random((N_ROWS, N_COLS))
+    values = tmin if var == 'tmin' else tmin + 4 + 12 * rng.random((N_ROWS, N_COLS))
+    values[7, 12] = -9999
+    return values
+
+
+class _Downloader:
+    # serves _normal for every day not in failing, and counts fetches
+    def __init__(self, failing = ()):
+        self.failing = set(failing)
+        self.fetched = []
+
+    def fetch(self, url, dest_file, var = None, date = None):
+        self.fetched.append((var, date))
+        if date in self.failing:
+            return False
+        write_prism_zip(dest_file, f'PRISM_{var}_30yr_normal_800mD1_{date}_bil', _normal(var, date))
+        return True
+
+    def fetch_many(self, jobs):
+
+        return [self.fetch(**job) for job in jobs]
+
+    def write_manifest(self):
+
+        pass
+
+def _reference(prism_dir, geometry, pest, day):
+    # the calculator on one day's clipped normals
+    rasters = {
+        var: load_prism_raster(
+            os.path.join(prism_dir, day, var), f'{day}_{var}.zip', f'PRISM_{var}_30yr_normal_800mD1_{day}_bil.bil', geometry)
+        for var in ('tmin', 'tmax')}
+    params = PEST_PARAMS[pest]
+    return DegreeDayCalculator(params['lt'], params['ut'], params['method']).get_degree_days_raster(rasters['tmin'], rasters['tmax']).values
+
+def _normals(root):
+    # (prism_dir, bbox_file, downloader) with nothing pulled yet
+    os.makedirs(root, exist_ok = True)
+    bbox_file = os.path.join(root, 'bbox.geojson')
+    geometry = box(ULX + 5 * RES, ULY - 15 * RES, ULX + 25 * RES, ULY - 5 * RES)
+    gpd.GeoDataFrame(geometry = [geometry], crs = 'EPSG:4269').to_file(bbox_file)
+    return os.path.join(root, 'normals'), bbox_file, _Downloader()
+
+@pytest.fixture(scope = 'module')
+def climatology(tmp_path_factory):
+    # (prism_dir, bbox_file, store_file, downloader) with every day pulled and stored once for the module
+    prism_dir, bbox_file, downloader = _normals(str(tmp_path_factory.mktemp('climatology')))
+    store_file = os.path.join(os.path.dirname(prism_dir), 'climatology.nc')
+    build_climatology_store(store_file, prism_dir, bbox_file, PEST_PARAMS, downloader = downloader)
+    return prism_dir, bbox_file, store_file, downloader
+
+
+def test_store_matches_calculator(climatology, tmp_path):
+    prism_dir, bbox_file, store_file, downloader = climatology
+    store = ClimatologyStore(store_file)
+    assert len(downloader.fetched) == 2 * len(DAYS)
+    geometry = gpd.read_file(bbox_file).geometry
+
+    days = ['0226', '0227', '0228', '0229', '0301', '0302']
+    for pest in PEST_PARAMS:
+        reference = {day: _reference(prism_dir, geometry, pest, day) for day in days}
+        for day in days:
+            # the store computes all pests at once, whose kernels round a little differently
+            np.testing.assert_allclose(store.daily(pest, day), reference[day], rtol = 1e-6, atol = 1e-6)
+        assert np.isnan(reference['0301']).any()
+        # the layer from the biofix, with and without the leap day; nan counts as 0
+        expected = sum(np.nan_to_num(reference[day]) for day in days[1:])
+        np.testing.assert_allclose(store.layer(pest, '03-02', start_day = '02-27'), expected, rtol = 1e-6)
+        expected_normal = expected - np.nan_to_num(reference['0229'])
+        np.testing.assert_allclose(store.layer(pest, '03-02', leap = False, start_day = '02-27'), expected_normal, rtol = 1e-6)
+
+    # any thresholds from the stored normals, without pulling again
+    params = PEST_PARAMS['late']
+    adhoc = climatology_degree_days(store_file, params['lt'], params['ut'], params['method'], '02-26', '03-02', leap = False)
+    assert [str(day) for day in adhoc.day.values] == [day for day in days if day != '0229']
+    for day in adhoc.day.values:
+        np.testing.assert_array_equal(adhoc.sel(day = day).values, store.daily('late', str(day)))
+
+    # changed parameters recompute that pest only, from the stored normals
+    changed_file = str(tmp_path / 'climatology.nc')
+    shutil.copy(store_file, changed_file)
+    changed = {**PEST_PARAMS, 'late': {**PEST_PARAMS['late'], 'lt': 7}}
+    changed_store = build_climatology_store(changed_file, prism_dir, bbox_file, changed, downloader = downloader)
+    assert len(downloader.fetched) == 2 * len(DAYS)
+    assert changed_store.pests()['late']['lt'] == 7.0
+    np.testing.assert_array_equal(changed_store.daily('early', '0301'), store.daily('early', '0301'))
+    assert not np.array_equal(changed_store.daily('late', '0301'), store.daily('late', '0301'), equal_nan = True)
+
+def test_failed_pull_is_retried(tmp_path):
+    # a failed fetch leaves its var_dir behind, which must not block the next run
+    prism_dir, bbox_file, downloader = _normals(str(tmp_path))
+    downloader.failing = {'0103'}
+    assert not pull_PRISM_data_normals('0103', ['tmin', 'tmax'], prism_dir, downloader = downloader)
+    assert os.path.isdir(os.path.join(prism_dir, '0103', 'tmin'))
+    store_file = str(tmp_path / 'climatology.nc')
+    with pytest.raises(RuntimeError, match = '0103'):
+        build_climatology_store(store_file, prism_dir, bbox_file, PEST_PARAMS, downloader = downloader)
+
+    downloader.failing = set()
+    store = build_climatology_store(store_file, prism_dir, bbox_file, PEST_PARAMS, downloader = downloader)
+    assert store.has_normals()
+    assert downloader.fetched.count(('tmin', '0103')) == 3
+    assert downloader.fetched.count(('tmin', '0102')) == 1 # pulled by the failed build, kept
+
+@pytest.mark.parametrize('start_date, end_date', [
+    (datetime(2023, 1, 1), datetime(2023, 1, 6)), # biofix days in a year other than 2024
+    (datetime(2024, 1, 1), datetime(2024, 1, 6)),
+    (datetime(2024, 2, 25), datetime(2024, 3, 2)), # leap day included / excluded
+])
+def test_store_path_matches_pulled_path(climatology, tmp_path, monkeypatch, start_date, end_date):
+    # the days are already pulled, so the pulled path reads the same zips the store was built from
+    prism_dir, bbox_file, store_file, downloader = climatology
+    monkeypatch.setattr(degree_day, 'get_default_downloader', lambda: downloader)
+    pulled_dir, store_dir = str(tmp_path / 'pulled'), str(tmp_path / 'store')
+    create_gdd_cube_normals(start_date, end_date, prism_dir, pulled_dir, bbox_file, PEST_PARAMS, agg_to_layer = True)
+    create_gdd_cube_normals(
+        start_date, end_date, prism_dir, store_dir, bbox_file, PEST_PARAMS, agg_to_layer = True,
+        climatology_file = store_file)
+    assert len(downloader.fetched) == 2 * len(DAYS)
+
+    last_layers = {}
+    for pest in PEST_PARAMS:
+        cube_name = os.path.join('cubes', f'gdd_cube_normals_{pest}.nc')
+        pulled, stored = xra.load_dataarray(os.path.join(pulled_dir, cube_name)), xra.load_dataarray(os.path.join(store_dir, cube_name))
+        assert list(stored.date.values) == list(pulled.date.values) == list(pd.date_range(start_date, end_date))
+        np.testing.assert_array_equal(stored.values, pulled.values)
+
+        for layer_kind in ('leap_year', 'norm_year'):
+            layer_dir = os.path.join('layers', pest, layer_kind)
+            names = sorted(os.listdir(os.path.join(pulled_dir, layer_dir)))
+            assert names == sorted(os.listdir(os.path.join(store_dir, layer_dir)))
+            assert len(names) == len(pd.date_range(start_date, end_date)) - (layer_kind == 'norm_year' and start_date.month == 2)
+            for name in names:
+                pulled_layer = xra.load_dataarray(os.path.join(pulled_dir, layer_dir, name))
+                stored_layer = xra.load_dataarray(os.path.join(store_dir, layer_dir, name))
+                np.testing.assert_allclose(stored_layer.values, pulled_layer.values, rtol = 1e-6, atol = 1e-9)
+        layer_dir = os.path.join(store_dir, 'layers', pest, 'leap_year')
+        last_layers[pest] = float(xra.load_dataarray(os.path.join(layer_dir, sorted(os.listdir(layer_dir))[-1])).sum())
+    # at least one biofix falls inside the dates, so the layers are not all 0
+    assert max(last_layers.values()) > 0
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+from degree_day.cube_store import GddCubeStore
+from degree_day.cube_index import cumsum_path, index_is_current, sum_dates_from_index, update_cumsum_index
+from degree_day import degree_day
+from degree_day.degree_day import aggregate_cube_by_date, build_gdd_cube, patch_gdd_cube
+
+### cumsum index sums against plain sums over the cube
+
+DATES = pd.date_range('2024-02-20', '2024-03-10')
+
+
+def _write_cube(cube_file, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(0, 20, (len(DATES), 6, 7))
+    values[:, 0, 0] = np.nan # outside the region
+    values[3, 2, 2] = np.nan # one nodata day
+    cube = xra.DataArray(values, dims = ('date', 'y', 'x'), coords = {'date': DATES, 'y': np.arange(6), 'x': np.arange(7)})
+    store = GddCubeStore(cube_file)
+    for i in range(len(DATES)):
+        store.append(cube.isel(date = [i]))
+    return cube
+
+def _plain_sum(cube, start, end, exclude = None):
+
+    dates = pd.DatetimeIndex(cube.date.values)
+    keep = (dates >= start) & (dates <= end) & (dates != exclude)
+    return np.nansum(cube.values[keep], axis = 0)
+
+def test_sums_match_plain_sums(tmp_path):
+    cube_file = str(tmp_path / 'cube.nc')
+    cube = _write_cube(cube_file)
+    assert not index_is_current(cube_file)
+    index_file = update_cumsum_index(cube_file)
+    assert index_file == cumsum_path(cube_file)
+    assert index_is_current(cube_file)
+
+    leap_day = pd.Timestamp('2024-02-29')
+    for start, end in [('2024-02-20', '2024-03-10'), ('2024-02-25', '2024-03-02'), ('2024-01-01', '2024-02-22'), ('2024-03-10', '2024-12-31')]:
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        for exclude in (None, leap_day):
+            np.testing.assert_allclose(sum_dates_from_index(index_file, start, end, exclude), _plain_sum(cube, start, end, exclude))
+    assert sum_dates_from_index(index_file, pd.Timestamp('2024-04-01'), pd.Timestamp('2024-05-01')) is None
+
+def test_aggregate_uses_index_and_matches_sum(tmp_path, monkeypatch):
+    cube_file = str(tmp_path / 'cube.nc')
+    cube = _write_cube(cube_file)
+    update_cumsum_index(cube_file)
+    calls = []
+    def counted(*args):
+        calls.append(args)
+        return sum_dates_from_index(*args)
+    monkeypatch.setattr(degree_day, 'sum_dates_from_index', counted)
+    with GddCubeStore(cube_file).open() as opened:
+        from_index = aggregate_cube_by_date(opened, start_day = '02-25', end_day = '03-05', exclude_day = '02-29')
+    assert len(calls) == 1
+    from_sum = aggregate_cube_by_date(cube, start_day = '02-25', end_day = '03-05', exclude_day = '02-29')
+    np.testing.assert_allclose(from_index.values, from_sum.values)
+    assert from_index.date.values == from_sum.date.values
+
+def test_index_invalidated_by_writes(tmp_path):
+    cube_file = str(tmp_path / 'cube.nc')
+    cube = _write_cube(cube_file)
+    update_cumsum_index(cube_file)
+
+    # overwrite a slice: the index is stale until extended from that date
+    store = GddCubeStore(cube_file)
+    store.write(cube.isel(date = [5]) + 100)
+    assert not index_is_current(cube_file)
+    update_cumsum_index(cube_file)
+    assert index_is_current(cube_file)
+    patched = cube.copy()
+    patched[5] += 100
+    np.testing.assert_allclose(sum_dates_from_index(cumsum_path(cube_file), DATES[0], DATES[-1]), _plain_sum(patched, DATES[0], DATES[-1]))
+
+    # a new date
+    store.append(cube.isel(date = [0]), date = '2024-03-11')
+    assert not index_is_current(cube_file)
+    update_cumsum_index(cube_file)
+    assert list(GddCubeStore(cumsum_path(cube_file)).dates()) == list(DATES) + [pd.Timestamp('2024-03-11')]
+
+def test_patch_keeps_index_current(prism_archive, tmp_path):
+    prism_dir, bbox_file, dates = prism_archive
+    params = {'lt': 10, 'ut': 30, 'method': 'single_sine'}
+    cube_file = str(tmp_path / 'cube.nc')
+    build_gdd_cube(prism_dir, bbox_file, params, date_list = dates[:5], cube_out = cube_file, return_cube = False, build_index = True)
+    assert index_is_current(cube_file)
+    patch_gdd_cube(cube_file, params, prism_dir, bbox_file, date_list = dates)
+    assert index_is_current(cube_file)
+    cube = xra.load_dataarray(cube_file)
+    np.testing.assert_allclose(
+        sum_dates_from_index(cumsum_path(cube_file), dates[2], dates[-1]), _plain_sum(cube, dates[2], dates[-1]), rtol = 1e-6)
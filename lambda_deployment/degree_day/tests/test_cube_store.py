@@ -0,0 +1,72 @@
+import warnings
+import numpy as np
+import pandas as pd
+import xarray as xra
+import pytest
+from degree_day.cube_store import GddCubeStore
+from degree_day.degree_day import open_gdd_cube
+
+### GddCubeStore on its own cubes and on plain to_netcdf cubes
+
+
+def _cube(dates, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    return xra.DataArray(
+        rng.random((len(dates), 4, 5)).astype(np.float32), dims = ('date', 'y', 'x'),
+        coords = {'date': pd.DatetimeIndex(dates), 'y': np.arange(3.5, 0, -1), 'x': np.arange(0.5, 5)})
+
+def test_append_write_and_insert(tmp_path):
+    cube = _cube(pd.date_range('2024-01-01', periods = 5))
+    store = GddCubeStore(str(tmp_path / 'cube.nc'))
+    for i in [0, 1, 3]:
+        store.append(cube.isel(date = [i]))
+    store.write(cube.isel(date = [4])) # latest: appended
+    store.write(cube.isel(date = [2])) # earlier: inserted
+    store.write(cube.isel(date = [0]) * 2) # existing: overwritten
+
+    expected = cube.copy()
+    expected[0] *= 2
+    assert list(store.dates()) == list(cube.date.values)
+    assert store.written_at().notna().all()
+    loaded = xra.load_dataarray(store.path)
+    np.testing.assert_array_equal(loaded.values, expected.values)
+    np.testing.assert_array_equal(loaded.date.values, cube.date.values)
+
+def test_to_netcdf_cube_reads_and_migrates(tmp_path):
+    # the layout cubes had before the store: int64 "days since <first date>", fixed date dimension
+    cube = _cube(pd.date_range('2024-03-01', periods = 3))
+    cube_file = str(tmp_path / 'legacy.nc')
+    cube.to_netcdf(cube_file)
+    store = GddCubeStore(cube_file)
+
+    assert list(store.dates()) == list(cube.date.values)
+    assert store.written_at().isna().all()
+    assert [date for date, _ in store.iter_slices()] == list(cube.date.values)
+    assert not store.is_appendable()
+    with pytest.raises(ValueError, match = 'migrate'):
+        store.append(cube.isel(date = 0), date = '2024-03-04')
+
+    assert store.migrate()
+    assert not store.migrate()
+    assert store.written_at().isna().all()
+    store.append(cube.isel(date = 0) + 1, date = '2024-03-04')
+    loaded = xra.load_dataarray(cube_file)
+    np.testing.assert_array_equal(loaded.values[:3], cube.values)
+    np.testing.assert_array_equal(loaded.values[3], cube.values[0] + 1)
+    assert list(store.dates()) == list(pd.date_range('2024-03-01', periods = 4))
+
+def test_open_gdd_cube_chunks(tmp_path):
+    pytest.importorskip('dask')
+    cube = _cube(pd.date_range('2024-01-01', periods = 40))
+    store = GddCubeStore(str(tmp_path / 'cube.nc'))
+    for i in range(40):
+        store.append(cube.isel(date = [i]))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error') # splitting stored chunks warns
+        lazy = open_gdd_cube(store.path)
+    assert lazy.chunks[0] == (32, 8) # whole one-date stored chunks, at least min_dates
+    np.testing.assert_array_equal(lazy.values, cube.values)
+    assert open_gdd_cube(store.path, chunks = False).chunks is None
+    assert open_gdd_cube(store.path, chunks = {'date': 8}).chunks[0] == (8,) * 5
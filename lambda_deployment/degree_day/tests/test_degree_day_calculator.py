@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from degree_day.degree_day import DegreeDayCalculator
+
+### vectorized DegreeDayCalculator against the scalar get_degree_days
+
+
+def _grid():
+    # every (tmin, tmax) pair on a grid straddling both thresholds, so all six
+    # cases occur, along with tmin == tmax, tmin > tmax and nan cells
+    temps = np.arange(-5, 42.5, 2.5)
+    tmin, tmax = [a.ravel() for a in np.meshgrid(temps, temps)]
+    tmin = np.concatenate([tmin, [np.nan, 12.0, np.nan]])
+    tmax = np.concatenate([tmax, [20.0, np.nan, np.nan]])
+    return tmin.reshape(-1, 7), tmax.reshape(-1, 7)
+
+@pytest.mark.parametrize('method', ['single_sine', 'simple_avg'])
+def test_array_matches_scalar(method):
+    calculator = DegreeDayCalculator(10, 30, method)
+    tmin, tmax = _grid()
+    expected = np.vectorize(calculator.get_degree_days, otypes = [float])(tmin, tmax)
+    result = calculator.get_degree_days_array(tmin, tmax)
+    assert result.shape == tmin.shape
+    np.testing.assert_allclose(result, expected, rtol = 0, atol = 1e-12)
+    assert np.isnan(result[tmin >= tmax]).all()
+    assert np.isnan(result[np.isnan(tmin) | np.isnan(tmax)]).all()
+
+def test_every_case_is_covered():
+    calculator = DegreeDayCalculator(10, 30)
+    tmin, tmax = _grid()
+    valid = tmin < tmax
+    cases = {
+        1: valid & (30 <= tmin),
+        2: valid & (10 >= tmax),
+        3: valid & (30 >= tmax) & (10 <= tmin) & (10 < tmax),
+        4: valid & (30 >= tmax) & (10 > tmin) & (10 < tmax),
+        5: valid & (30 < tmax) & (10 < tmin),
+        6: valid & (30 < tmax) & (10 >= tmin),
+    }
+    assert all(mask.any() for mask in cases.values())
+    assert (tmin == tmax).any() and (tmin > tmax).any()
+
+def test_out_and_float32():
+    calculator = DegreeDayCalculator(10, 30)
+    tmin, tmax = _grid()
+    out = np.empty(tmin.shape, dtype = np.float32)
+    result = calculator.get_degree_days_array(tmin.astype(np.float32), tmax.astype(np.float32), out = out)
+    assert result is out
+    np.testing.assert_allclose(out, calculator.get_degree_days_array(tmin, tmax), rtol = 1e-5, atol = 1e-4)
+
+def test_thresholds_not_ordered():
+    tmin, tmax = _grid()
+    assert np.isnan(DegreeDayCalculator(30, 10).get_degree_days_array(tmin, tmax)).all()
@@ -0,0 +1,140 @@
+import io
+import os
+import json
+import zipfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from degree_day.download import PrismDownloader
+
+### PrismDownloader against a local HTTP stand-in for PRISM
+# The server answers /<name> with a small zip, or with PRISM's throttling
+# text body while a per-path budget of refusals lasts, over HTTP/1.1
+# keep-alive so connection reuse can be counted.
+
+
+def _zip_bytes(name):
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        z.writestr(f'{name}.bil', b'\0' * 16)
+    return buffer.getvalue()
+
+
+class _Prism(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.connections.add(self.client_address)
+            refusals = server.refusals.get(self.path, 0)
+            if refusals > 0:
+                server.refusals[self.path] = refusals - 1
+        body = b'You have tried to download this file too many times today.' if refusals > 0 else _zip_bytes(self.path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+
+        pass
+
+
+@pytest.fixture
+def prism():
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Prism)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.connections = set()
+    server.refusals = {}
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def downloader(tmp_path):
+
+    with PrismDownloader(max_workers = 2, rate = 1000, burst = 100, max_retries = 2, backoff = 0, timeout = 5,
+                         manifest_file = str(tmp_path / 'manifest.json')) as downloader:
+        yield downloader
+
+def _url(server, name):
+
+    return f'http://127.0.0.1:{server.server_address[1]}/{name}'
+
+def _job(server, tmp_path, name):
+
+    return {'url': _url(server, name), 'dest_file': str(tmp_path / name / f'{name}.zip'), 'var': 'tmin', 'date': name}
+
+
+def test_throttled_fetch_is_retried(prism, downloader, tmp_path):
+
+    prism.refusals['/20240101'] = 2
+    job = _job(prism, tmp_path, '20240101')
+    assert downloader.fetch(**job)
+    assert prism.requests == 3
+    assert zipfile.is_zipfile(job['dest_file'])
+    assert downloader.failed == []
+
+def test_part_file_is_renamed_or_removed(prism, downloader, tmp_path):
+
+    ok = _job(prism, tmp_path, '20240101')
+    assert downloader.fetch(**ok)
+    assert os.path.exists(ok['dest_file']) and not os.path.exists(ok['dest_file'] + '.part')
+
+    prism.refusals['/20240102'] = 10
+    bad = _job(prism, tmp_path, '20240102')
+    assert not downloader.fetch(**bad)
+    assert not os.path.exists(bad['dest_file']) and not os.path.exists(bad['dest_file'] + '.part')
+
+def test_manifest_and_retry_failed(prism, downloader, tmp_path):
+
+    prism.refusals['/20240102'] = 3 # outlasts max_retries = 2
+    jobs = [_job(prism, tmp_path, name) for name in ('20240101', '20240102')]
+    assert downloader.fetch_many(jobs) == [True, False]
+
+    manifest_file = downloader.write_manifest()
+    with open(manifest_file) as f:
+        failed = json.load(f)
+    assert [(job['date'], job['dest_file']) for job in failed] == [('20240102', jobs[1]['dest_file'])]
+
+    assert downloader.retry_failed() == [True]
+    assert zipfile.is_zipfile(jobs[1]['dest_file'])
+    assert downloader.failed == []
+    with open(manifest_file) as f:
+        assert json.load(f) == []
+
+def test_failed_does_not_grow_across_pulls(prism, downloader, tmp_path):
+
+    job = _job(prism, tmp_path, '20240101')
+    for _ in range(3):
+        prism.refusals['/20240101'] = 3
+        assert not downloader.fetch(**job)
+    assert len(downloader.failed) == 1
+    assert downloader.fetch(**job)
+    assert downloader.failed == []
+
+def test_connections_are_reused_across_calls(prism, downloader, tmp_path):
+
+    for day in range(6):
+        jobs = [_job(prism, tmp_path, f'2024010{day + 1}_{var}') for var in ('tmin', 'tmax')]
+        assert downloader.fetch_many(jobs) == [True, True]
+    assert prism.requests == 12
+    assert len(prism.connections) <= downloader.max_workers
+
+def test_close_releases_connections(prism, tmp_path):
+
+    downloader = PrismDownloader(max_workers = 2, rate = 1000, burst = 100, timeout = 5)
+    downloader.fetch_many([_job(prism, tmp_path, name) for name in ('a', 'b')])
+    conns = [conn for idle in downloader._idle.values() for conn in idle]
+    assert len(conns) > 0
+    downloader.close()
+    assert all(conn.sock is None for conn in conns)
+    assert downloader._executor is None
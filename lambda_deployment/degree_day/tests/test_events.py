@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+import pytest
+from degree_day.events import NODATA, event_dates
+from conftest import OUTSIDE, daily_gdd, write_gdd_cube
+
+### event dates against the first crossing of a full cumulative sum
+
+TARGETS = {'egg_hatch': 100, 'adult_flight': 400, 'never': 5000}
+
+
+def _reference(dates, daily, targets, start_date, end_date):
+    # (target, y, x) day of year of the first date each running total reaches the target
+    window = (dates >= start_date) & (dates <= end_date)
+    running = np.cumsum(np.nan_to_num(daily[window]), axis = 0, dtype = np.float64)
+    in_region = ~np.isnan(daily[window][0])
+    doy = dates[window].dayofyear.values
+    result = np.full((len(targets),) + daily.shape[1:], NODATA, dtype = np.int16)
+    for i, target in enumerate(targets.values()):
+        reached = running >= target
+        first = doy[reached.argmax(axis = 0)]
+        result[i] = np.where(reached.any(axis = 0) & in_region, first, NODATA)
+    return result
+
+@pytest.fixture
+def cube(tmp_path):
+    # (cube_file, dates, daily) from Dec 1 into the next season
+    dates = pd.date_range('2023-12-01', '2024-04-30')
+    daily = daily_gdd(len(dates), seed = 4)
+    return write_gdd_cube(str(tmp_path / 'cube.nc'), dates, daily), dates, daily
+
+
+@pytest.mark.parametrize('start_day, end_day', [('02-01', '04-15'), ('01-01', '12-31')])
+def test_event_dates_match_cumsum(cube, start_day, end_day):
+    cube_file, dates, daily = cube
+    expected = _reference(
+        dates, daily, TARGETS, pd.Timestamp(f'2024-{start_day}'), pd.Timestamp(f'2024-{end_day}'))
+    assert (expected[0] != NODATA).any() and (expected[-1] == NODATA).all()
+    for source in (cube_file, xra.load_dataarray(cube_file)): # streamed from disk, and in memory
+        events = event_dates(source, TARGETS, start_day = start_day, year = 2024, end_day = end_day)
+        assert events.dtype == np.int16 and list(events.target.values) == list(TARGETS)
+        np.testing.assert_array_equal(events.values, expected)
+        assert (events.values[(slice(None),) + OUTSIDE] == NODATA).all()
+
+def test_event_dates_season_defaults_to_first_year(cube):
+    # from Dec 1 of the cube's first year, and targets given as a list
+    cube_file, dates, daily = cube
+    events = event_dates(cube_file, [50, 300])
+    assert list(events.target.values) == ['50', '300'] and events.attrs['year'] == 2023
+    expected = _reference(dates, daily, {'50': 50, '300': 300}, pd.Timestamp('2023-01-01'), pd.Timestamp('2023-12-31'))
+    np.testing.assert_array_equal(events.values, expected)
+    assert (events.values[1] == NODATA).any() # not reached by Dec 31
+
+    with pytest.raises(ValueError, match = 'no dates'):
+        event_dates(cube_file, TARGETS, year = 2025)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+from degree_day.degree_day import DegreeDayCalculator, get_degree_days_raster_multi
+
+### multi-pest evaluation against one DegreeDayCalculator per pest
+
+PEST_PARAMS = {
+    'codling_moth': {'lt': 10, 'ut': 31.1, 'method': 'single_sine'},
+    'cutworm': {'lt': 0, 'ut': 36, 'method': 'single_sine'},
+    'shared_lt': {'lt': 10, 'ut': 25, 'method': 'single_sine'}, # reuses codling moth's lower area
+    'average': {'lt': 5, 'ut': 30, 'method': 'simple_avg'},
+    'unordered': {'lt': 30, 'ut': 10, 'method': 'single_sine'},
+}
+
+
+def _rasters():
+
+    rng = np.random.default_rng(1)
+    tmin = rng.uniform(-10, 35, (12, 15))
+    tmax = tmin + rng.uniform(-2, 20, tmin.shape) # some cells with tmin >= tmax
+    tmin[0, :3] = np.nan
+    coords = {'y': np.arange(12), 'x': np.arange(15)}
+    return xra.DataArray(tmin, dims = ('y', 'x'), coords = coords), xra.DataArray(tmax, dims = ('y', 'x'), coords = coords)
+
+def test_multi_matches_single_pests():
+    tmin, tmax = _rasters()
+    dd_stack = get_degree_days_raster_multi(tmin, tmax, PEST_PARAMS)
+    assert list(dd_stack.pest.values) == list(PEST_PARAMS)
+    for pest, params in PEST_PARAMS.items():
+        expected = DegreeDayCalculator(params['lt'], params['ut'], params['method']).get_degree_days_raster(tmin, tmax)
+        np.testing.assert_allclose(dd_stack.sel(pest = pest).values, expected.values, rtol = 0, atol = 1e-12)
+
+def test_pest_list_and_data_frame():
+    tmin, tmax = _rasters()
+    dd_stack = get_degree_days_raster_multi(tmin, tmax, pd.DataFrame(PEST_PARAMS).T, pest_list = 'cutworm')
+    assert list(dd_stack.pest.values) == ['cutworm']
+    np.testing.assert_array_equal(dd_stack.values[0], get_degree_days_raster_multi(tmin, tmax, PEST_PARAMS).sel(pest = 'cutworm').values)
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import xarray as xra
+import rioxarray # noqa: F401, registers .rio
+from shapely.geometry import box
+from degree_day.npz_cache import NpzCache
+from degree_day.region_mask import MaskCache
+from degree_day.projection import ProjectionCache
+from degree_day.cube_store import GddCubeStore
+from degree_day.query_index import CubeGrid, ZonalIndexCache
+
+### NpzCache layers and the caches built on it
+
+
+def _counter():
+
+    calls = []
+    def compute():
+        calls.append(1)
+        return {'values': np.arange(4) * len(calls)}
+    return compute, calls
+
+def test_memory_and_file_layers(tmp_path):
+    compute, calls = _counter()
+    cache = NpzCache(str(tmp_path), prefix = 'test')
+    first = cache.cached(('a', 1), compute)
+    assert cache.cached(('a', 1), compute) is first
+    assert len(calls) == 1
+    assert os.listdir(tmp_path) == [os.path.basename(cache._cache_file(('a', 1)))]
+
+    # another process: a fresh instance reads the file instead of computing
+    other = NpzCache(str(tmp_path), prefix = 'test')
+    np.testing.assert_array_equal(other.cached(('a', 1), compute)['values'], first['values'])
+    assert len(calls) == 1
+
+def test_memory_only_and_bounded():
+    compute, calls = _counter()
+    cache = NpzCache(max_items = 2)
+    for key in ('a', 'b', 'a', 'c'):
+        cache.cached(key, compute)
+    assert list(cache.values) == ['a', 'c'] # b was least recently used
+    assert len(calls) == 3
+
+def test_encode_decode(tmp_path):
+    cache = NpzCache(str(tmp_path), prefix = 'pair')
+    encode = lambda pair: {'x': np.array(pair[0]), 'y': np.array(pair[1])}
+    decode = lambda arrays: (int(arrays['x']), int(arrays['y']))
+    assert cache.cached('k', lambda: (1, 2), encode, decode) == (1, 2)
+    assert NpzCache(str(tmp_path), prefix = 'pair').cached('k', lambda: (0, 0), encode, decode) == (1, 2)
+
+def test_mask_and_projection_caches_share_a_directory(tmp_path):
+    raster = xra.DataArray(
+        np.zeros((10, 10), dtype = np.float32), dims = ('y', 'x'),
+        coords = {'y': np.arange(9.5, 0, -1), 'x': np.arange(0.5, 10)})
+    geometry = [box(2, 3, 5, 7)]
+    region_mask = MaskCache(str(tmp_path)).get(raster, geometry)
+    reloaded = MaskCache(str(tmp_path)).get(raster, geometry)
+    assert reloaded.window == region_mask.window
+    np.testing.assert_array_equal(reloaded.mask, region_mask.mask)
+
+    ProjectionCache(str(tmp_path)).get(('p',), lambda: {'gdd': np.ones(3)})
+    assert sorted(f.rsplit('_', 1)[0] for f in os.listdir(tmp_path)) == ['gdd_projection', 'region_mask']
+
+def test_zonal_index_cache_reloads(tmp_path):
+    cube_file = str(tmp_path / 'gdd_cube.nc')
+    daily = xra.DataArray(
+        np.ones((10, 10), dtype = np.float32), dims = ('y', 'x'),
+        coords = {'y': np.arange(9.5, 0, -1), 'x': np.arange(0.5, 10)})
+    GddCubeStore(cube_file).append(daily, date = '2024-05-01')
+    grid = CubeGrid(cube_file)
+    geometry = [box(2, 3, 5, 7), box(20, 20, 21, 21)]
+    cache_dir = str(tmp_path / 'zonal')
+    zonal_index = ZonalIndexCache(cache_dir).get(grid, geometry)
+    assert os.listdir(cache_dir)[0].startswith('zonal_index_')
+
+    reloaded = ZonalIndexCache(cache_dir).get(grid, geometry)
+    for name in ('offsets', 'cells', 'weights'):
+        np.testing.assert_array_equal(getattr(reloaded, name), getattr(zonal_index, name))
+    assert reloaded.shape == grid.shape
+    np.testing.assert_array_equal(reloaded.offsets, [0, 12, 12]) # 3 x 4 cells, then off the grid
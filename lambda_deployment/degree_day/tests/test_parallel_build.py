@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+from degree_day.degree_day import build_gdd_cube, create_gdd_cube
+
+### parallel cube builds against serial ones
+
+PEST_PARAMS = {
+    'codling_moth': {'lt': 10, 'ut': 31.1, 'method': 'single_sine'},
+    'cutworm': {'lt': 0, 'ut': 36, 'method': 'single_sine'},
+}
+
+
+def test_build_gdd_cube_parallel_matches_serial(prism_archive, tmp_path):
+    prism_dir, bbox_file, dates = prism_archive
+    serial = build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS['cutworm'], date_list = dates)
+    parallel = build_gdd_cube(
+        prism_dir, bbox_file, PEST_PARAMS['cutworm'], date_list = dates, parallel = True, n_workers = 2,
+        cube_out = str(tmp_path / 'cube.nc'))
+    assert list(pd.to_datetime(parallel.date.values)) == dates
+    np.testing.assert_array_equal(parallel.values, serial.values)
+    np.testing.assert_array_equal(xra.load_dataarray(tmp_path / 'cube.nc').values, serial.values)
+
+def test_create_gdd_cube_parallel_matches_serial(prism_archive, tmp_path):
+    prism_dir, bbox_file, dates = prism_archive
+    for parallel in (False, True):
+        create_gdd_cube(
+            dates[0], dates[-1], prism_dir, str(tmp_path / f'gdd_{parallel}'), bbox_file, PEST_PARAMS,
+            parallel = parallel, n_workers = 2)
+    for pest in PEST_PARAMS:
+        serial = xra.load_dataarray(tmp_path / 'gdd_False' / f'gdd_cube_{pest}.nc')
+        parallel = xra.load_dataarray(tmp_path / 'gdd_True' / f'gdd_cube_{pest}.nc')
+        np.testing.assert_array_equal(parallel.date.values, serial.date.values)
+        np.testing.assert_array_equal(parallel.values, serial.values)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import xarray as xra
+from degree_day.degree_day import build_gdd_cube, patch_gdd_cube
+from degree_day.cube_store import GddCubeStore
+
+### patching cubes, in memory and in place
+
+PEST_PARAMS = {'lt': 10, 'ut': 30, 'method': 'single_sine'}
+
+
+def test_patch_cube_opened_from_store(prism_archive, tmp_path):
+    # a cube written by GddCubeStore carries date_written, new slices do not
+    prism_dir, bbox_file, dates = prism_archive
+    cube_file = str(tmp_path / 'cube.nc')
+    build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS, date_list = dates[:6], cube_out = cube_file, return_cube = False)
+    cube = xra.load_dataarray(cube_file)
+    assert 'date_written' in cube.coords
+    full = build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS, date_list = dates)
+
+    added = patch_gdd_cube(cube, PEST_PARAMS, prism_dir, bbox_file, date_list = dates[4:])
+    assert list(pd.to_datetime(added.date.values)) == dates
+    np.testing.assert_allclose(added.values, full.values)
+
+    replaced = patch_gdd_cube(cube, PEST_PARAMS, prism_dir, bbox_file, date_list = dates[2:8], overwrite = True)
+    assert list(pd.to_datetime(replaced.date.values)) == dates[:8]
+    np.testing.assert_allclose(replaced.values, full.values[:8])
+
+def test_patch_cube_in_place(prism_archive, tmp_path):
+
+    prism_dir, bbox_file, dates = prism_archive
+    cube_file = str(tmp_path / 'cube.nc')
+    build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS, date_list = dates[:6], cube_out = cube_file, return_cube = False)
+
+    patched = patch_gdd_cube(cube_file, PEST_PARAMS, prism_dir, bbox_file, date_list = dates)
+    assert patched == dates[6:]
+    assert list(GddCubeStore(cube_file).dates()) == dates
+
+def test_patch_to_netcdf_cube_in_place(prism_archive, tmp_path):
+    # cubes that already exist were written with plain to_netcdf
+    prism_dir, bbox_file, dates = prism_archive
+    cube_file = str(tmp_path / 'legacy.nc')
+    build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS, date_list = dates[:6]).to_netcdf(cube_file)
+    full = build_gdd_cube(prism_dir, bbox_file, PEST_PARAMS, date_list = dates)
+
+    patched = patch_gdd_cube(cube_file, PEST_PARAMS, prism_dir, bbox_file, date_list = dates)
+    assert patched == dates[6:]
+    assert list(GddCubeStore(cube_file).dates()) == dates
+    cube = xra.load_dataarray(cube_file)
+    np.testing.assert_allclose(cube.values, full.values)
+    assert cube.date_written.isnull().sum() == 6 # migrated slices were written before tracking
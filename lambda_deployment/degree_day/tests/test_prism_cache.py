@@ -0,0 +1,108 @@
+import os
+import sys
+import zipfile
+import threading
+import subprocess
+from degree_day import prism_cache
+from degree_day.prism_cache import PrismCache, COMPLETE
+
+### PrismCache hits, eviction and readers holding entries
+
+
+class _Downloader:
+    # writes a small zip for every fetch and counts them
+    def __init__(self):
+        self.fetches = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, url, dest_file, var = None, date = None):
+        os.makedirs(os.path.dirname(dest_file), exist_ok = True)
+        with zipfile.ZipFile(dest_file, 'w') as z:
+            z.writestr(f'{var}_{date}.bil', b'\0' * 1024)
+        with self.lock:
+            self.fetches += 1
+        return True
+
+def _job(date, var = 'tmin'):
+
+    return {'url': f'http://prism/{var}/{date}', 'var': var, 'date': date}
+
+
+def test_hit_survives_eviction_before_touch(tmp_path, monkeypatch):
+    # the marker is removed between the existence check and the utime
+    downloader = _Downloader()
+    cache = PrismCache(str(tmp_path), downloader = downloader)
+    job = _job('20240101')
+    entry_dir = cache.get(**job)
+    utime = os.utime
+
+    def evicted_utime(path, *args, **kwargs):
+        if os.path.basename(path) == COMPLETE and os.path.exists(path):
+            os.remove(path)
+        return utime(path, *args, **kwargs)
+    monkeypatch.setattr(prism_cache.os, 'utime', evicted_utime)
+    assert cache.get(**job) == entry_dir
+    monkeypatch.undo()
+    assert downloader.fetches == 2
+    assert cache.is_complete('tmin', '20240101')
+
+def test_reading_holds_entries_against_eviction(tmp_path):
+
+    cache = PrismCache(str(tmp_path), max_bytes = 0, downloader = _Downloader())
+    jobs = [_job('20240101'), _job('20240101', 'tmax')]
+    with cache.reading(jobs) as entry_dirs:
+        assert all(os.path.isfile(os.path.join(d, COMPLETE)) for d in entry_dirs)
+        evictor = threading.Thread(target = cache.evict)
+        evictor.start()
+        evictor.join()
+        # and from another process, through the record lock
+        code = f'from degree_day.prism_cache import PrismCache; PrismCache({str(tmp_path)!r}, max_bytes = 0).evict()'
+        subprocess.run([sys.executable, '-c', code], check = True)
+        assert all(os.path.isfile(os.path.join(d, COMPLETE)) for d in entry_dirs)
+    cache.evict()
+    assert not any(os.path.exists(os.path.join(d, COMPLETE)) for d in entry_dirs)
+
+def test_reading_fetches_evicted_entries_again(tmp_path):
+
+    downloader = _Downloader()
+    cache = PrismCache(str(tmp_path), downloader = downloader)
+    job = _job('20240101')
+    cache.get(**job)
+    cache.max_bytes = 0
+    cache.evict()
+    assert not cache.is_complete('tmin', '20240101')
+    cache.max_bytes = 1 << 20
+    with cache.reading([job]) as entry_dirs:
+        assert cache.is_complete('tmin', '20240101')
+        assert entry_dirs == [cache.entry_dir('tmin', '20240101')]
+    assert downloader.fetches == 2
+
+def test_eviction_removes_lock_files_and_locks(tmp_path):
+
+    cache = PrismCache(str(tmp_path), max_bytes = 1 << 20, downloader = _Downloader())
+    dates = [f'202401{day:02d}' for day in range(1, 6)]
+    for date in dates:
+        cache.get(**_job(date))
+    assert len(cache._key_locks) == len(dates)
+    cache.max_bytes = 0
+    cache.evict()
+    assert not os.listdir(os.path.join(str(tmp_path), 'tmin'))
+    assert cache._key_locks == {}
+
+def test_lock_on_removed_file_starts_over(tmp_path, monkeypatch):
+    # the evicting worker removes the lock file while we wait on it
+    lock_path = str(tmp_path / 'entry.lock')
+    lockf = prism_cache.fcntl.lockf
+    calls = []
+
+    def removed_while_waiting(lock_file, operation):
+        lockf(lock_file, operation)
+        calls.append(operation)
+        if len(calls) == 1:
+            os.remove(lock_path)
+    monkeypatch.setattr(prism_cache.fcntl, 'lockf', removed_while_waiting)
+    entry_lock = prism_cache._EntryLock(lock_path)
+    assert entry_lock.acquire(shared = False)
+    assert len(calls) == 2
+    assert os.path.samestat(os.fstat(entry_lock.lock_file.fileno()), os.stat(lock_path))
+    entry_lock.release(shared = False)
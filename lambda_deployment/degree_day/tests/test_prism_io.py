@@ -0,0 +1,81 @@
+import os
+import zipfile
+import numpy as np
+import geopandas as gpd
+import rioxarray
+from shapely.geometry import Polygon
+from degree_day.prism_io import bbox_window, load_prism_raster, open_bil, open_prism_raster
+from degree_day.region_mask import MaskCache
+from conftest import N_ROWS, N_COLS, RES, ULX, ULY, write_prism_day
+
+### windowed PRISM reads against a full read and rio.clip
+
+DATE = '20240101'
+FILE_NAME = f'prism_tmin_us_30s_{DATE}.bil'
+
+
+def _geometry():
+    # a polygon whose edges cut through cells, away from the raster edges
+    return gpd.GeoSeries([Polygon([
+        (ULX + 4.3 * RES, ULY - 3.7 * RES), (ULX + 21.6 * RES, ULY - 5.2 * RES),
+        (ULX + 17.2 * RES, ULY - 16.4 * RES), (ULX + 6.8 * RES, ULY - 12.9 * RES)])], crs = 'EPSG:4269')
+
+def _archive(tmp_path):
+
+    rng = np.random.default_rng(3)
+    tmin = rng.uniform(-5, 15, (N_ROWS, N_COLS))
+    tmin[8, 10:14] = -9999 # nodata inside the region
+    write_prism_day(str(tmp_path), DATE, tmin, tmin + 10)
+    return os.path.join(str(tmp_path), DATE, 'tmin')
+
+def _clipped(var_dir, geometry):
+    # what the pipeline did before windowed reads: GDAL read of the extracted .bil, rio.clip
+    with zipfile.ZipFile(os.path.join(var_dir, f'{DATE}_tmin.zip')) as zip_ref:
+        zip_ref.extractall(os.path.join(var_dir, 'extracted'))
+    raw_raster = rioxarray.open_rasterio(os.path.join(var_dir, 'extracted', FILE_NAME))
+    clipped = raw_raster.rio.clip(geometry, drop = True)
+    clipped = clipped.where(clipped != -9999)
+    return clipped.drop_vars('band').squeeze()
+
+def test_bbox_window_covers_clip(tmp_path):
+    var_dir = _archive(tmp_path)
+    geometry = _geometry()
+    expected = _clipped(var_dir, geometry)
+    raster = open_prism_raster(var_dir, f'{DATE}_tmin.zip', FILE_NAME)
+    window = bbox_window(raster, geometry)
+    x = raster.x.values[int(window.col_off):int(window.col_off + window.width)]
+    y = raster.y.values[int(window.row_off):int(window.row_off + window.height)]
+    assert set(expected.x.values) <= set(x) and set(expected.y.values) <= set(y)
+    assert window.width < N_COLS and window.height < N_ROWS
+
+def test_load_prism_raster_matches_clip(tmp_path):
+    var_dir = _archive(tmp_path)
+    geometry = _geometry()
+    expected = _clipped(var_dir, geometry)
+    mask_cache = MaskCache()
+    for _ in range(2): # rasterized, then from the mask cache
+        clipped = load_prism_raster(var_dir, f'{DATE}_tmin.zip', FILE_NAME, geometry, mask_cache = mask_cache)
+        np.testing.assert_allclose(clipped.x.values, expected.x.values)
+        np.testing.assert_allclose(clipped.y.values, expected.y.values)
+        np.testing.assert_array_equal(clipped.values, expected.values)
+    assert len(mask_cache.values) == 1
+    assert np.isnan(clipped.values).any() and not np.isnan(clipped.values).all()
+
+def test_memmap_and_gdal_paths_agree(tmp_path):
+    # stored members are memory-mapped without copies, deflated ones (as PRISM serves them) go through GDAL
+    var_dir = _archive(tmp_path)
+    zip_file = os.path.join(var_dir, f'{DATE}_tmin.zip')
+    memmapped = open_prism_raster(var_dir, f'{DATE}_tmin.zip', FILE_NAME)
+    assert not memmapped.data.flags.writeable # a view of the read-only map, never a copy
+
+    deflated_dir = str(tmp_path / 'deflated')
+    os.makedirs(deflated_dir)
+    with zipfile.ZipFile(zip_file) as source, zipfile.ZipFile(os.path.join(deflated_dir, f'{DATE}_tmin.zip'), 'w', zipfile.ZIP_DEFLATED) as dest:
+        for name in source.namelist():
+            dest.writestr(name, source.read(name))
+    assert open_bil(deflated_dir, f'{DATE}_tmin.zip', FILE_NAME) is None
+    geometry = _geometry()
+    from_gdal = load_prism_raster(deflated_dir, f'{DATE}_tmin.zip', FILE_NAME, geometry, mask_cache = MaskCache())
+    from_memmap = load_prism_raster(var_dir, f'{DATE}_tmin.zip', FILE_NAME, geometry, mask_cache = MaskCache())
+    np.testing.assert_array_equal(from_gdal.values, from_memmap.values)
+    np.testing.assert_allclose(from_gdal.x.values, from_memmap.x.values)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+from degree_day.climatology import DAYS
+from degree_day.events import NODATA
+from degree_day.projection import GddProjection, ProjectionCache
+from conftest import OUTSIDE, daily_gdd, write_gdd_cube, write_normals
+
+### projections against observed sums followed by normal daily sums
+
+NORMAL = daily_gdd(len(DAYS), seed = 6, high = 8) # leap calendar
+TARGETS = {'early': 150, 'late': 900, 'never': 1e6}
+
+
+def _reference_series(obs_dates, observed, normal_of, as_of, start_day, days):
+    # (days, y, x) GDD accumulated since the biofix on each day: observed up
+    # to as_of, normal daily GDD after it
+    month, day = [int(x) for x in start_day.split('-')]
+    start = max(pd.Timestamp(as_of.year, month, day), obs_dates[0])
+    running = np.zeros(observed.shape[1:])
+    series = []
+    for date in pd.date_range(start, days[-1]):
+        if date <= as_of:
+            running = running + np.nan_to_num(observed[obs_dates.get_loc(date)])
+        else:
+            running = running + np.nan_to_num(normal_of(date.strftime('%m%d')))
+        series.append(running)
+    series = dict(zip(pd.date_range(start, days[-1]), series))
+    zero = np.zeros(observed.shape[1:])
+    return np.array([series.get(date, zero) for date in days])
+
+@pytest.fixture
+def observed(tmp_path):
+    # (cube_file, dates, daily) for the first five months of 2024
+    dates = pd.date_range('2024-01-01', '2024-05-31')
+    daily = daily_gdd(len(dates), seed = 7)
+    return write_gdd_cube(str(tmp_path / 'cube.nc'), dates, daily), dates, daily
+
+
+@pytest.mark.parametrize('kind', ['store', 'cube_2024'])
+@pytest.mark.parametrize('as_of, start_day', [
+    ('2024-04-10', '03-01'),
+    ('2024-02-15', '03-01'), # before the biofix
+    ('2024-07-01', '01-01'), # after the cube's last date
+])
+def test_accumulation_matches_sums(observed, tmp_path, kind, as_of, start_day):
+    cube_file, obs_dates, daily = observed
+    normals, pest, normal_of = write_normals(kind, str(tmp_path), NORMAL, start_day)
+    projection = GddProjection(
+        cube_file, normals, as_of, pest = pest, start_day = None if kind == 'store' else start_day, cache = ProjectionCache())
+    assert projection.as_of == min(pd.Timestamp(as_of), obs_dates[-1])
+
+    days = pd.DatetimeIndex(['2024-03-01', '2024-06-15', '2024-12-31']).append(projection.as_of + pd.to_timedelta([1, 2], 'D'))
+    days = days[days > projection.as_of].sort_values()
+    projected = projection.accumulation(days)
+    expected = _reference_series(obs_dates, daily, normal_of, projection.as_of, start_day, days)
+    np.testing.assert_allclose(projected.values, expected, rtol = 1e-5, atol = 1e-3)
+    with pytest.raises(ValueError, match = 'after'):
+        projection.accumulation([projection.as_of])
+
+@pytest.mark.parametrize('as_of, start_day', [('2024-04-10', '03-01'), ('2024-02-15', '03-01')])
+def test_event_dates_match_sums(observed, tmp_path, as_of, start_day):
+    cube_file, obs_dates, daily = observed
+    normals, _, normal_of = write_normals('cube_2024', str(tmp_path), NORMAL, start_day)
+    projection = GddProjection(cube_file, normals, as_of, start_day = start_day, cache = ProjectionCache())
+    days = pd.date_range(f'2024-{start_day}', '2024-12-31')
+    series = _reference_series(obs_dates, daily, normal_of, projection.as_of, start_day, days)
+    in_region = ~np.isnan(daily[0])
+    expected = np.full((len(TARGETS),) + daily.shape[1:], NODATA, dtype = np.int16)
+    for i, target in enumerate(TARGETS.values()):
+        reached = series >= target
+        expected[i] = np.where(reached.any(axis = 0) & in_region, days.dayofyear.values[reached.argmax(axis = 0)], NODATA)
+
+    events = projection.event_dates(TARGETS, chunk_days = 20)
+    np.testing.assert_array_equal(events.values, expected)
+    assert (events.values[0] != NODATA).any() and (events.values[2] == NODATA).all()
+    assert (events.values[(slice(None),) + OUTSIDE] == NODATA).all()
+    if projection.as_of >= pd.Timestamp(f'2024-{start_day}'):
+        assert (events.values[0][in_region] <= events.attrs['as_of']).any() # observed crossings
+    assert (events.values[1][in_region] > events.attrs['as_of']).all() # projected crossings
+
+def test_patched_cube_is_recomputed(observed, tmp_path):
+    # the cube's last write is part of the cache key
+    cube_file, obs_dates, daily = observed
+    normals, _, normal_of = write_normals('cube_2024', str(tmp_path), NORMAL)
+    cache = ProjectionCache()
+    before = GddProjection(cube_file, normals, '2024-04-10', cache = cache).accumulation(['2024-06-01']).values
+    daily[50] += 5
+    write_gdd_cube(cube_file, obs_dates, daily)
+    after = GddProjection(cube_file, normals, '2024-04-10', cache = cache).accumulation(['2024-06-01']).values
+    in_region = ~np.isnan(daily[0])
+    np.testing.assert_allclose((after - before)[0][in_region], 5, atol = 1e-3)
+    expected = _reference_series(obs_dates, daily, normal_of, pd.Timestamp('2024-04-10'), '01-01', pd.DatetimeIndex(['2024-06-01']))
+    np.testing.assert_allclose(after, expected, rtol = 1e-5, atol = 1e-3)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon, box
+from degree_day.cube_store import GddCubeStore
+from degree_day.query_index import ZonalIndexCache, query_points, query_zones, timeseries_path, update_timeseries_cube
+from conftest import N_ROWS, N_COLS, RES, ULX, ULY, daily_gdd, grid_template, write_gdd_cube
+
+### point and zonal queries against indexing and nanmean over the loaded cube
+
+POINTS = [ # (x, y), the last two off the grid
+    (ULX + 0.3 * RES, ULY - 0.2 * RES), (ULX + 12.5 * RES, ULY - 7.9 * RES), (ULX + 29.99 * RES, ULY - 19.99 * RES),
+    (ULX + 2.5 * RES, ULY - 1.5 * RES), # outside the region
+    (ULX - 0.1 * RES, ULY - 3 * RES), (ULX + 3 * RES, ULY + 0.1 * RES)]
+ZONES = [
+    Polygon([(ULX + 4.3 * RES, ULY - 3.7 * RES), (ULX + 21.6 * RES, ULY - 5.2 * RES), (ULX + 17.2 * RES, ULY - 16.4 * RES)]),
+    box(ULX + 2.2 * RES, ULY - 6.3 * RES, ULX + 9.7 * RES, ULY - 1.4 * RES), # partly outside the region
+    box(ULX + 10.2 * RES, ULY - 9.8 * RES, ULX + 14.9 * RES, ULY - 4.1 * RES), # overlaps the first
+    box(ULX + 0.2 * RES, ULY - 2.8 * RES, ULX + 3.7 * RES, ULY - 0.3 * RES), # outside the region only
+    box(ULX + 40 * RES, ULY - 5 * RES, ULX + 45 * RES, ULY - 1 * RES), # off the grid
+    box(ULX + 5.1 * RES, ULY - 5.9 * RES, ULX + 5.4 * RES, ULY - 5.6 * RES), # no cell centre inside
+]
+
+
+def _cube(tmp_path, n_dates = 50):
+
+    dates = pd.date_range('2024-03-01', periods = n_dates)
+    daily = daily_gdd(n_dates, seed = 8)
+    return write_gdd_cube(str(tmp_path / 'cube.nc'), dates, daily), dates, daily
+
+def _expected_points(daily):
+
+    columns = []
+    for x, y in POINTS:
+        row, col = int(np.floor((ULY - y) / RES)), int(np.floor((x - ULX) / RES))
+        on_grid = (0 <= row < N_ROWS) and (0 <= col < N_COLS)
+        columns.append(daily[:, row, col] if on_grid else np.full(len(daily), np.nan))
+    return np.stack(columns, axis = 1)
+
+def _expected_zones(daily):
+    # nanmean over the cells whose centre is inside each zone
+    template = grid_template()
+    xx, yy = np.meshgrid(template.x.values, template.y.values)
+    columns = []
+    for zone in ZONES:
+        inside = shapely.contains_xy(zone, xx, yy)
+        cells = daily[:, inside]
+        valid = ~np.isnan(cells)
+        with np.errstate(invalid = 'ignore'):
+            columns.append(np.where(valid.any(axis = 1), np.nansum(cells, axis = 1) / valid.sum(axis = 1), np.nan))
+    return np.stack(columns, axis = 1)
+
+
+def test_queries_match_loaded_cube(tmp_path):
+    cube_file, dates, daily = _cube(tmp_path)
+    window = slice(5, 41)
+    zonal_cache = ZonalIndexCache(str(tmp_path / 'zonal'))
+    # from the cube's slices, then from a time-major copy tiled smaller than the grid
+    for ts_file in (None, update_timeseries_cube(cube_file, chunk_dates = 16, tile = 8, block_dates = 12)):
+        if ts_file is not None:
+            assert GddCubeStore(ts_file).dates().equals(dates)
+        points = query_points(
+            cube_file, [x for x, _ in POINTS], [y for _, y in POINTS], ids = list('abcdef'),
+            start_date = dates[window.start], end_date = dates[window.stop - 1])
+        assert list(points.columns) == list('abcdef') and points.index.equals(pd.Index(dates[window], name = 'date'))
+        np.testing.assert_array_equal(points.values, _expected_points(daily)[window])
+
+        zones = query_zones(cube_file, ZONES, zonal_cache = zonal_cache)
+        assert zones.index.equals(pd.Index(dates, name = 'date'))
+        expected = _expected_zones(daily)
+        np.testing.assert_allclose(zones.values, expected, rtol = 1e-6)
+        assert np.isnan(zones.values[:, 3:]).all() and not np.isnan(zones.values[:, :3]).any()
+
+    # the zonal index is read back from the cache directory
+    reloaded = query_zones(cube_file, ZONES, zonal_cache = ZonalIndexCache(str(tmp_path / 'zonal')))
+    np.testing.assert_array_equal(reloaded.values, zones.values)
+
+def test_stale_timeseries_copy_is_bypassed_then_extended(tmp_path):
+    cube_file, dates, daily = _cube(tmp_path)
+    update_timeseries_cube(cube_file, tile = 8)
+    cube_store = GddCubeStore(cube_file)
+    more = daily_gdd(5, seed = 9)
+    new_dates = pd.date_range(dates[-1] + pd.Timedelta(days = 1), periods = 5)
+    for date, values in zip(new_dates, more):
+        cube_store.append(grid_template().copy(data = values), date = date)
+    daily[10] += 1
+    cube_store.write(grid_template().copy(data = daily[10]), date = dates[10])
+    daily = np.concatenate([daily, more])
+
+    xs, ys = [x for x, _ in POINTS], [y for _, y in POINTS]
+    # stale copy: read from the cube
+    np.testing.assert_array_equal(query_points(cube_file, xs, ys).values, _expected_points(daily))
+    update_timeseries_cube(cube_file, tile = 8)
+    assert GddCubeStore(timeseries_path(cube_file)).dates().equals(dates.append(new_dates))
+    np.testing.assert_array_equal(query_points(cube_file, xs, ys).values, _expected_points(daily))
+    np.testing.assert_allclose(query_zones(cube_file, ZONES, zonal_cache = ZonalIndexCache()).values, _expected_zones(daily), rtol = 1e-6)
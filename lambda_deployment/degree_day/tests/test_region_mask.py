@@ -0,0 +1,62 @@
+import numpy as np
+import xarray as xra
+import rioxarray # noqa: F401, registers .rio
+import geopandas as gpd
+from shapely.geometry import Polygon
+from degree_day import region_mask
+from degree_day.region_mask import MaskCache
+
+### region masks rasterized once and reused across days, variables and grids
+
+
+def _raster(values, res = 1.0):
+
+    n_rows, n_cols = values.shape
+    raster = xra.DataArray(
+        values[None], dims = ('band', 'y', 'x'),
+        coords = {'band': [1], 'y': 20 - res * (np.arange(n_rows) + 0.5), 'x': res * (np.arange(n_cols) + 0.5)})
+    return raster.rio.write_crs('EPSG:4269').rio.write_nodata(-9999.0)
+
+def _geometry():
+
+    return gpd.GeoSeries([Polygon([(2.3, 17.6), (11.4, 15.1), (8.2, 4.7), (3.1, 8.8)])], crs = 'EPSG:4269')
+
+def _counting(monkeypatch):
+
+    calls = []
+    rasterize = region_mask.rasterize_region
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return rasterize(*args, **kwargs)
+    monkeypatch.setattr(region_mask, 'rasterize_region', counted)
+    return calls
+
+def test_mask_reused_across_days_and_variables(monkeypatch):
+    calls = _counting(monkeypatch)
+    mask_cache = MaskCache()
+    rng = np.random.default_rng(5)
+    geometry = _geometry()
+    for _ in range(4): # e.g. tmin and tmax on two days
+        values = rng.uniform(-5, 30, (20, 15))
+        values[10, 5] = -9999
+        raster = _raster(values)
+        mask = mask_cache.get(raster, geometry)
+        expected = raster.rio.clip(geometry, drop = True)
+        expected = expected.where(expected != -9999)
+        applied = mask.apply(raster)
+        np.testing.assert_array_equal(applied.values, expected.values)
+        np.testing.assert_array_equal(applied.x.values, expected.x.values)
+    assert len(calls) == 1
+
+    # another grid is another mask
+    mask_cache.get(_raster(np.zeros((40, 30)), res = 0.5), geometry)
+    assert len(calls) == 2
+
+def test_mask_file_layer_shared_across_processes(monkeypatch, tmp_path):
+    calls = _counting(monkeypatch)
+    raster = _raster(np.zeros((20, 15)))
+    first = MaskCache(str(tmp_path)).get(raster, _geometry())
+    second = MaskCache(str(tmp_path)).get(raster, _geometry())
+    assert len(calls) == 1
+    assert second.window == first.window
+    np.testing.assert_array_equal(second.mask, first.mask)
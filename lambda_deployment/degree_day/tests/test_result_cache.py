@@ -0,0 +1,59 @@
+from degree_day.result_cache import ResultCache
+from conftest import age_object
+
+### ResultCache layers against the S3 stand-in
+
+FILES = {'gdd_raster.nc': b'netcdf', 'gdd_raster.png': b'png'}
+
+
+def test_shared_hit_and_publish(s3, tmp_path):
+
+    client, server = s3
+    cache = ResultCache(str(tmp_path / 'local'), client, 'test')
+    key = cache.key(date = '20240601', state = 'Oregon', lt = 10, ut = 30)
+    assert cache.lookup(key, list(FILES)) is None
+    cache.put_shared(key, FILES)
+    assert cache.lookup(key, list(FILES)) == 'shared'
+    cache.publish(key, {'gdd_raster.png': 'user/gdd_raster.png'})
+    assert client.get_object(Bucket = 'test', Key = 'user/gdd_raster.png')['Body'].read() == b'png'
+    assert cache.stats == {'local_hits': 0, 'shared_hits': 1, 'misses': 1}
+
+def test_expired_shared_objects_are_misses(s3, tmp_path):
+
+    client, server = s3
+    cache = ResultCache(str(tmp_path / 'local'), client, 'test', ttl = 3600)
+    key = cache.key(date = '20240601')
+    cache.put_shared(key, FILES)
+    assert cache.lookup(key, list(FILES)) == 'shared'
+    age_object(server, 'test', f'gdd_cache/{key}/gdd_raster.png', 7200)
+    assert cache.lookup(key, list(FILES)) is None
+
+def test_sweep_shared_deletes_only_old_objects(s3, tmp_path):
+
+    client, server = s3
+    cache = ResultCache(str(tmp_path / 'local'), client, 'test', ttl = 3600)
+    old, new = cache.key(date = '20240601'), cache.key(date = '20240602')
+    cache.put_shared(old, FILES)
+    cache.put_shared(new, FILES)
+    client.put_object(Bucket = 'test', Key = 'other/file', Body = b'x')
+    for name in FILES:
+        age_object(server, 'test', f'gdd_cache/{old}/{name}', 7200)
+    age_object(server, 'test', 'other/file', 7200)
+
+    assert cache.sweep_shared() == 2
+    keys = {obj['Key'] for obj in client.list_objects_v2(Bucket = 'test')['Contents']}
+    assert keys == {f'gdd_cache/{new}/{name}' for name in FILES} | {'other/file'}
+
+def test_apply_shared_lifecycle_keeps_other_rules(s3, tmp_path):
+
+    client, server = s3
+    other = {'ID': 'logs', 'Status': 'Enabled', 'Filter': {'Prefix': 'logs/'}, 'Expiration': {'Days': 30}}
+    client.put_bucket_lifecycle_configuration(Bucket = 'test', LifecycleConfiguration = {'Rules': [other]})
+    cache = ResultCache(str(tmp_path / 'local'), client, 'test')
+    cache.apply_shared_lifecycle(7)
+    cache.apply_shared_lifecycle(14) # replaces its own rule
+
+    rules = {rule['ID']: rule for rule in client.get_bucket_lifecycle_configuration(Bucket = 'test')['Rules']}
+    assert set(rules) == {'logs', 'gdd_cache-expiry'}
+    assert rules['gdd_cache-expiry']['Expiration'] == {'Days': 14}
+    assert rules['gdd_cache-expiry']['Filter'] == {'Prefix': 'gdd_cache/'}
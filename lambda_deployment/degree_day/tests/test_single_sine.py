@@ -0,0 +1,84 @@
+import itertools
+import numpy as np
+import pytest
+from degree_day import single_sine
+
+### closed-form single sine kernels against the sympy derivation
+# The closed forms agree with the symbolic integrals for non-negative
+# thresholds. With negative thresholds and a day that stays below 0 the sympy
+# Abs() terms flip the sign of the integral under the sine, so the symbolic
+# expressions are wrong there; the closed forms are checked against numerical
+# integration of the sine curve instead.
+
+sympy = pytest.importorskip('sympy')
+
+TEMPS = np.arange(0, 41, 2.5)
+THRESHOLDS = np.arange(0, 41, 2.5)
+
+
+@pytest.fixture(scope = 'module')
+def kernels():
+
+    return single_sine.derive_sympy_kernels()
+
+def _cases():
+    # (case, args) for every grid point that falls in the case
+    for temp_min, temp_max in itertools.combinations(TEMPS, 2):
+        for low, upp in itertools.combinations(THRESHOLDS, 2):
+            if upp <= temp_min:
+                yield 'case1', (low, upp)
+            elif low >= temp_max:
+                continue # case 2, 0
+            elif upp >= temp_max and low <= temp_min:
+                yield 'case3', (temp_min, temp_max, low)
+            elif upp >= temp_max:
+                yield 'case4', (temp_min, temp_max, low)
+            elif low <= temp_min:
+                yield 'case5', (temp_min, temp_max, low, upp)
+            else:
+                yield 'case6', (temp_min, temp_max, low, upp)
+
+def _numerical(temp_min, temp_max, low, upp, n = 200001):
+    # mean over one day of the sine clipped to [low, upp], less low
+    t = np.linspace(0, 1, n)
+    curve = np.clip(single_sine.sin_curve(temp_min, temp_max, t), low, upp) - low
+    return np.trapezoid(curve, t)
+
+
+@pytest.mark.parametrize('case', ['case1', 'case3', 'case4', 'case5', 'case6'])
+def test_closed_form_matches_sympy(kernels, case):
+
+    args = [a for c, a in _cases() if c == case]
+    assert len(args) > 0
+    closed = np.array([getattr(single_sine, case)(*a) for a in args])
+    symbolic = np.array([kernels[case](*a) for a in args], dtype = float)
+    np.testing.assert_allclose(closed, symbolic, rtol = 1e-9, atol = 1e-9)
+
+def test_degree_days_matches_cases():
+
+    for case, a in _cases():
+        if case == 'case1':
+            continue # needs the temperatures too
+        temp_min, temp_max, low = a[:3]
+        upp = a[3] if len(a) == 4 else temp_max + 1
+        mean, amp = single_sine.sine_params(temp_min, temp_max)
+        assert single_sine.degree_days(mean, amp, low, upp) == pytest.approx(getattr(single_sine, case)(*a), abs = 1e-9)
+
+NEGATIVE = [
+    (-30.0, -20.0, -25.0, 10.0), # case 4
+    (-30.0, -20.0, -25.0, -22.0), # case 6
+    (-30.0, -20.0, -35.0, -25.0), # case 5
+    (-10.0, 5.0, -5.0, 30.0), # case 4, crossing 0
+]
+
+@pytest.mark.parametrize('temp_min, temp_max, low, upp', NEGATIVE)
+def test_negative_thresholds_match_integration(temp_min, temp_max, low, upp):
+
+    mean, amp = single_sine.sine_params(temp_min, temp_max)
+    closed = single_sine.degree_days(mean, amp, low, upp)
+    assert closed == pytest.approx(_numerical(temp_min, temp_max, low, upp), abs = 1e-6)
+
+def test_sympy_diverges_below_zero(kernels):
+    # documents the known divergence: a day entirely below 0
+    temp_min, temp_max, low = NEGATIVE[0][:3]
+    assert abs(kernels['case4'](temp_min, temp_max, low) - single_sine.case4(temp_min, temp_max, low)) > 1
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import xarray as xra
+from degree_day.degree_day import DegreeDayCalculator, get_degree_days_raster_multi
+
+### tiled evaluation against the untiled path, bit for bit
+
+PEST_PARAMS = {
+    'codling_moth': {'lt': 10, 'ut': 31.1, 'method': 'single_sine'},
+    'cutworm': {'lt': 0, 'ut': 36, 'method': 'single_sine'},
+    'average': {'lt': 5, 'ut': 30, 'method': 'simple_avg'},
+}
+
+
+def _rasters(dtype = np.float32):
+
+    rng = np.random.default_rng(2)
+    tmin = rng.uniform(-10, 35, (45, 61)).astype(dtype)
+    tmax = (tmin + rng.uniform(-2, 20, tmin.shape)).astype(dtype)
+    tmin[5:9, 10:20] = np.nan
+    coords = {'y': np.arange(45), 'x': np.arange(61)}
+    return xra.DataArray(tmin, dims = ('y', 'x'), coords = coords), xra.DataArray(tmax, dims = ('y', 'x'), coords = coords)
+
+@pytest.mark.parametrize('tile_size, n_threads', [(7, 1), (16, 1), (7, 4), (100, 2)])
+def test_tiled_matches_untiled(tile_size, n_threads):
+    tmin, tmax = _rasters()
+    calculator = DegreeDayCalculator(10, 31.1)
+    untiled = calculator.get_degree_days_raster(tmin, tmax)
+    tiled = calculator.get_degree_days_raster(tmin, tmax, tile_size = tile_size, n_threads = n_threads)
+    assert tiled.dtype == untiled.dtype == np.float32
+    np.testing.assert_array_equal(tiled.values, untiled.values)
+
+def test_tiled_into_out():
+    tmin, tmax = _rasters(np.float64)
+    calculator = DegreeDayCalculator(0, 36)
+    out = np.full(tmin.shape, -1.0)
+    tiled = calculator.get_degree_days_raster(tmin, tmax, tile_size = 9, n_threads = 3, out = out)
+    assert tiled.values is out
+    np.testing.assert_array_equal(out, calculator.get_degree_days_raster(tmin, tmax).values)
+
+@pytest.mark.parametrize('tile_size, n_threads', [(7, 1), (13, 4)])
+def test_tiled_multi_matches_untiled_and_single_pests(tile_size, n_threads):
+    tmin, tmax = _rasters()
+    out = np.empty((len(PEST_PARAMS),) + tmin.shape, dtype = np.float32)
+    tiled = get_degree_days_raster_multi(tmin, tmax, PEST_PARAMS, tile_size = tile_size, n_threads = n_threads, out = out)
+    assert tiled.values is out
+    np.testing.assert_array_equal(out, get_degree_days_raster_multi(tmin, tmax, PEST_PARAMS).values)
+
+    # the shared-intermediate kernels round differently from the per-case ones,
+    # so per-pest calls agree to float64 precision rather than bit for bit
+    tmin, tmax = _rasters(np.float64)
+    tiled = get_degree_days_raster_multi(tmin, tmax, PEST_PARAMS, tile_size = tile_size, n_threads = n_threads)
+    for pest, params in PEST_PARAMS.items():
+        single = DegreeDayCalculator(params['lt'], params['ut'], params['method']).get_degree_days_raster(
+            tmin, tmax, tile_size = tile_size, n_threads = n_threads)
+        np.testing.assert_allclose(tiled.sel(pest = pest).values, single.values, rtol = 0, atol = 1e-12)
@@ -0,0 +1,72 @@
+import io
+import os
+import numpy as np
+import xarray as xra
+from boto3.s3.transfer import TransferConfig
+from degree_day.upload import netcdf_artifact, upload_artifacts
+from degree_day.result_cache import ResultCache
+
+### in-memory artifacts and concurrent uploads against the S3 stand-in
+
+
+def _raster(n = 50):
+
+    values = np.arange(n * n, dtype = 'float32').reshape(n, n)
+    return xra.DataArray(values, dims = ('y', 'x'), coords = {'y': np.arange(n), 'x': np.arange(n)}, name = 'gdd')
+
+def _get(client, key):
+
+    return client.get_object(Bucket = 'test', Key = key)['Body'].read()
+
+
+def test_netcdf_artifact_in_memory(tmp_path):
+
+    raster = _raster()
+    spill_path = str(tmp_path / 'spill' / 'raster.nc')
+    artifact = netcdf_artifact(raster, spill_path)
+    assert isinstance(artifact, bytes)
+    assert not os.path.exists(spill_path)
+    with xra.open_dataarray(io.BytesIO(artifact)) as opened:
+        np.testing.assert_array_equal(opened.values, raster.values)
+
+def test_netcdf_artifact_spills_above_max_memory(tmp_path):
+
+    raster = _raster()
+    spill_path = str(tmp_path / 'spill' / 'raster.nc')
+    artifact = netcdf_artifact(raster, spill_path, max_memory_bytes = raster.nbytes - 1)
+    assert artifact == spill_path
+    with xra.open_dataarray(spill_path) as opened:
+        np.testing.assert_array_equal(opened.values, raster.values)
+
+def test_upload_artifacts_concurrently(s3, tmp_path):
+
+    client, server = s3
+    server.put_delay = 0.3
+    spilled = netcdf_artifact(_raster(), str(tmp_path / 'raster.nc'), max_memory_bytes = 0)
+    artifacts = {'a.png': b'png', 'b.nc': netcdf_artifact(_raster(), None), 'c.nc': spilled}
+    upload_artifacts(client, 'test', artifacts)
+    assert server.max_in_flight >= 2
+    assert _get(client, 'a.png') == b'png'
+    assert _get(client, 'b.nc') == artifacts['b.nc']
+    with open(spilled, 'rb') as f:
+        assert _get(client, 'c.nc') == f.read()
+
+def test_upload_artifacts_multipart(s3):
+
+    client, server = s3
+    payload = np.random.default_rng(0).bytes(6 * 1024 ** 2)
+    config = TransferConfig(multipart_threshold = 1024 ** 2, multipart_chunksize = 5 * 1024 ** 2)
+    upload_artifacts(client, 'test', {'big.nc': payload}, transfer_config = config)
+    assert server.multipart == [('big.nc', 2)]
+    assert _get(client, 'big.nc') == payload
+
+def test_result_cache_without_local_layer(s3, tmp_path):
+
+    client, server = s3
+    cache = ResultCache(None, client, 'test')
+    key = cache.key(date = '20240601')
+    cache.put(key, {'gdd_raster.png': b'png'})
+    assert cache.lookup(key, ['gdd_raster.png']) == 'shared'
+    cache.publish(key, {'gdd_raster.png': 'user/gdd_raster.png'})
+    assert _get(client, 'user/gdd_raster.png') == b'png'
+    assert os.listdir(tmp_path) == ['s3'] # nothing written outside the stand-in
@@ -2,135 +2,388 @@ import sys
 sys.path.append('/mnt/entsoc2024-efs/lib')
 import json
 import shutil
-import urllib
 import os
-import zipfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 import boto3
 from degree_day import degree_day as dd
+from degree_day.prism_cache import PrismCache
+from degree_day.prism_io import load_prism_raster
+from degree_day.region_mask import MaskCache, set_default_mask_cache
+from degree_day.result_cache import ResultCache
+from degree_day.render import render_png
+from degree_day.upload import netcdf_artifact
 import xarray as xra
 import rioxarray
-import matplotlib.pyplot as plt
 import geopandas as gpd
 
 
-def lambda_handler(event, context):
-   
-    # Test connection to internet 
-    print('Testing internet connection...')
+### one-time initialization
+# Runs once per execution environment (cold start). Warm invocations reuse the
+# S3 client, the parsed state geometries, the region masks (in the default
+# mask cache, keyed by geometry), the degree day calculators, the result cache
+# and the raw PRISM cache. Locations can
+# be overridden through the environment, e.g. to point at local stub servers
+# (see ../benchmarks/benchmark.py).
+
+weather_var_list = ['tmin', 'tmax']
+base_url = os.environ.get('PRISM_BASE_URL', 'https://services.nacse.org/prism/data/public/4km')
+format = 'nc'
+s3_bucket = os.environ.get('S3_BUCKET', 'entsoc2024-ecodata-cloud-workshop')
+s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL') # None for AWS
+state_shapes_path = os.environ.get('STATE_SHAPES_PATH', f'zip+s3://{s3_bucket}/tl_2024_us_state.zip')
+storage_dir = os.environ.get('STORAGE_DIR', '/tmp/prism-etl') # for lambda
+efs_dir = os.environ.get('EFS_DIR', '/mnt/entsoc2024-efs')
+result_cache_bytes = int(os.environ.get('RESULT_CACHE_BYTES', 2 * 1024 ** 3))
+result_cache_ttl = float(os.environ['RESULT_CACHE_TTL']) if 'RESULT_CACHE_TTL' in os.environ else None # seconds
+max_batch_days = int(os.environ.get('MAX_BATCH_DAYS', 366))
+batch_workers = int(os.environ.get('BATCH_WORKERS', 4)) # concurrent day downloads / loads in a batch request
+prism_cache_bytes = int(os.environ.get('PRISM_CACHE_BYTES', 5 * 1024 ** 3))
+memory_artifact_bytes = int(os.environ.get('MEMORY_ARTIFACT_BYTES', 256 * 1024 ** 2)) # larger NetCDFs spill to disk
+png_scale = int(os.environ.get('PNG_SCALE', 2)) # pixels per grid cell
+result_version = 2 # bump when the artifacts change, so older cached results are not served
+
+_s3_client = None
+_state_shapes = None
+_state_geometries = {} # state name -> GeoSeries
+_calculators = {} # (lt, ut, method) -> DegreeDayCalculator
+_result_cache = None
+_prism_cache = None
+
+
+def get_s3_client():
+
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3', endpoint_url = s3_endpoint_url)
+    return _s3_client
+
+def get_state_shapes():
+
+    global _state_shapes
+    if _state_shapes is None:
+        _state_shapes = gpd.read_file(state_shapes_path)
+    return _state_shapes
+
+def get_state_geometry(state):
+    # the states file is read once, each state's geometry is selected once
+    if state not in _state_geometries:
+        shp_state = get_state_shapes().loc[lambda x: x.NAME == state]
+        if len(shp_state) == 0:
+            raise ValueError(f'{state} is not a known state.')
+        _state_geometries[state] = shp_state.geometry
+    return _state_geometries[state]
+
+def get_calculator(lt, ut, method = 'single_sine'):
+
+    key = (lt, ut, method)
+    if key not in _calculators:
+        _calculators[key] = dd.DegreeDayCalculator(lt, ut, method)
+    return _calculators[key]
+
+def get_result_cache():
+    # local layer on EFS when mounted (shared by all environments), none
+    # otherwise so artifacts never land in /tmp; shared layer under gdd_cache/
+    # in the bucket, expired by a bucket lifecycle rule
+    # (ResultCache.apply_shared_lifecycle, run once at deploy)
+    global _result_cache
+    if _result_cache is None:
+        local_dir = os.path.join(efs_dir, 'gdd_result_cache') if os.path.isdir(efs_dir) else None
+        _result_cache = ResultCache(
+            local_dir, get_s3_client(), s3_bucket, max_bytes = result_cache_bytes, ttl = result_cache_ttl)
+    return _result_cache
+
+def get_prism_cache():
+    # raw PRISM zips, one download per (var, date) for every environment that mounts EFS
+    global _prism_cache
+    if _prism_cache is None:
+        local_root = efs_dir if os.path.isdir(efs_dir) else storage_dir
+        _prism_cache = PrismCache(os.path.join(local_root, 'prism_cache'), max_bytes = prism_cache_bytes)
+    return _prism_cache
+
+def initialize():
+    print("Loading Common Variables and Objects")
+    start = time.perf_counter()
+    if os.path.isdir(efs_dir):
+        # region masks persist on EFS, so new execution environments skip rasterizing them
+        set_default_mask_cache(MaskCache(os.path.join(efs_dir, 'region_masks')))
+    get_s3_client()
+    get_result_cache()
+    get_prism_cache()
     try:
-        response = urllib.request.urlopen('https://aws.amazon.com')
-        status_code = response.getcode()
-        print(f'- Response Code: {status_code}. Internet connection established!')
+        get_state_shapes()
     except Exception as e:
-        print('- Error:', e)
-        raise e
+        # not fatal here, the first request retries and reports the error
+        print('- Could not preload state shapes:', e)
+    print(f'- Initialized in {time.perf_counter() - start:.2f} s')
 
-    print("Loading Common Variables and Objects")
-    ## Common objects
-    weather_var_list = ['tmin', 'tmax'] 
-    base_url = 'https://services.nacse.org/prism/data/public/4km'
-    format = 'nc'
-    s3_bucket = 'entsoc2024-ecodata-cloud-workshop'
-    s3_client = boto3.client('s3')
-
-    # event parameters 
+initialize()
+
+
+def prism_jobs(dates):
+
+    return [
+        {'url': f'{base_url}/{var}/{target_date}?format={format}', 'var': var, 'date': target_date}
+        for target_date in dates for var in weather_var_list]
+
+def load_day(var_dirs, target_date, state_geometry):
+    # {var: raster clipped to the state}; reads the state's window inside the
+    # cached zips rather than extracting them
+    prism_dict = {}
+    for var, var_dir in var_dirs.items():
+        file_name = f'PRISM_{var}_stable_4kmD2_{target_date}_nc.nc'
+        prism_dict[var] = load_prism_raster(var_dir, f'{var}_{target_date}.zip', file_name, state_geometry)
+    return prism_dict
+
+def parse_dates(event):
+    # 'dates' as a list or comma separated string, or an inclusive
+    # 'start_date' / 'end_date' range, all YYYYMMDD
+    if 'dates' in event:
+        dates = event['dates']
+        if isinstance(dates, str):
+            dates = dates.split(',')
+        dates = pd.to_datetime([str(d).strip() for d in dates], format = '%Y%m%d')
+    else:
+        dates = pd.date_range(
+            pd.to_datetime(str(event['start_date']), format = '%Y%m%d'),
+            pd.to_datetime(str(event['end_date']), format = '%Y%m%d'))
+    return sorted(set(dates.strftime('%Y%m%d')))
+
+def parse_thresholds(event):
+    # 'thresholds' as [[lt, ut], ...] or 'lt:ut,lt:ut', else temp_low / temp_high
+    if 'thresholds' in event:
+        thresholds = event['thresholds']
+        if isinstance(thresholds, str):
+            thresholds = [t.split(':') for t in thresholds.split(',')]
+    else:
+        thresholds = [(event['temp_low'], event['temp_high'])]
+    return [(int(lt), int(ut)) for lt, ut in thresholds]
+
+
+def lambda_handler(event, context):
+
+    # event parameters
     if 'queryStringParameters' in event:
         event = event['queryStringParameters']
+    if 'dates' in event or 'start_date' in event:
+        return batch_handler(event)
     target_date = event['date']
     lt = int(event['temp_low'])
     ut = int(event['temp_high'])
     user = event['user']
     state = event['state']
-    
-    # paths
-    storage_dir = "/tmp/prism-etl" # for lambda 
+    method = event.get('method', 'single_sine')
+    try:
+        state_geometry = get_state_geometry(state)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(str(e))
+        }
+
+    # paths; the gdd dir only holds artifacts too large to keep in memory
     gdd_dir = os.path.join(storage_dir, 'gdd')
     if os.path.exists(gdd_dir):
         shutil.rmtree(gdd_dir)
-    os.makedirs(gdd_dir)
     raster_name = f'gdd_raster_user={user}_date={target_date}_lt={lt}_ut={ut}.nc'
     local_raster_path = os.path.join(gdd_dir, raster_name)
     png_name = f'gdd_raster_user={user}_date={target_date}_lt={lt}_ut={ut}.png'
-    local_png_path = os.path.join(gdd_dir, png_name)
     s3_raster_loc = f'gdd_rasters/{user}/{raster_name}'
     s3_png_loc = f'gdd_rasters/{user}/{png_name}'
-        
+    dest_keys = {'gdd_raster.nc': s3_raster_loc, 'gdd_raster.png': s3_png_loc}
+
+    # the artifacts depend on everything but the user, so reuse them across users
+    result_cache = get_result_cache()
+    result_params = dict(date = target_date, state = state, lt = lt, ut = ut, method = method, version = result_version)
+    cache_key = result_cache.key(**result_params)
+    cache_layer = result_cache.lookup(cache_key, list(dest_keys))
+    if cache_layer is not None:
+        print(f'Result cache hit ({cache_layer}), copying artifacts to {user}. Cache stats: {result_cache.stats}')
+        result_cache.publish(cache_key, dest_keys)
+        return {
+            'statusCode': 200,
+            'headers': {'X-Cache': f'hit-{cache_layer}'},
+            'body': json.dumps('Computation complete!')
+        }
+    print(f'Result cache miss. Cache stats: {result_cache.stats}')
 
     print(f"Pulling weather data from PRISM for {target_date}.")
-    for var in weather_var_list:
-        dest_dir = os.path.join(storage_dir, var, target_date)
-        dest_file = os.path.join(dest_dir, f'{var}_{target_date}.zip')
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-
-        # download data
-        url =f'{base_url}/{var}/{target_date}?format={format}'
-        print(f'- Requesting {var} at {url}')
-
-        # handle failed connection to PRISM server
-        try:
-            urllib.request.urlretrieve(url, dest_file)
-        except: 
-            print('- Failed connection to PRISM!')
-            break 
-        else: print('- Connection to PRISM endpoint established.')
-        
-        # test for successful weather pull by checking for zip file 
-        iszip = zipfile.is_zipfile(dest_file)
-        if not iszip: 
-            weather_pull_succeeded = False
-            print(f'- Weather data for {var} failed to pull!') 
-            break # need both tmin and tmax, so break out if either fails
-
-        # unzip data
-        print(f'- Uncompressing {var} download')
-        with zipfile.ZipFile(dest_file, 'r') as zip_ref:
-            zip_ref.extractall(dest_dir)
-        
-        print(f'- Successfully pulled {var}')
-        
-    # Load PRISM rasters and clip to state
-    print(f'Loading PRISM rasters and clipping to {state}.') 
-    prism_dict = {} 
-    shp = gpd.read_file(f'zip+s3://entsoc2024-ecodata-cloud-workshop/tl_2024_us_state.zip')
-    # shp = gpd.read_file('/mnt/ecodata2024-efs/tl_2024_us_state.zip')
-    shp_state = shp.loc[lambda x: x.NAME == state]
-    for var in ['tmin', 'tmax']:
-        print(f'- Clipping {var} raster.')
-        # load var
-        dest_dir = os.path.join(storage_dir, var, target_date)
-        file_name = f'PRISM_{var}_stable_4kmD2_{target_date}_nc.nc'
-        file_path = os.path.join(dest_dir, file_name)
-        raw_raster = rioxarray.open_rasterio(file_path)
-        or_raster = raw_raster.rio.clip(shp_state.geometry, drop = True)
-        or_raster = or_raster.where(or_raster != -9999)
-        prism_dict[var] = or_raster.drop_vars('band').squeeze()
-        del raw_raster, or_raster
-
-    # create GDD artifacts
-    print('Creating GDD artifacts.')
-
-    # get gdd layer
-    print(f'- Setting up degree day calculator with lt = {lt} and ut = {ut}')
-    ss_calculator = dd.DegreeDayCalculator(lt, ut) 
-
-    print(f'- Calculating raster. This may take a moment ... ')
-    dd_array = ss_calculator.get_degree_days_raster(prism_dict['tmin'], prism_dict['tmax'])
-
-    print(f'- Saving raster to file.')
-    dd_array.to_netcdf(local_raster_path)
-
-    # Plotting to png
-    print(f'- Plotting raster and saving to file.')
-    dd_array.plot()
-    plt.savefig(local_png_path)
-    
-    # upload to S3
+    jobs = prism_jobs([target_date])
+    for job in jobs:
+        print(f"- Requesting {job['var']} at {job['url']}")
+
+    # tmin and tmax come from the shared cache, or are downloaded concurrently
+    # (with retries and rate limiting) by whichever invocation asks first.
+    # A failed download also covers what the old connectivity check caught.
+    prism_cache = get_prism_cache()
+    var_dirs = prism_cache.get_many(jobs)
+    if not all(var_dirs):
+        print('- Weather data failed to pull!')
+        return {
+            'statusCode': 502,
+            'body': json.dumps('Failed to pull weather data from PRISM.')
+        }
+
+    for job in jobs:
+        print(f"- Successfully pulled {job['var']}")
+    print(f'- PRISM cache stats: {prism_cache.stats}')
+
+    # the cached zips are held until the raster is computed, so other
+    # invocations cannot evict them while they are read
+    with prism_cache.reading(jobs) as var_dirs:
+        if not all(var_dirs):
+            return {
+                'statusCode': 502,
+                'body': json.dumps('Failed to pull weather data from PRISM.')
+            }
+
+        # Load PRISM rasters and clip to state
+        print(f'Loading PRISM rasters and clipping to {state}.')
+        prism_dict = load_day(dict(zip(weather_var_list, var_dirs)), target_date, state_geometry)
+
+        # create GDD artifacts
+        print('Creating GDD artifacts.')
+
+        # get gdd layer
+        print(f'- Using degree day calculator with lt = {lt} and ut = {ut}')
+        ss_calculator = get_calculator(lt, ut, method)
+
+        print(f'- Calculating raster. This may take a moment ... ')
+        dd_array = ss_calculator.get_degree_days_raster(prism_dict['tmin'], prism_dict['tmax'])
+
+    # serialized in memory, spilling only large rasters to disk
+    print(f'- Serializing raster.')
+    raster_artifact = netcdf_artifact(dd_array, local_raster_path, max_memory_bytes = memory_artifact_bytes)
+
+    # colormap lookup straight to png, no plotting library or figure state
+    print(f'- Rendering raster to png.')
+    png_artifact = render_png(dd_array, scale = png_scale)
+
+    # cache (uploading both artifacts concurrently), then copy to the user's keys in S3
     print('Uploading files to S3')
-    response = s3_client.upload_file(local_raster_path, s3_bucket, s3_raster_loc)
-    response = s3_client.upload_file(local_png_path, s3_bucket, s3_png_loc)
+    result_cache.put(cache_key, {'gdd_raster.nc': raster_artifact, 'gdd_raster.png': png_artifact}, **result_params)
+    result_cache.publish(cache_key, dest_keys)
 
     return {
         'statusCode': 200,
+        'headers': {'X-Cache': 'miss'},
         'body': json.dumps('Computation complete!')
-    }
\ No newline at end of file
+    }
+
+
+def batch_handler(event):
+    ### many dates and threshold pairs in one request
+    # Days are fetched concurrently through the PRISM cache and evaluated with
+    # the vectorized multi-threshold path into one (date, threshold, y, x) cube,
+    # optionally with the running total over the dates.
+    start = time.perf_counter()
+    method = event.get('method', 'single_sine')
+    accumulate = str(event.get('accumulate', 'false')).lower() in ('true', '1', 'yes')
+    try:
+        user = event['user']
+        state = event['state']
+        dates = parse_dates(event)
+        thresholds = parse_thresholds(event)
+        state_geometry = get_state_geometry(state)
+    except (ValueError, KeyError) as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(f'Invalid batch request: {e}')
+        }
+    if not 0 < len(dates) <= max_batch_days:
+        return {
+            'statusCode': 400,
+            'body': json.dumps(f'A batch request takes 1 to {max_batch_days} dates, got {len(dates)}.')
+        }
+    labels = [f'{lt}_{ut}' for lt, ut in thresholds]
+
+    def response(cache_state):
+        elapsed = time.perf_counter() - start
+        return {
+            'statusCode': 200,
+            'headers': {'X-Cache': cache_state},
+            'body': json.dumps({
+                'message': 'Computation complete!',
+                's3_key': s3_cube_loc,
+                'n_days': len(dates),
+                'thresholds': labels,
+                'elapsed_s': round(elapsed, 3),
+                'per_day_ms': round(1000 * elapsed / len(dates), 1),
+            })
+        }
+
+    result_cache = get_result_cache()
+    result_params = dict(
+        dates = dates, state = state, thresholds = thresholds, method = method,
+        accumulate = accumulate, version = result_version)
+    cache_key = result_cache.key(**result_params)
+    gdd_dir = os.path.join(storage_dir, 'gdd')
+    if os.path.exists(gdd_dir):
+        shutil.rmtree(gdd_dir)
+    cube_name = f'gdd_cube_user={user}_dates={dates[0]}-{dates[-1]}_{cache_key[:12]}.nc'
+    local_cube_path = os.path.join(gdd_dir, cube_name)
+    s3_cube_loc = f'gdd_cubes/{user}/{cube_name}'
+    dest_keys = {'gdd_cube.nc': s3_cube_loc}
+
+    cache_layer = result_cache.lookup(cache_key, list(dest_keys))
+    if cache_layer is not None:
+        print(f'Result cache hit ({cache_layer}), copying cube to {user}. Cache stats: {result_cache.stats}')
+        result_cache.publish(cache_key, dest_keys)
+        return response(f'hit-{cache_layer}')
+
+    print(f'Pulling weather data from PRISM for {len(dates)} dates.')
+    jobs = prism_jobs(dates)
+    prism_cache = get_prism_cache()
+    var_dirs = prism_cache.get_many(jobs, max_workers = batch_workers)
+    failed = sorted({job['date'] for job, var_dir in zip(jobs, var_dirs) if var_dir is None})
+    if failed:
+        print(f'- Weather data failed to pull for {failed}')
+        return {
+            'statusCode': 502,
+            'body': json.dumps({'message': 'Failed to pull weather data from PRISM.', 'failed_dates': failed})
+        }
+    day_jobs = {}
+    for job in jobs:
+        day_jobs.setdefault(job['date'], []).append(job)
+    print(f'- PRISM cache stats: {prism_cache.stats}')
+
+    print(f'Calculating {len(dates)} days x {len(thresholds)} thresholds for {state}.')
+    pest_params = {label: {'lt': lt, 'ut': ut, 'method': method} for label, (lt, ut) in zip(labels, thresholds)}
+
+    def compute_day(i, out = None):
+        # each day's zips are held only while that day is read
+        with prism_cache.reading(day_jobs[dates[i]]) as var_dirs:
+            if not all(var_dirs):
+                raise RuntimeError(f'PRISM data for {dates[i]} was evicted and could not be pulled again.')
+            var_dirs = {job['var']: var_dir for job, var_dir in zip(day_jobs[dates[i]], var_dirs)}
+            prism_dict = load_day(var_dirs, dates[i], state_geometry)
+            return dd.get_degree_days_raster_multi(prism_dict['tmin'], prism_dict['tmax'], pest_params, labels, out = out)
+
+    # the first day sets the grid, the rest are written straight into the cube
+    first_day = compute_day(0)
+    cube = np.empty((len(dates),) + first_day.shape, dtype = first_day.dtype)
+    cube[0] = first_day.values
+    with ThreadPoolExecutor(max_workers = batch_workers) as pool:
+        list(pool.map(lambda i: compute_day(i, out = cube[i]), range(1, len(dates))))
+
+    gdd = xra.DataArray(
+        cube,
+        dims = ('date',) + first_day.dims,
+        coords = {**first_day.coords, 'date': pd.to_datetime(dates, format = '%Y%m%d')},
+    ).rename(pest = 'threshold')
+    gdd_ds = gdd.to_dataset(name = 'gdd')
+    if accumulate:
+        # running total over the requested dates, nan outside the state
+        gdd_ds['gdd_cumulative'] = gdd.cumsum('date').where(gdd.notnull().any('date'))
+    gdd_ds.attrs.update({
+        'state': state, 'method': method,
+        'lt': [lt for lt, _ in thresholds], 'ut': [ut for _, ut in thresholds]})
+
+    print('- Serializing cube and uploading to S3.')
+    cube_artifact = netcdf_artifact(gdd_ds, local_cube_path, max_memory_bytes = memory_artifact_bytes)
+    result_cache.put(cache_key, {'gdd_cube.nc': cube_artifact}, **result_params)
+    result_cache.publish(cache_key, dest_keys)
+
+    return response('miss')